@@ -1,9 +1,104 @@
 import datetime
-from dataclasses import dataclass
+import hashlib
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Optional
 
+import numpy as np
 import pandas as pd
 import sqlalchemy
 
+from lcatricity_api.microservice.constants import conversion_factors, GENERATION_UNIT
+
+
+@dataclass
+class ImpactFactorMatrix:
+    """
+    Environmental impact factors as dense (generation type x impact category) arrays, with the units and unit conversion
+    factors already resolved. Cells without an impact factor are NaN in impact_values and conversion_factors
+    """
+    generation_type_ids: np.ndarray  # Sorted, shape (n_generation_types,)
+    impact_category_ids: np.ndarray  # Sorted, shape (n_impact_categories,)
+    impact_values: np.ndarray  # float, shape (n_generation_types, n_impact_categories)
+    conversion_factors: np.ndarray  # float, shape (n_generation_types, n_impact_categories)
+    impact_category_units: np.ndarray  # object, shape (n_generation_types, n_impact_categories)
+    per_units: np.ndarray  # object, shape (n_generation_types, n_impact_categories)
+    generation_unit: str
+
+    def generation_type_index(self, generation_type_ids) -> np.ndarray:
+        """Row index of each generation type id in the matrix, -1 where the generation type has no impact factors"""
+        return _index_of(self.generation_type_ids, generation_type_ids)
+
+    def impact_category_index(self, impact_category_ids) -> np.ndarray:
+        """Column index of each impact category id in the matrix, -1 where the impact category has no impact factors"""
+        return _index_of(self.impact_category_ids, impact_category_ids)
+
+
+def _index_of(sorted_ids: np.ndarray, ids) -> np.ndarray:
+    ids = np.asarray(ids, dtype=np.int64)
+    if sorted_ids.size == 0:
+        return np.full(ids.shape, -1, dtype=np.int64)
+    positions = np.searchsorted(sorted_ids, ids).clip(max=sorted_ids.size - 1)
+    return np.where(sorted_ids[positions] == ids, positions, -1)
+
+
+def build_impact_factor_matrix(environmental_impacts: pd.DataFrame,
+                               generation_unit: str = GENERATION_UNIT) -> ImpactFactorMatrix:
+    """
+    Pivot the EnvironmentalImpacts table into an ImpactFactorMatrix. Where a (generation type, impact category) pair has
+    several rows, the one with the latest ReferenceYear is used
+
+    :param environmental_impacts: Rows of the EnvironmentalImpacts table
+    :param generation_unit: Unit of the generation data the factors will be applied to
+    :return: ImpactFactorMatrix
+    """
+    impacts = environmental_impacts
+    if 'ReferenceYear' in impacts.columns:
+        impacts = impacts.sort_values('ReferenceYear')
+    impacts = impacts.drop_duplicates(['ElectricityGenerationTypeId', 'ImpactCategoryId'], keep='last')
+
+    generation_type_ids = np.unique(impacts['ElectricityGenerationTypeId'].to_numpy(dtype=np.int64))
+    impact_category_ids = np.unique(impacts['ImpactCategoryId'].to_numpy(dtype=np.int64))
+    shape = (generation_type_ids.size, impact_category_ids.size)
+    rows = np.searchsorted(generation_type_ids, impacts['ElectricityGenerationTypeId'].to_numpy(dtype=np.int64))
+    columns = np.searchsorted(impact_category_ids, impacts['ImpactCategoryId'].to_numpy(dtype=np.int64))
+
+    impact_values = np.full(shape, np.nan)
+    impact_values[rows, columns] = impacts['ImpactValue'].to_numpy(dtype=float)
+    impact_category_units = np.full(shape, None, dtype=object)
+    impact_category_units[rows, columns] = impacts['ImpactCategoryUnit'].to_numpy()
+    per_units = np.full(shape, None, dtype=object)
+    per_units[rows, columns] = impacts['PerUnit'].to_numpy()
+
+    factors = np.full(shape, np.nan)
+    for per_unit in impacts['PerUnit'].unique():
+        if (generation_unit, per_unit) not in conversion_factors:
+            logging.error(f'No conversion factor from `{generation_unit}` to `{per_unit}`. Impact factors per `{per_unit}` will be ignored')
+            continue
+        factors[per_units == per_unit] = conversion_factors[(generation_unit, per_unit)]
+    impact_values[np.isnan(factors)] = np.nan
+
+    return ImpactFactorMatrix(generation_type_ids=generation_type_ids,
+                              impact_category_ids=impact_category_ids,
+                              impact_values=impact_values,
+                              conversion_factors=factors,
+                              impact_category_units=impact_category_units,
+                              per_units=per_units,
+                              generation_unit=generation_unit)
+
+
+@dataclass(frozen=True)
+class EncodedTable:
+    """A reference data table encoded as JSON records once per cache load, with the ETag of the encoded bytes"""
+    body: bytes
+    etag: str
+
+
+def encode_table(df: pd.DataFrame) -> EncodedTable:
+    body = df.to_json(orient='records').encode()
+    return EncodedTable(body=body, etag=f'"{hashlib.sha256(body).hexdigest()[:32]}"')
+
 
 @dataclass
 class BasicDataCache:
@@ -12,19 +107,53 @@ class BasicDataCache:
     generation_type_mappings: pd.DataFrame
     regions: pd.DataFrame
     impact_categories: pd.DataFrame
+    environmental_impacts: pd.DataFrame
     retrieved_timestamp: datetime.datetime
+    # Indexed lookups, built once per cache load from the tables above
+    region_id_by_code: dict = field(init=False, repr=False)
+    region_code_by_id: dict = field(init=False, repr=False)
+    # Region codes shared by more than one region, which cannot be resolved to a region id
+    duplicated_region_codes: set = field(init=False, repr=False)
+    generation_type_by_id: dict = field(init=False, repr=False)
+    impact_factors: ImpactFactorMatrix = field(init=False, repr=False)
+    # JSON responses of the list endpoints, by table name (e.g. `regions`)
+    encoded_tables: dict = field(init=False, repr=False)
+    # Hash of the content of all the tables, to tell whether a reload changed anything
+    content_hash: str = field(init=False)
+    # Id of the shared snapshot this cache was published as or read from (see shared_reference_data), if any
+    snapshot_id: Optional[str] = field(default=None, init=False)
+
+    def __post_init__(self):
+        self.duplicated_region_codes = set(self.regions.loc[self.regions['Code'].duplicated(), 'Code'])
+        if self.duplicated_region_codes:
+            logging.error(f'More than one region found for region codes {sorted(self.duplicated_region_codes)}. '
+                          f'There is probably an error in the database')
+        region_ids_and_codes = list(zip(self.regions['Id'].astype(int), self.regions['Code']))
+        self.region_id_by_code = {code: region_id for region_id, code in region_ids_and_codes}
+        self.region_code_by_id = {region_id: code for region_id, code in region_ids_and_codes}
+        self.generation_type_by_id = {int(generation_type['Id']): generation_type
+                                      for generation_type in self.generation_types.to_dict(orient='records')}
+        self.impact_factors = build_impact_factor_matrix(self.environmental_impacts)
+        self.encoded_tables = {name: encode_table(getattr(self, name))
+                               for name in ('regions', 'generation_types', 'generation_type_mappings',
+                                            'impact_categories')}
+        content = hashlib.sha256(self.environmental_impacts.to_json(orient='records').encode())
+        for name in sorted(self.encoded_tables):
+            content.update(self.encoded_tables[name].etag.encode())
+        self.content_hash = content.hexdigest()[:32]
 
 
 def load_common_data_from_db(sql_engine) -> BasicDataCache:
-    """Load common data from the database and return as a BasicDataCache object"""
-    generation_types = pd.read_sql(sqlalchemy.text('SELECT * FROM public."ElectricityGenerationTypes"'), sql_engine)
-    generation_type_mappings = pd.read_sql(sqlalchemy.text('SELECT * FROM public."ElectricityGenerationTypesMapping"'),
-                                           sql_engine)
-    regions = pd.read_sql(sqlalchemy.text('SELECT * FROM public."Regions"'), sql_engine)
+    """Load common data from the database and return as a BasicDataCache object. The tables are read concurrently"""
+    table_names = {'generation_types': 'ElectricityGenerationTypes',
+                   'generation_type_mappings': 'ElectricityGenerationTypesMapping',
+                   'regions': 'Regions',
+                   'impact_categories': 'ImpactCategories',
+                   'environmental_impacts': 'EnvironmentalImpacts'}
+    with ThreadPoolExecutor(max_workers=len(table_names), thread_name_prefix='lcatricity-cache-load') as executor:
+        futures = {name: executor.submit(pd.read_sql, sqlalchemy.text(f'SELECT * FROM public."{table_name}"'),
+                                         sql_engine)
+                   for name, table_name in table_names.items()}
+        tables = {name: future.result() for name, future in futures.items()}
     retrieved_timestamp = datetime.datetime.now(datetime.timezone.utc)
-    impact_categories = pd.read_sql(sqlalchemy.text('SELECT * FROM public."ImpactCategories"'), sql_engine)
-    return BasicDataCache(generation_types=generation_types,
-                          regions=regions,
-                          generation_type_mappings=generation_type_mappings,
-                          impact_categories=impact_categories,
-                          retrieved_timestamp=retrieved_timestamp)
+    return BasicDataCache(retrieved_timestamp=retrieved_timestamp, **tables)
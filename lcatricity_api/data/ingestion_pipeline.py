@@ -0,0 +1,185 @@
+"""
+Parallel ingestion of many generation series, e.g. for a historical backfill of ENTSO-E data.
+
+Items (region_id, generation_type_id, generation_mw) are queued to a pool of worker threads sharing the connection pool
+of the engine given, so the engine should allow at least one connection per worker. Each region is always handled by
+the same worker, so that its transactions do not wait for each other on the lock of the rollups of the region (see
+rollups.lock_region_rollups), which serialises them with the other processes writing the region. The queues are
+bounded: when the workers fall behind, putting the next item blocks, so the series read ahead stay in memory only up
+to the queue size.
+
+Each worker stores the items waiting in its queue together, up to batch_size items per transaction (see
+store_generation_series_to_db). Items of the same region and generation type in a batch (e.g. the chunks of a
+backfill) are stored as separate series, each replacing only its own interval. Transient database errors (lost
+connections, deadlocks, serialization failures) are retried with exponential backoff. Other errors are reported per
+item and do not stop the pipeline.
+"""
+import logging
+import os
+import queue
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Iterable, Tuple, Optional, List
+
+import pandas as pd
+import sqlalchemy
+from dotenv import load_dotenv
+from sqlalchemy.exc import DBAPIError, OperationalError
+
+from lcatricity_api.data.store_generation_data import store_generation_series_to_db
+
+load_dotenv()
+
+INGEST_WORKERS = int(os.getenv('ELEC_LCA_INGEST_WORKERS', '4'))
+INGEST_QUEUE_SIZE = int(os.getenv('ELEC_LCA_INGEST_QUEUE_SIZE', '64'))
+INGEST_BATCH_SIZE = int(os.getenv('ELEC_LCA_INGEST_BATCH_SIZE', '20'))
+INGEST_MAX_RETRIES = int(os.getenv('ELEC_LCA_INGEST_MAX_RETRIES', '3'))
+# Seconds between two progress reports in the log
+INGEST_PROGRESS_INTERVAL = float(os.getenv('ELEC_LCA_INGEST_PROGRESS_INTERVAL', '10'))
+# Seconds to wait before the first retry, doubled for each following retry
+RETRY_BACKOFF = 1.0
+
+_STOP = object()
+
+
+@dataclass
+class IngestionReport:
+    items_stored: int = 0
+    rows_stored: int = 0
+    retries: int = 0
+    # (region_id, generation_type_id, error message) of the items that could not be stored
+    items_failed: List[Tuple[int, int, str]] = field(default_factory=list)
+    elapsed_s: float = 0.0
+
+    @property
+    def rows_per_second(self) -> float:
+        return self.rows_stored / self.elapsed_s if self.elapsed_s > 0 else 0.0
+
+
+def ingest_generation_series(items: Iterable[Tuple[int, int, pd.Series]], sql_engine: sqlalchemy.Engine,
+                             n_workers: int = INGEST_WORKERS, queue_size: int = INGEST_QUEUE_SIZE,
+                             batch_size: int = INGEST_BATCH_SIZE, max_retries: int = INGEST_MAX_RETRIES,
+                             progress_interval: float = INGEST_PROGRESS_INTERVAL,
+                             total: Optional[int] = None) -> IngestionReport:
+    """
+    Store generation series on a pool of workers. Returns once every item has been stored or has failed
+
+    :param items: Iterable (e.g. a generator downloading the data) of (region_id, generation_type_id, generation_mw)
+        items, with generation_mw as expected by store_generation_data_to_db
+    :param sql_engine: SQL engine to the elec_lca database, with a pool of at least n_workers connections
+    :param n_workers: Number of worker threads
+    :param queue_size: Maximum number of items waiting to be stored, over all workers
+    :param batch_size: Maximum number of items stored in one transaction
+    :param max_retries: Number of retries of an item after a transient database error
+    :param progress_interval: Seconds between two progress reports in the log
+    :param total: Optional number of items, for the progress reports
+    :return: IngestionReport
+    """
+    report = IngestionReport()
+    report_lock = threading.Lock()
+    queues = [queue.Queue(maxsize=max(1, queue_size // n_workers)) for _ in range(n_workers)]
+    workers = [threading.Thread(target=_worker, args=(worker_queue, sql_engine, batch_size, max_retries, report,
+                                                      report_lock),
+                                name=f'lcatricity-ingest-{i}', daemon=True)
+               for i, worker_queue in enumerate(queues)]
+    for worker in workers:
+        worker.start()
+
+    s = time.perf_counter()
+    done = threading.Event()
+    progress = threading.Thread(target=_report_progress, args=(report, report_lock, s, total, progress_interval, done),
+                                name='lcatricity-ingest-progress', daemon=True)
+    progress.start()
+    try:
+        for region_id, generation_type_id, generation_mw in items:
+            # Blocks while the queue of the worker is full
+            queues[hash(int(region_id)) % n_workers].put((region_id, generation_type_id, generation_mw))
+    finally:
+        for worker_queue in queues:
+            worker_queue.put(_STOP)
+        for worker in workers:
+            worker.join()
+        done.set()
+        progress.join()
+        report.elapsed_s = time.perf_counter() - s
+
+    logging.info(f'Ingestion finished: {report.items_stored} series and {report.rows_stored} rows stored in '
+                 f'{report.elapsed_s:.1f} s ({report.rows_per_second:.0f} rows/s), {report.retries} retries, '
+                 f'{len(report.items_failed)} series failed')
+    return report
+
+
+def _worker(worker_queue: queue.Queue, sql_engine: sqlalchemy.Engine, batch_size: int, max_retries: int,
+            report: IngestionReport, report_lock: threading.Lock):
+    stop = False
+    while not stop:
+        item = worker_queue.get()
+        if item is _STOP:
+            return
+        batch = [item]
+        while len(batch) < batch_size:
+            try:
+                item = worker_queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is _STOP:
+                stop = True
+                break
+            batch.append(item)
+        _store_batch(batch, sql_engine, max_retries, report, report_lock)
+
+
+def _store_batch(batch: list, sql_engine: sqlalchemy.Engine, max_retries: int, report: IngestionReport,
+                 report_lock: threading.Lock):
+    """Store a batch of items in one transaction. If it fails for a non transient reason, store the items one by one"""
+    try:
+        _store_with_retries(batch, sql_engine, max_retries, report, report_lock)
+    except Exception as e:
+        if len(batch) == 1:
+            region_id, generation_type_id, _ = batch[0]
+            logging.error(f'Could not store the series of region={region_id} and generation type='
+                          f'{generation_type_id}: {e}')
+            with report_lock:
+                report.items_failed.append((region_id, generation_type_id, str(e)))
+            return
+        for item in batch:
+            _store_batch([item], sql_engine, max_retries, report, report_lock)
+        return
+    with report_lock:
+        report.items_stored += len(batch)
+        report.rows_stored += sum(len(generation_mw) for _, _, generation_mw in batch)
+
+
+def _store_with_retries(batch: list, sql_engine: sqlalchemy.Engine, max_retries: int, report: IngestionReport,
+                        report_lock: threading.Lock):
+    for attempt in range(max_retries + 1):
+        try:
+            store_generation_series_to_db([(generation_mw, generation_type_id, region_id)
+                                           for region_id, generation_type_id, generation_mw in batch], sql_engine)
+            return
+        except DBAPIError as e:
+            if attempt == max_retries or not _is_transient(e):
+                raise
+            delay = RETRY_BACKOFF * 2 ** attempt
+            logging.warning(f'Transient error storing {len(batch)} series, retrying in {delay:.0f} s: {e}')
+            with report_lock:
+                report.retries += 1
+            time.sleep(delay)
+
+
+def _is_transient(error: DBAPIError) -> bool:
+    """Lost connections, deadlocks and serialization failures, which may succeed when retried"""
+    return error.connection_invalidated or isinstance(error, OperationalError)
+
+
+def _report_progress(report: IngestionReport, report_lock: threading.Lock, start: float, total: Optional[int],
+                     interval: float, done: threading.Event):
+    while not done.wait(interval):
+        with report_lock:
+            items_done = report.items_stored + len(report.items_failed)
+            rows_stored = report.rows_stored
+        elapsed = time.perf_counter() - start
+        of_total = f'/{total}' if total is not None else ''
+        logging.info(f'Ingestion progress: {items_done}{of_total} series, {rows_stored} rows, '
+                     f'{rows_stored / elapsed:.0f} rows/s')
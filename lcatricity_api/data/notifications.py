@@ -0,0 +1,56 @@
+"""
+Postgres NOTIFY messages sent when generation data is written, so that API workers can invalidate what they have
+cached for the rewritten (region, generation type, date range).
+
+The message is sent inside the writing transaction, so it is only delivered if the write is committed.
+"""
+import json
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Optional
+
+import sqlalchemy
+from sqlalchemy import func, select
+
+GENERATION_WRITTEN_CHANNEL = 'lcatricity_generation_written'
+
+
+@dataclass(frozen=True)
+class GenerationWritten:
+    region_id: int
+    generation_type_id: Optional[int]
+    start: datetime
+    end: datetime
+
+
+def notify_generation_written(connection: sqlalchemy.Connection, region_id: int, generation_type_id: Optional[int],
+                              start: datetime, end: datetime):
+    """
+    Send a GENERATION_WRITTEN_CHANNEL notification for data written in [start, end]
+
+    :param connection: SQLAlchemy connection, in the transaction that wrote the data
+    :param region_id: Internal region id
+    :param generation_type_id: Internal generation type id, or None if several generation types were written
+    :param start: First DateStamp written
+    :param end: Last DateStamp written
+    """
+    payload = json.dumps({'RegionId': int(region_id),
+                          'GenerationTypeId': int(generation_type_id) if generation_type_id is not None else None,
+                          'Start': start.isoformat(),
+                          'End': end.isoformat()})
+    connection.execute(select(func.pg_notify(GENERATION_WRITTEN_CHANNEL, payload)))
+
+
+def parse_generation_written(payload: str) -> GenerationWritten:
+    """Parse the payload of a GENERATION_WRITTEN_CHANNEL notification. Dates are returned as naive UTC datetimes"""
+    message = json.loads(payload)
+    return GenerationWritten(region_id=int(message['RegionId']),
+                             generation_type_id=message['GenerationTypeId'],
+                             start=_naive_utc(datetime.fromisoformat(message['Start'])),
+                             end=_naive_utc(datetime.fromisoformat(message['End'])))
+
+
+def _naive_utc(value: datetime) -> datetime:
+    if value.tzinfo is None:
+        return value
+    return value.astimezone(timezone.utc).replace(tzinfo=None)
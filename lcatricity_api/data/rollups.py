@@ -0,0 +1,274 @@
+"""
+Rollup tables of the electricity generation data at hourly, daily and monthly resolution.
+
+Each rollup row summarises one (region, generation type, time bucket) with the sum, median, min, max and count of the
+generation data points in the bucket. Hourly rollups are computed from the raw ElectricityGeneration rows. Daily and
+monthly rollups are computed from the hourly rollups, so their median is an approximation (the median of the hourly
+medians).
+
+The availability rollup counts the data points of each (region, day) over all generation types, with the first and
+last DateStamp of the day, for the data availability endpoints.
+
+The rollups are kept up to date by store_generation_data_to_db, which refreshes the buckets overlapping the range it
+writes, and creates the rollup tables if they do not exist. The API only reads a rollup whose row exists in the
+coverage table, and reads the raw rows otherwise. The rollup tables created over an empty ElectricityGeneration table
+are covered straight away. Over existing data, the ingest does not build them, as it would hold the rollup lock for
+the whole build: build them (or rebuild them) once with
+
+    python -m lcatricity_api.data.rollups
+
+which writes the coverage rows when it is done.
+"""
+import logging
+import os
+import time
+from datetime import datetime
+from typing import Optional
+
+import sqlalchemy
+from sqlalchemy import Column, Integer, Float, String, DateTime, func, literal, literal_column, select, cast, text, \
+    exists
+
+from lcatricity_api.microservice.resolution import bucket_expression
+from lcatricity_dataschema.base import ElectricityGeneration
+
+rollup_metadata = sqlalchemy.MetaData()
+
+
+def _rollup_table(name: str) -> sqlalchemy.Table:
+    return sqlalchemy.Table(
+        name, rollup_metadata,
+        Column('RegionId', Integer, primary_key=True),
+        Column('GenerationTypeId', Integer, primary_key=True),
+        # Start of the time bucket. Same type as ElectricityGeneration.DateStamp so that range filters behave the same
+        Column('DateStamp', ElectricityGeneration.__table__.c.DateStamp.type, primary_key=True),
+        Column('SumGeneration', Float),
+        Column('MedianGeneration', Float),
+        Column('MinGeneration', Float),
+        Column('MaxGeneration', Float),
+        Column('CountDataPoints', Integer),
+    )
+
+
+ROLLUP_TABLES = {
+    'hour': _rollup_table('ElectricityGenerationHourly'),
+    'day': _rollup_table('ElectricityGenerationDaily'),
+    'month': _rollup_table('ElectricityGenerationMonthly'),
+}
+
+AVAILABILITY_TABLE = sqlalchemy.Table(
+    'ElectricityGenerationAvailability', rollup_metadata,
+    Column('RegionId', Integer, primary_key=True),
+    # Start of the day
+    Column('Day', ElectricityGeneration.__table__.c.DateStamp.type, primary_key=True),
+    Column('EarliestTimeStamp', ElectricityGeneration.__table__.c.DateStamp.type),
+    Column('LatestTimeStamp', ElectricityGeneration.__table__.c.DateStamp.type),
+    Column('CountDataPoints', Integer),
+)
+
+# A row per rollup (`hour`, `day`, `month` and `availability`) once it holds every generation row: written when the
+# rollup tables are created empty, or built over all the data, after which the ingest keeps them up to date
+ROLLUP_COVERAGE_TABLE = sqlalchemy.Table(
+    'ElectricityGenerationRollupCoverage', rollup_metadata,
+    Column('Rollup', String, primary_key=True),
+    Column('BuiltAt', DateTime(timezone=True)),
+)
+AVAILABILITY_ROLLUP = 'availability'
+# Key of the advisory lock serialising the creation and the building of the rollups between processes. Refreshes of
+# the rollups of a region hold it shared, and an exclusive lock on (key, region id)
+_ROLLUP_LOCK_KEY = 0x4c434152
+
+_engines_with_rollup_tables = set()
+
+
+def create_rollup_tables(sql_engine: sqlalchemy.Engine):
+    """
+    Create the rollup tables if they do not exist yet. They are marked as covered if there is no generation data yet,
+    otherwise the rollups of the existing data are left to rebuild_generation_rollups. Only checks the database once per
+    engine
+    """
+    if id(sql_engine) in _engines_with_rollup_tables:
+        return
+    with sql_engine.begin() as connection:
+        # Another process may be creating or building the rollups
+        connection.execute(text('SELECT pg_advisory_xact_lock(:key)'), {'key': _ROLLUP_LOCK_KEY})
+        rollup_metadata.create_all(connection, checkfirst=True)
+        if not _is_covered(connection):
+            if connection.execute(select(exists().select_from(ElectricityGeneration))).scalar():
+                logging.warning('The generation rollups do not cover the existing data and are not read by the API. '
+                                'Build them with `python -m lcatricity_api.data.rollups`')
+            else:
+                _mark_covered(connection)
+    _engines_with_rollup_tables.add(id(sql_engine))
+
+
+def is_rollup_covered(rollup: str):
+    """SQL condition true if the rollup (e.g. `hour` or `availability`) holds every generation row"""
+    return exists().where(ROLLUP_COVERAGE_TABLE.c.Rollup == rollup)
+
+
+def _is_covered(connection: sqlalchemy.Connection) -> bool:
+    covered = set(connection.execute(select(ROLLUP_COVERAGE_TABLE.c.Rollup)).scalars())
+    return covered >= set(ROLLUP_TABLES) | {AVAILABILITY_ROLLUP}
+
+
+def _build_rollups(connection: sqlalchemy.Connection):
+    """Recompute every rollup over all the generation data and record their coverage, within the transaction given"""
+    s = time.time()
+    start, end = connection.execute(select(func.min(ElectricityGeneration.DateStamp),
+                                           func.max(ElectricityGeneration.DateStamp))).one()
+    if start is None:
+        logging.info('No generation data to build rollups from')
+    else:
+        logging.info(f'Building the generation rollups for `{start}`-`{end}`')
+        refresh_generation_rollups(connection, start, end)
+    _mark_covered(connection)
+    logging.info(f'{time.time() - s:.2f} s to build the generation rollups')
+
+
+def _mark_covered(connection: sqlalchemy.Connection):
+    """Record that every rollup holds every generation row, within the transaction given"""
+    connection.execute(ROLLUP_COVERAGE_TABLE.delete())
+    connection.execute(ROLLUP_COVERAGE_TABLE.insert().values(BuiltAt=func.now()),
+                       [{'Rollup': rollup} for rollup in [*ROLLUP_TABLES, AVAILABILITY_ROLLUP]])
+
+
+def lock_region_rollups(connection: sqlalchemy.Connection, region_id: int):
+    """
+    Wait for the other transactions refreshing the rollups of the region (or building all the rollups) to end, and keep
+    them from starting until the transaction of the connection given ends. Without it, two transactions writing
+    different generation types of a region would both delete and re-insert the same availability rows, and the second
+    insert would fail on the primary key. Locks are taken in order of region id to avoid deadlocks
+    """
+    connection.execute(text('SELECT pg_advisory_xact_lock_shared(:key)'), {'key': _ROLLUP_LOCK_KEY})
+    connection.execute(text('SELECT pg_advisory_xact_lock(:key, :region_id)'),
+                       {'key': _ROLLUP_LOCK_KEY, 'region_id': int(region_id)})
+
+
+def _bucket_bounds(resolution: str, start: datetime, end: datetime):
+    """SQL expressions of the start of the first bucket and the end of the last bucket overlapping [start, end]"""
+    unit = literal_column(f"'{resolution}'")
+    date_stamp_type = ElectricityGeneration.__table__.c.DateStamp.type
+    return (func.date_trunc(unit, cast(literal(start), date_stamp_type)),
+            func.date_trunc(unit, cast(literal(end), date_stamp_type)) + literal_column(f"interval '1 {resolution}'"))
+
+
+def refresh_generation_rollups(connection: sqlalchemy.Connection, start: datetime, end: datetime,
+                               region_id: Optional[int] = None, generation_type_id: Optional[int] = None):
+    """
+    Recompute the rollup rows of every bucket overlapping [start, end], within the transaction of the connection given.
+    If region_id or generation_type_id is None, the buckets of all regions / generation types are recomputed. The
+    availability rollup of the days overlapping [start, end] is recomputed for the region over all generation types
+
+    :param connection: SQLAlchemy connection, in a transaction
+    :param start: First DateStamp written
+    :param end: Last DateStamp written
+    :param region_id: Optional internal region id to restrict the refresh to
+    :param generation_type_id: Optional internal generation type id to restrict the refresh to
+    """
+    if region_id is not None:
+        lock_region_rollups(connection, region_id)
+    hourly = ROLLUP_TABLES['hour']
+    # (resolution, source table, column aggregated by the median, by the sum, by the min, by the max, count expression)
+    raw = ElectricityGeneration.__table__
+    levels = [
+        ('hour', raw, raw.c.AggregatedGeneration, raw.c.AggregatedGeneration, raw.c.AggregatedGeneration,
+         raw.c.AggregatedGeneration, func.count(raw.c.AggregatedGeneration)),
+        ('day', hourly, hourly.c.MedianGeneration, hourly.c.SumGeneration, hourly.c.MinGeneration,
+         hourly.c.MaxGeneration, func.sum(hourly.c.CountDataPoints)),
+        ('month', hourly, hourly.c.MedianGeneration, hourly.c.SumGeneration, hourly.c.MinGeneration,
+         hourly.c.MaxGeneration, func.sum(hourly.c.CountDataPoints)),
+    ]
+    for resolution, source, median_of, sum_of, min_of, max_of, count in levels:
+        rollup = ROLLUP_TABLES[resolution]
+        lower, upper = _bucket_bounds(resolution, start, end)
+
+        delete_query = rollup.delete().where((rollup.c.DateStamp >= lower) & (rollup.c.DateStamp < upper))
+        bucket = bucket_expression(source.c.DateStamp, resolution)
+        source_query = (select(source.c.RegionId,
+                               source.c.GenerationTypeId,
+                               bucket,
+                               func.sum(sum_of),
+                               func.percentile_cont(0.5).within_group(median_of),
+                               func.min(min_of),
+                               func.max(max_of),
+                               count)
+                        .where((source.c.DateStamp >= lower) & (source.c.DateStamp < upper))
+                        .group_by(source.c.RegionId, source.c.GenerationTypeId, bucket))
+        if region_id is not None:
+            delete_query = delete_query.where(rollup.c.RegionId == int(region_id))
+            source_query = source_query.where(source.c.RegionId == int(region_id))
+        if generation_type_id is not None:
+            delete_query = delete_query.where(rollup.c.GenerationTypeId == int(generation_type_id))
+            source_query = source_query.where(source.c.GenerationTypeId == int(generation_type_id))
+
+        connection.execute(delete_query)
+        insert_result = connection.execute(rollup.insert().from_select(
+            ['RegionId', 'GenerationTypeId', 'DateStamp', 'SumGeneration', 'MedianGeneration', 'MinGeneration',
+             'MaxGeneration', 'CountDataPoints'],
+            source_query))
+        logging.debug(f'{insert_result.rowcount} {resolution} rollup rows refreshed for region={region_id}, '
+                      f'generation type={generation_type_id} and date range=`{start}`-`{end}`')
+
+    refresh_availability_rollup(connection, start, end, region_id=region_id)
+
+
+def refresh_availability_rollup(connection: sqlalchemy.Connection, start: datetime, end: datetime,
+                                region_id: Optional[int] = None):
+    """
+    Recompute the availability rows of every day overlapping [start, end], within the transaction of the connection
+    given. If region_id is None, the days of all regions are recomputed
+
+    :param connection: SQLAlchemy connection, in a transaction
+    :param start: First DateStamp written
+    :param end: Last DateStamp written
+    :param region_id: Optional internal region id to restrict the refresh to
+    """
+    if region_id is not None:
+        lock_region_rollups(connection, region_id)
+    raw = ElectricityGeneration.__table__
+    availability = AVAILABILITY_TABLE
+    lower, upper = _bucket_bounds('day', start, end)
+
+    delete_query = availability.delete().where((availability.c.Day >= lower) & (availability.c.Day < upper))
+    day = bucket_expression(raw.c.DateStamp, 'day')
+    source_query = (select(raw.c.RegionId,
+                           day,
+                           func.min(raw.c.DateStamp),
+                           func.max(raw.c.DateStamp),
+                           func.count(raw.c.DateStamp))
+                    .where((raw.c.DateStamp >= lower) & (raw.c.DateStamp < upper))
+                    .group_by(raw.c.RegionId, day))
+    if region_id is not None:
+        delete_query = delete_query.where(availability.c.RegionId == int(region_id))
+        source_query = source_query.where(raw.c.RegionId == int(region_id))
+
+    connection.execute(delete_query)
+    insert_result = connection.execute(availability.insert().from_select(
+        ['RegionId', 'Day', 'EarliestTimeStamp', 'LatestTimeStamp', 'CountDataPoints'], source_query))
+    logging.debug(f'{insert_result.rowcount} availability rows refreshed for region={region_id} and date '
+                  f'range=`{start}`-`{end}`')
+
+
+def rebuild_generation_rollups(sql_engine: sqlalchemy.Engine):
+    """Rebuild the rollups of all the generation data in the database, creating the rollup tables if needed"""
+    with sql_engine.begin() as connection:
+        connection.execute(text('SELECT pg_advisory_xact_lock(:key)'), {'key': _ROLLUP_LOCK_KEY})
+        rollup_metadata.create_all(connection, checkfirst=True)
+        _build_rollups(connection)
+    _engines_with_rollup_tables.add(id(sql_engine))
+
+
+if __name__ == '__main__':
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO)
+    rebuild_generation_rollups(sqlalchemy.create_engine(sqlalchemy.engine.url.URL.create(
+        drivername='postgresql',
+        host=os.getenv('ELEC_LCA_DB_HOST'),
+        database=os.getenv('ELEC_LCA_DB_NAME'),
+        username=os.getenv('ELEC_LCA_DB_LOGIN'),
+        password=os.getenv('ELEC_LCA_DB_PWD'),
+        port=os.getenv('ELEC_LCA_DB_PORT')
+    )))
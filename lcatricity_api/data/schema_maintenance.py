@@ -0,0 +1,423 @@
+"""
+Index and monthly range partitions of the ElectricityGeneration table.
+
+The generation reads (generation.py, data_availability.py) and the upsert of store_generation_frame_to_db all filter the
+table on RegionId, GenerationTypeId and a DateStamp range. This module keeps the table organised for that access
+pattern:
+
+- A composite (RegionId, GenerationTypeId, DateStamp) index, with AggregatedGeneration as a non-key column so that the
+  raw reads are index-only scans. On a plain table it is built with CREATE INDEX CONCURRENTLY. On a partitioned table it
+  is created on the parent only, then concurrently on each partition and attached, so writes are never blocked.
+- Monthly range partitions on DateStamp, named ElectricityGeneration_yYYYYmMM, with a default partition for the rows of
+  months that have no partition yet. A DateStamp range then only reads the partitions of its months.
+
+Converting the existing table (partition_generation_table) copies every row into a new partitioned table, then swaps
+the names. The table can still be read during the copy, but not written, so run it in a maintenance window. The
+previous table is kept as ElectricityGeneration_unpartitioned unless drop_previous is set, and only the managed index
+is created on the new table: other secondary indexes of the previous table are logged, not carried over.
+
+The partitions of the current month and the next ELEC_LCA_PARTITION_MONTHS_AHEAD months are created ahead of time by
+ensure_generation_partitions, and store_generation_frame_to_db creates the partitions of the months it writes, each in
+a short transaction of its own. Partitions are created standalone and attached, which does not block reads or writes
+of the table, and rows of the month that landed in the default partition are moved into the new partition. To check
+the schema, create the index and the partitions ahead, e.g. daily from cron:
+
+    python -m lcatricity_api.data.schema_maintenance [--partition] [--verify]
+"""
+import json
+import logging
+import os
+import re
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Optional, List, Tuple
+
+import pandas as pd
+import sqlalchemy
+from dotenv import load_dotenv
+from sqlalchemy import text
+
+from lcatricity_dataschema.base import ElectricityGeneration
+
+load_dotenv()
+
+# Number of months after the current one whose partitions are created ahead of time
+PARTITION_MONTHS_AHEAD = int(os.getenv('ELEC_LCA_PARTITION_MONTHS_AHEAD', '3'))
+
+GENERATION_TABLE = ElectricityGeneration.__table__.name
+GENERATION_INDEX = f'{GENERATION_TABLE}_region_type_date_idx'
+INDEX_COLUMNS = ('RegionId', 'GenerationTypeId', 'DateStamp')
+DEFAULT_PARTITION = f'{GENERATION_TABLE}_default'
+UNPARTITIONED_TABLE = f'{GENERATION_TABLE}_unpartitioned'
+_PARTITION_NAME = re.compile(rf'^{GENERATION_TABLE}_y(\d{{4}})m(\d{{2}})$')
+# Key of the advisory lock serialising the creation of partitions between processes
+_PARTITION_LOCK_KEY = 0x4c434147
+
+# Per engine: whether the table is partitioned, and the months known to have a partition
+_partitioned_engines = {}
+_known_partition_months = {}
+_known_partitions_lock = threading.Lock()
+
+
+def partition_name(month: datetime) -> str:
+    return f'{GENERATION_TABLE}_y{month:%Y}m{month:%m}'
+
+
+def month_start(date_stamp) -> datetime:
+    """Start of the month of a DateStamp, as a naive UTC datetime"""
+    date_stamp = pd.Timestamp(date_stamp)
+    if date_stamp.tzinfo is not None:
+        date_stamp = date_stamp.tz_convert('UTC').tz_localize(None)
+    return datetime(date_stamp.year, date_stamp.month, 1)
+
+
+def next_month(month: datetime) -> datetime:
+    return month.replace(year=month.year + month.month // 12, month=month.month % 12 + 1)
+
+
+def months_between(first: datetime, last: datetime) -> List[datetime]:
+    """Start of each month from the month of first to the month of last, inclusive"""
+    month, last = month_start(first), month_start(last)
+    months = []
+    while month <= last:
+        months.append(month)
+        month = next_month(month)
+    return months
+
+
+def is_partitioned(connection: sqlalchemy.Connection) -> bool:
+    return connection.execute(text(
+        'SELECT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(:table))'),
+        {'table': f'"{GENERATION_TABLE}"'}).scalar()
+
+
+def partition_months(connection: sqlalchemy.Connection) -> List[datetime]:
+    """Months that have a partition, in order. Partitions not named ElectricityGeneration_yYYYYmMM are ignored"""
+    names = connection.execute(text(
+        'SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid '
+        'WHERE i.inhparent = to_regclass(:table)'), {'table': f'"{GENERATION_TABLE}"'}).scalars()
+    months = []
+    for name in names:
+        match = _PARTITION_NAME.match(name)
+        if match:
+            months.append(datetime(int(match.group(1)), int(match.group(2)), 1))
+    return sorted(months)
+
+
+def generation_index(connection: sqlalchemy.Connection) -> Optional[Tuple[str, bool]]:
+    """
+    Name and validity of an index of the table whose key columns are (RegionId, GenerationTypeId, DateStamp), or None.
+    An index is invalid while it is built, after a failed concurrent build, or on a partitioned table until every
+    partition has its index attached
+    """
+    indexes = connection.execute(text(
+        'SELECT c.relname, i.indisvalid, '
+        '       array(SELECT a.attname FROM unnest(i.indkey) WITH ORDINALITY AS k(attnum, n) '
+        '             JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = k.attnum '
+        '             WHERE k.n <= i.indnkeyatts ORDER BY k.n) '
+        'FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid WHERE i.indrelid = to_regclass(:table)'),
+        {'table': f'"{GENERATION_TABLE}"'}).all()
+    matching = [(name, valid) for name, valid, columns in indexes if tuple(columns) == INDEX_COLUMNS]
+    # A valid index first, then the managed one
+    matching.sort(key=lambda index: (not index[1], index[0] != GENERATION_INDEX))
+    return matching[0] if matching else None
+
+
+def ensure_generation_index(sql_engine: sqlalchemy.Engine) -> bool:
+    """
+    Create the (RegionId, GenerationTypeId, DateStamp) index if the table has no valid one, without blocking writes.
+    An invalid managed index (e.g. left by an interrupted build) is dropped and built again. Returns whether an index
+    was built
+    """
+    with sql_engine.connect() as connection:
+        index = generation_index(connection)
+        partitioned = is_partitioned(connection)
+    if index is not None and index[1]:
+        return False
+
+    s = time.time()
+    # CREATE INDEX CONCURRENTLY cannot run in a transaction
+    with sql_engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+        if index is not None and index[0] == GENERATION_INDEX and not partitioned:
+            connection.execute(text(f'DROP INDEX CONCURRENTLY IF EXISTS "{GENERATION_INDEX}"'))
+        if partitioned:
+            _create_partitioned_index(connection)
+        else:
+            connection.execute(text(_index_definition(GENERATION_INDEX, GENERATION_TABLE, concurrently=True)))
+    logging.info(f'{time.time() - s:.2f} s to build the index {GENERATION_INDEX}')
+    return True
+
+
+def _index_definition(index_name: str, table_name: str, concurrently: bool = False, only: bool = False) -> str:
+    columns = ', '.join(f'"{column}"' for column in INDEX_COLUMNS)
+    return (f'CREATE INDEX {"CONCURRENTLY " if concurrently else ""}IF NOT EXISTS "{index_name}" '
+            f'ON {"ONLY " if only else ""}"{table_name}" ({columns}) INCLUDE ("AggregatedGeneration")')
+
+
+def _create_partitioned_index(connection: sqlalchemy.Connection):
+    """
+    Build the index of a partitioned table: created invalid on the parent only, built concurrently on each partition
+    and attached to it. It becomes valid when the index of the last partition is attached
+    """
+    connection.execute(text(_index_definition(GENERATION_INDEX, GENERATION_TABLE, only=True)))
+    partitions = connection.execute(text(
+        'SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid '
+        'WHERE i.inhparent = to_regclass(:table)'), {'table': f'"{GENERATION_TABLE}"'}).scalars().all()
+    # Partitions whose index is already attached, e.g. created after the index of the parent
+    indexed_partitions = set(connection.execute(text(
+        'SELECT c.relname FROM pg_inherits i JOIN pg_index x ON x.indexrelid = i.inhrelid '
+        'JOIN pg_class c ON c.oid = x.indrelid WHERE i.inhparent = to_regclass(:index)'),
+        {'index': f'"{GENERATION_INDEX}"'}).scalars())
+    for partition in partitions:
+        if partition in indexed_partitions:
+            continue
+        partition_index = f'{partition}_region_type_date_idx'
+        connection.execute(text(f'DROP INDEX CONCURRENTLY IF EXISTS "{partition_index}"'))
+        connection.execute(text(_index_definition(partition_index, partition, concurrently=True)))
+        connection.execute(text(f'ALTER INDEX "{GENERATION_INDEX}" ATTACH PARTITION "{partition_index}"'))
+
+
+def partition_generation_table(sql_engine: sqlalchemy.Engine, months_ahead: int = PARTITION_MONTHS_AHEAD,
+                               drop_previous: bool = False) -> bool:
+    """
+    Convert ElectricityGeneration to a table partitioned by month of DateStamp, with a partition for each month from
+    the first row to months_ahead months after the current one, and the managed index. Returns False if the table is
+    already partitioned. The table cannot be written while its rows are copied
+
+    :param months_ahead: Number of months after the current one to create partitions for
+    :param drop_previous: Drop the previous table instead of keeping it as ElectricityGeneration_unpartitioned
+    """
+    s = time.time()
+    new_table = f'{GENERATION_TABLE}_partitioned'
+    with sql_engine.begin() as connection:
+        if is_partitioned(connection):
+            return False
+        # Reads go on while the rows are copied, writes wait for the swap
+        connection.execute(text(f'LOCK TABLE "{GENERATION_TABLE}" IN EXCLUSIVE MODE'))
+        connection.execute(text(
+            f'CREATE TABLE "{new_table}" (LIKE "{GENERATION_TABLE}" INCLUDING DEFAULTS INCLUDING IDENTITY '
+            f'INCLUDING GENERATED INCLUDING CONSTRAINTS INCLUDING STORAGE INCLUDING COMMENTS) '
+            f'PARTITION BY RANGE ("DateStamp")'))
+
+        # The primary key of a partitioned table must include the partition key
+        primary_key = connection.execute(text(
+            'SELECT array(SELECT a.attname FROM unnest(i.indkey) WITH ORDINALITY AS k(attnum, n) '
+            '             JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = k.attnum ORDER BY k.n) '
+            'FROM pg_index i WHERE i.indrelid = to_regclass(:table) AND i.indisprimary'),
+            {'table': f'"{GENERATION_TABLE}"'}).scalar()
+        if primary_key:
+            key_columns = list(primary_key) + (['DateStamp'] if 'DateStamp' not in primary_key else [])
+            key = ', '.join(f'"{column}"' for column in key_columns)
+            connection.execute(text(f'ALTER TABLE "{new_table}" ADD PRIMARY KEY ({key})'))
+        foreign_keys = connection.execute(text(
+            "SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint "
+            "WHERE conrelid = to_regclass(:table) AND contype = 'f'"), {'table': f'"{GENERATION_TABLE}"'}).all()
+        for constraint_name, definition in foreign_keys:
+            connection.execute(text(f'ALTER TABLE "{new_table}" ADD CONSTRAINT "{constraint_name}" {definition}'))
+        other_indexes = connection.execute(text(
+            'SELECT c.relname FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid '
+            'WHERE i.indrelid = to_regclass(:table) AND NOT i.indisprimary'),
+            {'table': f'"{GENERATION_TABLE}"'}).scalars().all()
+
+        first, last = connection.execute(text(
+            f'SELECT min("DateStamp"), max("DateStamp") FROM "{GENERATION_TABLE}"')).one()
+        now = datetime.now(timezone.utc)
+        months = months_between(first if first is not None else now, _months_after(now, months_ahead))
+        if last is not None and month_start(last) > months[-1]:
+            months = months_between(months[0], last)
+        for month in months:
+            connection.execute(text(
+                f'CREATE TABLE "{partition_name(month)}" PARTITION OF "{new_table}" '
+                f'FOR VALUES FROM ({_bound(month)}) TO ({_bound(next_month(month))})'))
+        connection.execute(text(f'CREATE TABLE "{DEFAULT_PARTITION}" PARTITION OF "{new_table}" DEFAULT'))
+        # The name of the managed index goes to the new table
+        connection.execute(text(f'ALTER INDEX IF EXISTS "{GENERATION_INDEX}" '
+                                f'RENAME TO "{UNPARTITIONED_TABLE}_region_type_date_idx"'))
+        # Built once the rows are in, which is faster than maintaining it row by row
+        copied = connection.execute(text(
+            f'INSERT INTO "{new_table}" OVERRIDING SYSTEM VALUE SELECT * FROM "{GENERATION_TABLE}"')).rowcount
+        connection.execute(text(_index_definition(GENERATION_INDEX, new_table)))
+
+        # Sequences of the serial and identity columns carry on from the copied rows
+        serial_columns = connection.execute(text(
+            "SELECT a.attname, a.attidentity != '', pg_get_serial_sequence(:table, a.attname) FROM pg_attribute a "
+            "WHERE a.attrelid = to_regclass(:table) AND a.attnum > 0 AND NOT a.attisdropped "
+            "AND pg_get_serial_sequence(:table, a.attname) IS NOT NULL"), {'table': f'"{GENERATION_TABLE}"'}).all()
+        for column, is_identity, sequence in serial_columns:
+            if is_identity:
+                connection.execute(text(
+                    f'SELECT setval(pg_get_serial_sequence(:table, :column), '
+                    f'coalesce((SELECT max("{column}") FROM "{new_table}"), 0) + 1, false)'),
+                    {'table': f'"{new_table}"', 'column': column})
+            else:
+                connection.execute(text(f'ALTER SEQUENCE {sequence} OWNED BY "{new_table}"."{column}"'))
+
+        connection.execute(text(f'ALTER TABLE "{GENERATION_TABLE}" RENAME TO "{UNPARTITIONED_TABLE}"'))
+        connection.execute(text(f'ALTER TABLE "{new_table}" RENAME TO "{GENERATION_TABLE}"'))
+        if drop_previous:
+            connection.execute(text(f'DROP TABLE "{UNPARTITIONED_TABLE}"'))
+    with sql_engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+        connection.execute(text(f'ANALYZE "{GENERATION_TABLE}"'))
+    _forget_engine(sql_engine)
+    if other_indexes:
+        logging.warning(f'Indexes of the previous table not created on the partitioned table: {other_indexes}')
+    logging.info(f'{time.time() - s:.2f} s to partition {GENERATION_TABLE} into {len(months)} monthly partitions '
+                 f'({copied} rows)')
+    return True
+
+
+def ensure_generation_partitions(sql_engine: sqlalchemy.Engine, months_ahead: int = PARTITION_MONTHS_AHEAD) -> list:
+    """
+    Create the partitions of the current month and of the months_ahead next months, and of the months that have rows
+    in the default partition, if the table is partitioned. Returns the months created
+    """
+    with sql_engine.connect() as connection:
+        if not is_partitioned(connection):
+            return []
+        months_in_default = connection.execute(text(
+            f'SELECT DISTINCT date_trunc(\'month\', "DateStamp") FROM "{DEFAULT_PARTITION}"')).scalars().all() \
+            if _has_default_partition(connection) else []
+    now = datetime.now(timezone.utc)
+    months = set(months_between(now, _months_after(now, months_ahead)))
+    months.update(month_start(month) for month in months_in_default)
+    return _create_partitions(sql_engine, sorted(months))
+
+
+def ensure_partitions_for_period(sql_engine: sqlalchemy.Engine, start, end) -> list:
+    """
+    Create the partitions of the months between start and end (DateStamps) that do not have one yet, if the table is
+    partitioned, so that rows written in this period do not go to the default partition. The partitions are looked up
+    once per engine, so this is usually free. Returns the months created
+    """
+    months = months_between(start, end)
+    with _known_partitions_lock:
+        partitioned = _partitioned_engines.get(id(sql_engine))
+        known_months = _known_partition_months.get(id(sql_engine), set())
+    if partitioned is False or (partitioned and known_months.issuperset(months)):
+        return []
+    if partitioned is None:
+        with sql_engine.connect() as connection:
+            partitioned = is_partitioned(connection)
+        with _known_partitions_lock:
+            _partitioned_engines[id(sql_engine)] = partitioned
+        if not partitioned:
+            return []
+    return _create_partitions(sql_engine, months)
+
+
+def _create_partitions(sql_engine: sqlalchemy.Engine, months: List[datetime]) -> list:
+    """
+    Create the missing partitions of the months given, each in a transaction of its own. A partition is created as a
+    standalone table, filled with the rows of its month from the default partition, then attached
+    """
+    created = []
+    with sql_engine.connect() as connection:
+        existing = set(partition_months(connection))
+        has_default_partition = _has_default_partition(connection)
+    for month in months:
+        if month in existing:
+            continue
+        name = partition_name(month)
+        lower, upper = _bound(month), _bound(next_month(month))
+        with sql_engine.begin() as connection:
+            # Another process may be creating the same partition
+            connection.execute(text('SELECT pg_advisory_xact_lock(:key)'), {'key': _PARTITION_LOCK_KEY})
+            if month in partition_months(connection):
+                existing.add(month)
+                continue
+            connection.execute(text(
+                f'CREATE TABLE "{name}" (LIKE "{GENERATION_TABLE}" INCLUDING DEFAULTS INCLUDING CONSTRAINTS '
+                f'INCLUDING STORAGE)'))
+            in_month = f'"DateStamp" >= {lower} AND "DateStamp" < {upper}'
+            moved = connection.execute(text(
+                f'WITH moved AS (DELETE FROM "{DEFAULT_PARTITION}" WHERE {in_month} RETURNING *) '
+                f'INSERT INTO "{name}" SELECT * FROM moved')).rowcount if has_default_partition else 0
+            # Lets ATTACH skip scanning the partition to check its rows are in range
+            connection.execute(text(f'ALTER TABLE "{name}" ADD CONSTRAINT "{name}_range" CHECK ({in_month})'))
+            connection.execute(text(
+                f'ALTER TABLE "{GENERATION_TABLE}" ATTACH PARTITION "{name}" FOR VALUES FROM ({lower}) TO ({upper})'))
+            connection.execute(text(f'ALTER TABLE "{name}" DROP CONSTRAINT "{name}_range"'))
+        created.append(month)
+        logging.info(f'Created the partition {name}' + (f', with {moved} rows of the default partition' if moved else ''))
+    with _known_partitions_lock:
+        _known_partition_months.setdefault(id(sql_engine), set()).update(existing, created)
+    return created
+
+
+def verify_generation_schema(sql_engine: sqlalchemy.Engine, months_ahead: int = PARTITION_MONTHS_AHEAD) -> dict:
+    """
+    State of the index and partitions of ElectricityGeneration. `ok` is True if the table has a valid index on
+    (RegionId, GenerationTypeId, DateStamp), and, when it is partitioned, partitions up to months_ahead months after
+    the current one and no rows in the default partition
+    """
+    with sql_engine.connect() as connection:
+        index = generation_index(connection)
+        partitioned = is_partitioned(connection)
+        months = partition_months(connection) if partitioned else []
+        rows_in_default = connection.execute(text(f'SELECT count(*) FROM "{DEFAULT_PARTITION}"')).scalar() \
+            if partitioned and _has_default_partition(connection) else 0
+    now = datetime.now(timezone.utc)
+    missing_ahead = [f'{month:%Y-%m}' for month in months_between(now, _months_after(now, months_ahead))
+                     if month not in months]
+    index_ok = index is not None and index[1]
+    return {'index': index[0] if index else None, 'index_valid': index_ok, 'partitioned': partitioned,
+            'partitions': len(months), 'first_partition': f'{months[0]:%Y-%m}' if months else None,
+            'last_partition': f'{months[-1]:%Y-%m}' if months else None, 'missing_partitions_ahead': missing_ahead,
+            'rows_in_default_partition': rows_in_default,
+            'ok': index_ok and (not partitioned or (not missing_ahead and not rows_in_default))}
+
+
+def _has_default_partition(connection: sqlalchemy.Connection) -> bool:
+    return connection.execute(text('SELECT to_regclass(:table) IS NOT NULL'),
+                              {'table': f'"{DEFAULT_PARTITION}"'}).scalar()
+
+
+def _bound(month: datetime) -> str:
+    """Partition bound of the start of a month, in UTC (the offset is ignored for a timestamp without time zone)"""
+    return f"'{month:%Y-%m-%d} 00:00:00+00'"
+
+
+def _months_after(date: datetime, n_months: int) -> datetime:
+    month = month_start(date)
+    for _ in range(n_months):
+        month = next_month(month)
+    return month
+
+
+def _forget_engine(sql_engine: sqlalchemy.Engine):
+    with _known_partitions_lock:
+        _partitioned_engines.pop(id(sql_engine), None)
+        _known_partition_months.pop(id(sql_engine), None)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Check and maintain the index and partitions of ElectricityGeneration')
+    parser.add_argument('--partition', action='store_true',
+                        help='Convert the table to monthly partitions first, if it is not partitioned. Blocks writes '
+                             'while the rows are copied')
+    parser.add_argument('--drop-previous', action='store_true',
+                        help='With --partition, drop the previous table instead of keeping it')
+    parser.add_argument('--verify', action='store_true', help='Only report the state of the schema')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    engine = sqlalchemy.create_engine(sqlalchemy.engine.url.URL.create(
+        drivername='postgresql',
+        host=os.getenv('ELEC_LCA_DB_HOST'),
+        database=os.getenv('ELEC_LCA_DB_NAME'),
+        username=os.getenv('ELEC_LCA_DB_LOGIN'),
+        password=os.getenv('ELEC_LCA_DB_PWD'),
+        port=os.getenv('ELEC_LCA_DB_PORT')
+    ))
+    if not args.verify:
+        if args.partition:
+            partition_generation_table(engine, drop_previous=args.drop_previous)
+        ensure_generation_index(engine)
+        ensure_generation_partitions(engine)
+    state = verify_generation_schema(engine)
+    print(json.dumps(state, indent=2))
+    sys.exit(0 if state['ok'] else 1)
@@ -0,0 +1,146 @@
+"""
+Reference data loaded once from the database for all the uvicorn workers of a host, and handed to them as Arrow IPC
+files.
+
+One worker (the writer, holding an exclusive lock on the directory) loads the reference data from the database and
+publishes it as a snapshot: one Arrow IPC file per table in a new directory, then the CURRENT file naming the snapshot,
+replaced atomically. The other workers (readers) build their cache from the current snapshot instead of querying the
+database, so a reload costs one set of queries per host rather than per worker, and every worker serves the same
+version of the data. Only the files are shared: each worker reads them into its own DataFrames and builds its own
+lookups and impact factor matrix, so the memory of the cache is not reduced per worker. When the writer exits, the lock
+is released and the next worker to refresh becomes the writer. A reader that needs the data
+reloaded from the database (e.g. POST /admin/reference_data/refresh) asks the writer with a request file, which the
+writer polls, then reads the snapshot the writer publishes.
+
+Put the directory on a tmpfs (e.g. /dev/shm) for the snapshots to stay in memory. Needs the pyarrow dependency.
+"""
+import datetime
+import fcntl
+import json
+import logging
+import os
+import shutil
+import uuid
+from typing import Optional
+
+from lcatricity_api.data.get_common_data import BasicDataCache
+
+CURRENT_FILE = 'CURRENT'
+LOCK_FILE = '.writer.lock'
+REFRESH_REQUEST_FILE = 'REFRESH_REQUESTED'
+SNAPSHOTS_DIR = 'snapshots'
+TABLE_NAMES = ('generation_types', 'generation_type_mappings', 'regions', 'impact_categories', 'environmental_impacts')
+# Snapshots kept besides the current one, for the readers still mapping the previous one
+_SNAPSHOTS_KEPT = 1
+
+_writer_lock_file = None
+
+
+def acquire_writer_lock(directory: str) -> bool:
+    """
+    Whether this process is the writer of the shared reference data in directory, taking the lock if it is free. The
+    lock is held until the process exits
+    """
+    global _writer_lock_file
+    if _writer_lock_file is not None:
+        return True
+    os.makedirs(directory, exist_ok=True)
+    lock_file = open(os.path.join(directory, LOCK_FILE), 'a')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock_file.close()
+        return False
+    _writer_lock_file = lock_file
+    return True
+
+
+def holds_writer_lock() -> bool:
+    """Whether this process is the writer, without trying to take the lock"""
+    return _writer_lock_file is not None
+
+
+def current_snapshot_id(directory: str) -> Optional[str]:
+    """Id of the snapshot currently published in directory, or None if nothing has been published yet"""
+    try:
+        with open(os.path.join(directory, CURRENT_FILE)) as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def request_refresh(directory: str):
+    """Ask the writer to reload the reference data from the database and publish it (see take_refresh_request)"""
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, REFRESH_REQUEST_FILE), 'w') as f:
+        f.write(str(os.getpid()))
+
+
+def take_refresh_request(directory: str) -> bool:
+    """Whether a reader asked for a reload since the last call, clearing the request. For the writer"""
+    try:
+        os.remove(os.path.join(directory, REFRESH_REQUEST_FILE))
+    except FileNotFoundError:
+        return False
+    return True
+
+
+def publish_snapshot(cache: BasicDataCache, directory: str) -> str:
+    """
+    Write the tables of cache as a new snapshot and make it the current one. Readers see either the previous snapshot
+    or the complete new one. Returns the id of the snapshot
+    """
+    import pyarrow as pa
+
+    snapshot_id = f'{cache.retrieved_timestamp:%Y%m%dT%H%M%S%f}-{uuid.uuid4().hex[:8]}'
+    snapshot_path = os.path.join(directory, SNAPSHOTS_DIR, snapshot_id)
+    os.makedirs(snapshot_path)
+    for name in TABLE_NAMES:
+        table = pa.Table.from_pandas(getattr(cache, name), preserve_index=False)
+        with pa.OSFile(os.path.join(snapshot_path, f'{name}.arrow'), 'wb') as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+    with open(os.path.join(snapshot_path, 'meta.json'), 'w') as f:
+        json.dump({'retrieved_timestamp': cache.retrieved_timestamp.isoformat()}, f)
+
+    current_tmp = os.path.join(directory, f'{CURRENT_FILE}.{os.getpid()}.tmp')
+    with open(current_tmp, 'w') as f:
+        f.write(snapshot_id)
+    os.replace(current_tmp, os.path.join(directory, CURRENT_FILE))
+    cache.snapshot_id = snapshot_id
+    _remove_old_snapshots(directory, snapshot_id)
+    return snapshot_id
+
+
+def read_snapshot(directory: str) -> Optional[BasicDataCache]:
+    """
+    The reference data of the current snapshot in directory, or None if nothing has been published yet. The tables are
+    copied into new DataFrames, so the files can be removed once this returns
+    """
+    import pyarrow as pa
+
+    snapshot_id = current_snapshot_id(directory)
+    if snapshot_id is None:
+        return None
+    snapshot_path = os.path.join(directory, SNAPSHOTS_DIR, snapshot_id)
+    tables = {}
+    for name in TABLE_NAMES:
+        with pa.memory_map(os.path.join(snapshot_path, f'{name}.arrow')) as source:
+            tables[name] = pa.ipc.open_file(source).read_all().to_pandas()
+    with open(os.path.join(snapshot_path, 'meta.json')) as f:
+        retrieved_timestamp = datetime.datetime.fromisoformat(json.load(f)['retrieved_timestamp'])
+    cache = BasicDataCache(retrieved_timestamp=retrieved_timestamp, **tables)
+    cache.snapshot_id = snapshot_id
+    return cache
+
+
+def _remove_old_snapshots(directory: str, current_id: str):
+    snapshots_path = os.path.join(directory, SNAPSHOTS_DIR)
+    # Snapshot ids start with their timestamp, so they sort by age
+    old_ids = sorted(snapshot_id for snapshot_id in os.listdir(snapshots_path) if snapshot_id != current_id)
+    for snapshot_id in old_ids[:max(0, len(old_ids) - _SNAPSHOTS_KEPT)]:
+        try:
+            # Readers that still map the files keep them until they unmap them
+            shutil.rmtree(os.path.join(snapshots_path, snapshot_id))
+        except OSError as e:
+            logging.warning(f'Could not remove the reference data snapshot {snapshot_id}: {e}')
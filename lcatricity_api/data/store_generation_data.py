@@ -1,11 +1,22 @@
+import io
 import logging
 import time
+from typing import Iterable, Tuple
 
 import pandas as pd
 import sqlalchemy
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import text
 
-from lcatricity_dataschema.base import sql_alchemy_base
+from lcatricity_api.data.notifications import notify_generation_written
+from lcatricity_api.data.rollups import create_rollup_tables, refresh_generation_rollups
+from lcatricity_api.data.schema_maintenance import ensure_partitions_for_period
+
+GENERATION_COLUMNS = ['RegionId', 'DateStamp', 'GenerationTypeId', 'AggregatedGeneration']
+# Optional column of store_generation_frame_to_db telling the series apart, whose intervals are replaced separately
+SERIES_COLUMN = 'Series'
+_STAGING_TABLE = 'ElectricityGenerationStaging'
+# Number of rows encoded as CSV and sent to COPY at a time
+COPY_CHUNK_ROWS = 100000
 
 
 def store_generation_data_to_db(
@@ -16,6 +27,9 @@ def store_generation_data_to_db(
     """
     Store electricity time series power generation data to elec_lca database. Uses an upsert approach, removing any
         existing generation data for the same interval and region id (as it is likely outdated or null, as new data is generated continuously).
+        The hourly, daily and monthly rollups overlapping the interval are then refreshed, and API workers are notified
+        so that they invalidate their cached results for the interval. Everything is done in a single transaction, so
+        readers see either the previous or the new data for the interval.
 
     @param generation_mw: Pandas Series with the generation data (MW per time interval) to insert. The index should be the timestamps of the beginning of each interval
     @param generation_type_id: Internal generation type id (int)
@@ -23,40 +37,111 @@ def store_generation_data_to_db(
     @param sql_engine: SQL engine to the elec_lca database
     @return:
     """
+    return store_generation_series_to_db([(generation_mw, generation_type_id, region_id)], sql_engine)
+
+
+def store_generation_series_to_db(series: Iterable[Tuple[pd.Series, int, int]], sql_engine: sqlalchemy.Engine) -> bool:
+    """
+    Store several electricity generation time series at once. See store_generation_data_to_db
+
+    @param series: (generation_mw, generation_type_id, region_id) of each series to store
+    @param sql_engine: SQL engine to the elec_lca database
+    @return:
+    """
+    values_to_insert = []
+    for series_index, (generation_mw, generation_type_id, region_id) in enumerate(series):
+        # Validate the Series provided:
+        try:
+            assert isinstance(generation_mw.index[0], pd.Timestamp)
+            assert isinstance(generation_mw.values[0,0], float)
+        except AssertionError as e:
+            raise e
+        values_to_insert.append(pd.DataFrame({'RegionId': int(region_id),
+                                              'DateStamp': generation_mw.index,
+                                              'GenerationTypeId': int(generation_type_id),
+                                              'AggregatedGeneration': generation_mw['Actual Aggregated'].values,
+                                              SERIES_COLUMN: series_index}))
+    if not values_to_insert:
+        return True
+    return store_generation_frame_to_db(pd.concat(values_to_insert, ignore_index=True), sql_engine)
+
+
+def store_generation_frame_to_db(values_to_insert: pd.DataFrame, sql_engine: sqlalchemy.Engine) -> bool:
+    """
+    Bulk upsert generation data points, in a single transaction:
+
+    1. The rows are streamed with COPY into a temporary staging table
+    2. For each series and (region, generation type) in the staging table, the existing rows between its first and
+       last DateStamp are deleted, and the staged rows are inserted. Where series overlap, the DateStamps of the last
+       series are kept
+    3. The rollups of each region are refreshed over the interval written, and a notification is sent to the API
+
+    @param values_to_insert: DataFrame with columns RegionId, DateStamp, GenerationTypeId, AggregatedGeneration, and
+        optionally Series, an integer telling apart the series of a same region and generation type (e.g. two
+        non-contiguous periods), so that the rows between them are not deleted. Without it, the rows of a region and
+        generation type are one series
+    @param sql_engine: SQL engine to the elec_lca database
+    @return:
+    """
     s_1 = time.time()
+    missing_columns = set(GENERATION_COLUMNS) - set(values_to_insert.columns)
+    if missing_columns:
+        raise ValueError(f'Generation data to store is missing the columns {sorted(missing_columns)}')
+    if SERIES_COLUMN in values_to_insert.columns:
+        values_to_insert = values_to_insert[GENERATION_COLUMNS + [SERIES_COLUMN]]
+    else:
+        values_to_insert = values_to_insert[GENERATION_COLUMNS].assign(**{SERIES_COLUMN: 0})
+
+    create_rollup_tables(sql_engine)
+    if values_to_insert.shape[0]:
+        # In transactions of their own, so that the locks taken to attach a partition are not held until the upsert ends
+        ensure_partitions_for_period(sql_engine, values_to_insert['DateStamp'].min(),
+                                     values_to_insert['DateStamp'].max())
+    with sql_engine.begin() as connection:
+        # timestamptz so that timezone-aware DateStamps are converted to the column type as when inserted directly
+        connection.execute(text(
+            f'CREATE TEMPORARY TABLE "{_STAGING_TABLE}" ("RegionId" integer, "DateStamp" timestamptz, '
+            f'"GenerationTypeId" integer, "AggregatedGeneration" double precision, "{SERIES_COLUMN}" integer) '
+            f'ON COMMIT DROP'))
+        _copy_to_staging(connection, values_to_insert)
+
+        deletion_result = connection.execute(text(
+            f'DELETE FROM "ElectricityGeneration" AS target '
+            f'USING (SELECT "RegionId", "GenerationTypeId", min("DateStamp") AS "Start", max("DateStamp") AS "End" '
+            f'       FROM "{_STAGING_TABLE}" GROUP BY "{SERIES_COLUMN}", "RegionId", "GenerationTypeId") AS written '
+            f'WHERE target."RegionId" = written."RegionId" AND target."GenerationTypeId" = written."GenerationTypeId" '
+            f'AND target."DateStamp" >= written."Start" AND target."DateStamp" <= written."End"'))
+        # A single row per DateStamp of a region and generation type, that of the last series where they overlap
+        insertion_result = connection.execute(text(
+            f'INSERT INTO "ElectricityGeneration" ("RegionId", "DateStamp", "GenerationTypeId", "AggregatedGeneration") '
+            f'SELECT DISTINCT ON ("RegionId", "GenerationTypeId", "DateStamp") '
+            f'       "RegionId", "DateStamp", "GenerationTypeId", "AggregatedGeneration" FROM "{_STAGING_TABLE}" '
+            f'ORDER BY "RegionId", "GenerationTypeId", "DateStamp", "{SERIES_COLUMN}" DESC'))
+        if insertion_result.rowcount < values_to_insert.shape[0]:
+            logging.warning(f'{values_to_insert.shape[0] - insertion_result.rowcount} rows with the DateStamp of '
+                            f'another row of the same region and generation type were not stored')
+        logging.info(f'{deletion_result.rowcount} existing rows replaced by {insertion_result.rowcount} rows')
 
-    # Validate the Series provided:
-    try:
-        assert isinstance(generation_mw.index[0], pd.Timestamp)
-        assert isinstance(generation_mw.values[0,0], float)
-    except AssertionError as e:
-        raise e
-    start = generation_mw.index.min()
-    end = generation_mw.index.max()
-
-    # Create dataframe of values to insert
-    values_to_insert = pd.DataFrame({'RegionId': region_id,
-                                     'DateStamp': generation_mw.index.to_list(),
-                                     'GenerationTypeId': generation_type_id,
-                                     'AggregatedGeneration': generation_mw['Actual Aggregated'].values}
-                                    )
-    logging.info(values_to_insert)
-    session_obj = sessionmaker(bind=sql_engine)
-    with session_obj() as session:
-        elec_gen_table = sqlalchemy.Table('ElectricityGeneration', sql_alchemy_base.metadata, autoload=True)
-        delete_query = elec_gen_table.delete().where(
-            (elec_gen_table.c.DateStamp >= start) &
-            (elec_gen_table.c.DateStamp <= end) &
-            (elec_gen_table.c.RegionId == int(region_id)) &
-            (elec_gen_table.c.GenerationTypeId == int(generation_type_id))
-        )
-        deletion_result = session.execute(delete_query)
-        session.commit()
-        logging.info(f'{deletion_result.rowcount} rows deleted, that already existed for region={region_id}, date range=`{start}`-`{end}` and generation type={generation_type_id}')
-
-    time.sleep(1)
-    count_rows = values_to_insert.to_sql('ElectricityGeneration', sql_engine, if_exists='append', index=False)
-    logging.info(f'Inserted {count_rows} values for region with id = `{region_id}` to database')
+        regions_written = connection.execute(text(
+            f'SELECT "RegionId", array_agg(DISTINCT "GenerationTypeId"), min("DateStamp"), max("DateStamp") '
+            f'FROM "{_STAGING_TABLE}" GROUP BY "RegionId" ORDER BY "RegionId"')).all()
+        for region_id, generation_type_ids, start, end in regions_written:
+            # Refresh the rollups of all generation types at once when several were written for the region
+            generation_type_id = generation_type_ids[0] if len(generation_type_ids) == 1 else None
+            refresh_generation_rollups(connection, start, end, region_id=region_id,
+                                       generation_type_id=generation_type_id)
+            notify_generation_written(connection, region_id, generation_type_id, start, end)
     e = time.time()
-    logging.info(f'{e - s_1:.2f} s to write to database')
+    logging.info(f'{e - s_1:.2f} s to write {values_to_insert.shape[0]} rows to database')
     return True
+
+
+def _copy_to_staging(connection: sqlalchemy.Connection, values_to_insert: pd.DataFrame):
+    """COPY the rows to the staging table, COPY_CHUNK_ROWS at a time so that the CSV buffer stays small"""
+    with connection.connection.cursor() as cursor:
+        for chunk_start in range(0, values_to_insert.shape[0], COPY_CHUNK_ROWS):
+            buffer = io.StringIO()
+            values_to_insert.iloc[chunk_start:chunk_start + COPY_CHUNK_ROWS].to_csv(buffer, index=False, header=False)
+            buffer.seek(0)
+            cursor.copy_expert(f'COPY "{_STAGING_TABLE}" ("RegionId", "DateStamp", "GenerationTypeId", '
+                               f'"AggregatedGeneration", "{SERIES_COLUMN}") FROM STDIN WITH (FORMAT csv)', buffer)
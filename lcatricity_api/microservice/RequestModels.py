@@ -0,0 +1,11 @@
+from typing import Optional, List
+
+from pydantic import BaseModel, Field
+
+
+class BatchCalculationRequest(BaseModel):
+    region_codes: List[str] = Field(min_length=1, examples=[["FR", "NL", "DE_LU"]])
+    impact_category_ids: Optional[List[int]] = Field(default=None, examples=[[1, 2]])
+    date_start: str = Field(examples=["2024-02-01"])
+    date_end: Optional[str] = Field(default=None, examples=["2024-02-02"])
+    resolution: Optional[str] = Field(default=None, examples=["hour"])
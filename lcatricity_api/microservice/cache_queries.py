@@ -1,13 +1,249 @@
+import logging
+import os
+import threading
+import time
+from typing import Callable, List, Optional
+
 import pandas as pd
+from dotenv import load_dotenv
+
+from lcatricity_api.data.get_common_data import load_common_data_from_db, ImpactFactorMatrix, EncodedTable, \
+    BasicDataCache
+from lcatricity_api.data.shared_reference_data import acquire_writer_lock, publish_snapshot, read_snapshot, \
+    current_snapshot_id, holds_writer_lock, request_refresh, take_refresh_request
+from lcatricity_api.microservice.constants import NotReadyError, ServerError
 
-from lcatricity_api.data.get_common_data import load_common_data_from_db
+load_dotenv()
 
+# Seconds between two background reloads of the cache. 0 disables the background reloads
+CACHE_REFRESH_INTERVAL = float(os.getenv('ELEC_LCA_CACHE_REFRESH_INTERVAL', '3600'))
+# Directory of the reference data shared by the workers of this host (see lcatricity_api.data.shared_reference_data).
+# Empty to have every worker load its own copy from the database
+SHARED_CACHE_DIR = os.getenv('ELEC_LCA_SHARED_CACHE_DIR', '')
+# Seconds between two checks by the reader workers for a new shared snapshot
+SHARED_CACHE_POLL_INTERVAL = float(os.getenv('ELEC_LCA_SHARED_CACHE_POLL_INTERVAL', '5'))
 
 cache = None
+# Duration in seconds and error of the last (re)load of the cache
+last_refresh_duration = None
+last_refresh_error = None
+
+_refresh_lock = threading.Lock()
+_refresh_requested = threading.Event()
+_refresher_thread = None
+_refresh_interval = None
+_refresh_handlers: List[Callable[[Optional[BasicDataCache], BasicDataCache], None]] = []
+
 
 def init_cache(engine):
-    global cache
-    cache = load_common_data_from_db(sql_engine=engine)
+    refresh_cache(engine)
+
+
+def refresh_cache(engine) -> BasicDataCache:
+    """
+    Reload the cache from the database, or from the shared snapshot if SHARED_CACHE_DIR is set and another worker is
+    the writer (see _load_reference_data). The new BasicDataCache is fully built before it replaces the previous one in a
+    single assignment, so readers keep using the previous cache until then and never see a partly loaded one. The
+    handlers registered with add_cache_refresh_handler are then called with the previous and the new cache
+
+    :param engine: SQLAlchemy Engine to use
+    :return: The new cache
+    """
+    global cache, last_refresh_duration, last_refresh_error
+    with _refresh_lock:
+        s = time.perf_counter()
+        try:
+            new_cache = _load_reference_data(engine)
+        except Exception as e:
+            last_refresh_error = str(e)
+            raise
+        previous_cache, cache = cache, new_cache
+        last_refresh_duration = time.perf_counter() - s
+        last_refresh_error = None
+    logging.info(f'Cache loaded in {last_refresh_duration:.2f} s')
+    for handler in _refresh_handlers:
+        try:
+            handler(previous_cache, new_cache)
+        except Exception as e:
+            logging.error(f'Cache refresh handler {handler} failed: {e}')
+    return new_cache
+
+
+def _load_reference_data(engine) -> BasicDataCache:
+    """
+    Without SHARED_CACHE_DIR, load the reference data from the database. Otherwise the writer worker loads it from the
+    database and publishes it for the other workers, which read the current snapshot, or the database if nothing has
+    been published yet
+    """
+    if not SHARED_CACHE_DIR:
+        return load_common_data_from_db(sql_engine=engine)
+    if acquire_writer_lock(SHARED_CACHE_DIR):
+        new_cache = load_common_data_from_db(sql_engine=engine)
+        try:
+            publish_snapshot(new_cache, SHARED_CACHE_DIR)
+        except Exception as e:
+            logging.error(f'Could not publish the reference data to {SHARED_CACHE_DIR}: {e}')
+        return new_cache
+    try:
+        new_cache = read_snapshot(SHARED_CACHE_DIR)
+    except Exception as e:
+        logging.error(f'Could not read the reference data from {SHARED_CACHE_DIR}, loading it from the database: {e}')
+        new_cache = None
+    return new_cache if new_cache is not None else load_common_data_from_db(sql_engine=engine)
+
+
+def request_refresh_from_writer() -> bool:
+    """
+    With SHARED_CACHE_DIR, ask the writer worker to reload the reference data from the database, unless this worker is
+    (or can become) the writer. Does not wait: the background refresher reads the snapshot the writer then publishes.
+    Whether the writer was asked, False if this worker should reload the cache itself with refresh_cache
+    """
+    if not SHARED_CACHE_DIR or acquire_writer_lock(SHARED_CACHE_DIR):
+        return False
+    request_refresh(SHARED_CACHE_DIR)
+    return True
+
+
+def add_cache_refresh_handler(handler: Callable[[Optional[BasicDataCache], BasicDataCache], None]):
+    """Register a function called with the previous cache (None on the first load) and the new cache after a reload"""
+    _refresh_handlers.append(handler)
+
+
+def start_cache_refresher(engine, interval: float = CACHE_REFRESH_INTERVAL):
+    """
+    Start a daemon thread reloading the cache every interval seconds, or sooner when request_cache_refresh is called.
+    Only one refresher is started per process. If interval is 0, only requested refreshes are done
+    """
+    global _refresher_thread, _refresh_interval
+    if _refresher_thread is not None:
+        return
+    _refresh_interval = interval
+    _refresher_thread = threading.Thread(target=_refresh_periodically, args=(engine, interval),
+                                         name='lcatricity-cache-refresher', daemon=True)
+    _refresher_thread.start()
+
+
+def request_cache_refresh():
+    """Ask the background refresher to reload the cache now, without waiting for it"""
+    _refresh_requested.set()
+
+
+def cache_status() -> dict:
+    """When the cache was loaded, how long it took, and the error of the last reload if it failed"""
+    current_cache = cache
+    return {'loaded': current_cache is not None,
+            'retrieved_timestamp': current_cache.retrieved_timestamp.isoformat() if current_cache is not None else None,
+            'content_hash': current_cache.content_hash if current_cache is not None else None,
+            'shared_snapshot_id': current_cache.snapshot_id if current_cache is not None else None,
+            'last_refresh_duration_s': last_refresh_duration,
+            'last_refresh_error': last_refresh_error,
+            'refresh_interval_s': _refresh_interval,
+            'shared_cache_role': (('writer' if holds_writer_lock() else 'reader') if SHARED_CACHE_DIR else None)}
+
+
+def _refresh_periodically(engine, interval: float):
+    last_refresh = time.monotonic()
+    while True:
+        if SHARED_CACHE_DIR:
+            # Readers check for a new snapshot often, as reading it is cheap, and may become the writer
+            _refresh_requested.wait(SHARED_CACHE_POLL_INTERVAL)
+            due = interval > 0 and time.monotonic() - last_refresh >= interval
+            current_cache = cache
+            new_snapshot = current_cache is None or (
+                not holds_writer_lock() and current_snapshot_id(SHARED_CACHE_DIR) != current_cache.snapshot_id)
+            # A reader asked the writer to reload from the database
+            requested_by_reader = holds_writer_lock() and take_refresh_request(SHARED_CACHE_DIR)
+            if not (_refresh_requested.is_set() or due or new_snapshot or requested_by_reader):
+                continue
+        else:
+            _refresh_requested.wait(interval if interval > 0 else None)
+        _refresh_requested.clear()
+        last_refresh = time.monotonic()
+        try:
+            refresh_cache(engine)
+        except Exception as e:
+            # The previous cache stays in use
+            logging.error(f'Could not reload the cache: {e}')
+
+
+def get_region_id(region_code: str) -> int:
+    """
+    Look up the internal region id of a region code (e.g. `FR`) in the cache, without a round trip to the database
+
+    :param region_code: Region code, like `FR`
+    :return: Internal region id
+    """
+    if cache is None:
+        raise NotReadyError('Cache is not loaded')
+    if region_code in cache.duplicated_region_codes:
+        raise ServerError(
+            f'More than one region found for region code `{region_code}`. There is probably an error in the database')
+    try:
+        return cache.region_id_by_code[region_code]
+    except KeyError:
+        raise ValueError(f'Region Code `{region_code}` could not be found in database')
+
+
+def get_region_code(region_id: int) -> str:
+    """
+    Look up the region code (e.g. `FR`) of an internal region id in the cache
+
+    :param region_id: Internal region id
+    :return: Region code
+    """
+    if cache is None:
+        raise NotReadyError('Cache is not loaded')
+    try:
+        return cache.region_code_by_id[int(region_id)]
+    except KeyError:
+        raise ValueError(f'Region id `{region_id}` could not be found in database')
+
+
+def get_generation_type(generation_type_id: int) -> dict:
+    """
+    Look up the metadata (the ElectricityGenerationTypes row as a dict) of a generation type id in the cache
+
+    :param generation_type_id: Internal generation type id
+    :return: dict
+    """
+    if cache is None:
+        raise NotReadyError('Cache is not loaded')
+    try:
+        return cache.generation_type_by_id[int(generation_type_id)]
+    except KeyError:
+        raise ValueError(f'Generation type id `{generation_type_id}` could not be found in database')
+
+def get_generation_type_ids() -> list:
+    """List the ids of all generation types in the cache"""
+    if cache is None:
+        raise NotReadyError('Cache is not loaded')
+    return list(cache.generation_type_by_id)
+
+
+def get_impact_factors() -> ImpactFactorMatrix:
+    """
+    Get the environmental impact factors as a dense (generation type x impact category) matrix. The matrix is rebuilt
+    whenever the cache is loaded
+
+    :return: ImpactFactorMatrix
+    """
+    if cache is None:
+        raise NotReadyError('Cache is not loaded')
+    return cache.impact_factors
+
+
+def get_encoded_table(table_name: str) -> EncodedTable:
+    """
+    Get a reference data table (`regions`, `generation_types`, `generation_type_mappings` or `impact_categories`)
+    encoded as JSON records, with its ETag
+
+    :param table_name: Name of the table in the cache
+    :return: EncodedTable
+    """
+    if cache is None:
+        raise NotReadyError('Cache is not loaded')
+    return cache.encoded_tables[table_name]
+
 
 async def list_regions_in_cache() -> pd.DataFrame:
     """
@@ -18,7 +254,7 @@ async def list_regions_in_cache() -> pd.DataFrame:
     DF
     """
     if cache is None:
-        raise ValueError('Cache is not loaded')
+        raise NotReadyError('Cache is not loaded')
     return cache.regions
 
 
@@ -30,7 +266,7 @@ async def list_generation_types_in_cache() -> pd.DataFrame:
     JSON
     """
     if cache is None:
-        raise ValueError('Cache is not loaded')
+        raise NotReadyError('Cache is not loaded')
     return cache.generation_types
 
 
@@ -43,7 +279,7 @@ async def list_generation_type_mappings_in_cache() -> pd.DataFrame:
     JSON
     """
     if cache is None:
-        raise ValueError('Cache is not loaded')
+        raise NotReadyError('Cache is not loaded')
     return cache.generation_type_mappings
 
 
@@ -55,5 +291,5 @@ async def list_impact_categories_df_in_cache() -> pd.DataFrame:
     JSON
     """
     if cache is None:
-        raise ValueError('Cache is not loaded')
+        raise NotReadyError('Cache is not loaded')
     return cache.impact_categories
@@ -1,18 +1,45 @@
 import logging
+from dataclasses import dataclass
 from datetime import datetime
-from typing import Optional
+from typing import Optional, List, Iterator
 
+import numpy as np
 import pandas as pd
-from sqlalchemy.orm import sessionmaker
 
-from lcatricity_api.microservice.constants import conversion_factors, NoDataAvailableError
-from lcatricity_api.microservice.generation import get_electricity_generation_df
-from lcatricity_dataschema.base import EnvironmentalImpacts
+from lcatricity_api.data.get_common_data import ImpactFactorMatrix
+from lcatricity_api.microservice.cache_queries import get_impact_factors
+from lcatricity_api.microservice.compact_result import CompactResult, small_ints, dictionary_encode
+from lcatricity_api.microservice.constants import NoDataAvailableError
+from lcatricity_api.microservice.metrics import timed_stage
+from lcatricity_api.microservice.generation import get_electricity_generation_df, stream_electricity_generation_frames, \
+    get_batch_electricity_generation_df
 
+# Maximum number of regions in one call to calculate_batch_impacts_df
+MAX_BATCH_REGIONS = 100
 
-async def calculate_impact_df(date_start: str, date_end: str, region_code: str, impact_category_id: int, engine):
+
+async def calculate_impact_df(date_start: str, date_end: str, region_code: str, impact_category_id: int, engine,
+                              resolution: Optional[str] = None):
     logging.debug(
         f'Getting electricity generation data for date {date_start}, region code {region_code}, impact category id {impact_category_id}')
+    return await _calculate_impacts_for_period(date_start, date_end, region_code, engine,
+                                               impact_category_ids=[impact_category_id], resolution=resolution)
+
+
+async def calculate_all_impacts_df(date_start: str, date_end: str, region_code: str, engine,
+                                   resolution: Optional[str] = None) -> CompactResult:
+    """
+    Calculate every impact category at once for the electricity generation of a region in a period. Returns the same
+    columns as calculate_impact_df, with one row per generation data point and impact category
+    """
+    logging.debug(f'Getting electricity generation data for date {date_start}, region code {region_code}, all impact categories')
+    return await _calculate_impacts_for_period(date_start, date_end, region_code, engine, impact_category_ids=None,
+                                               resolution=resolution)
+
+
+async def _calculate_impacts_for_period(date_start: str, date_end: str, region_code: str, engine,
+                                        impact_category_ids: Optional[List[int]],
+                                        resolution: Optional[str] = None) -> CompactResult:
     try:
         datetime_start = datetime.strptime(date_start, '%Y-%m-%d')
         datetime_end = datetime.strptime(date_end, '%Y-%m-%d')
@@ -20,50 +47,166 @@ async def calculate_impact_df(date_start: str, date_end: str, region_code: str,
         raise ValueError(
             f'Could not handle start or end date in the period `{date_start}`-`{date_end}`. Check your input is in the form yyyy-mm-dd')
 
-    generation_df = await get_electricity_generation_df(date_start, region_code, engine=engine, generation_type_id=None,
-                                                        date_end=date_end)
-    if generation_df.empty:
+    generation = await get_electricity_generation_df(date_start, region_code, engine=engine, generation_type_id=None,
+                                                     date_end=date_end, resolution=resolution)
+    if generation.empty:
         raise NoDataAvailableError(
             f"No data available for region '{region_code}' in the period '{datetime_start}' - '{datetime_end}'")
     logging.debug('Retrieved generation data')
-    environmental_impacts_df = await get_calculation_data(engine=engine, impact_category_id=impact_category_id)
-
-    # Annotate generation data with units # TODO: Move to DB
-    if 'GenerationUnit' not in generation_df.columns.to_list():
-        generation_df['GenerationUnit'] = 'MJ'
-
-    # Remove unnecessary columns for calculation
-    environmental_impacts_df.drop(['ReferenceYear'], axis=1, inplace=True)
-    environmental_impacts_df.drop(['Id'], axis=1, inplace=True)
-
-    # Join dataframes
-    calculation_df = generation_df.merge(environmental_impacts_df,
-                                         left_on='GenerationTypeId',
-                                         right_on='ElectricityGenerationTypeId')
-
-    calculation_df.drop(["GenerationTypeId"], axis=1, inplace=True)
-    # Convert units
-    calculation_df['ConversionFactor'] = calculation_df[['GenerationUnit', 'PerUnit']].apply(
-        lambda x: conversion_factors[(x['GenerationUnit'], x['PerUnit'])], axis=1)
-    calculation_df['AggregatedGenerationConverted'] = calculation_df['AggregatedGeneration'] * calculation_df[
-        'ConversionFactor']
-    calculation_df['EnvironmentalImpact'] = calculation_df['AggregatedGenerationConverted'] * calculation_df[
-        'ImpactValue']
-
-    # TODO: Move to database
-    return calculation_df
-
-
-async def get_calculation_data(engine, impact_category_id: Optional[int] = None) -> pd.DataFrame:
-    session_obj = sessionmaker(bind=engine)
-    with session_obj() as session:
-        if impact_category_id is None:
-            impacts_query = session.query(EnvironmentalImpacts)
-        else:
-            impacts_query = session.query(EnvironmentalImpacts).where(
-                EnvironmentalImpacts.ImpactCategoryId == impact_category_id)
-        impacts_df = pd.read_sql(impacts_query.statement, session.bind)
-        # if isinstance(EnvironmentalImpactsSchema.validate(impacts_df), (SchemaError, SchemaErrors)):
-        #     logging.error('Schema error in environmental impacts data returned from database')
-        #     raise ServerError('Schema error in environmental impacts data returned from database')
-    return impacts_df
+    with timed_stage('impact_calculation'):
+        return calculate_compact_impacts(generation, get_impact_factors(), impact_category_ids=impact_category_ids)
+
+
+async def calculate_batch_impacts_df(date_start: str, date_end: str, region_codes: List[str], engine,
+                                     impact_category_ids: Optional[List[int]] = None,
+                                     resolution: Optional[str] = None) -> CompactResult:
+    """
+    Calculate impact categories for the electricity generation of several regions in a period, reading the generation
+    data of all the regions with one query and calculating all the impacts in one pass. Returns the same columns as
+    calculate_impact_df, ordered by region
+
+    :param region_codes: Codes of the regions, e.g. [`FR`, `NL`]
+    :param impact_category_ids: Impact categories to calculate. If None, all impact categories
+    """
+    try:
+        datetime_start = datetime.strptime(date_start, '%Y-%m-%d')
+        datetime_end = datetime.strptime(date_end, '%Y-%m-%d')
+    except (ValueError, TypeError):
+        raise ValueError(
+            f'Could not handle start or end date in the period `{date_start}`-`{date_end}`. Check your input is in the form yyyy-mm-dd')
+    if len(region_codes) > MAX_BATCH_REGIONS:
+        raise ValueError(f'At most {MAX_BATCH_REGIONS} regions can be calculated in one batch')
+
+    generation = await get_batch_electricity_generation_df(date_start, region_codes, engine=engine,
+                                                           date_end=date_end, resolution=resolution)
+    if generation.empty:
+        raise NoDataAvailableError(
+            f"No data available for regions {region_codes} in the period '{datetime_start}' - '{datetime_end}'")
+    with timed_stage('impact_calculation'):
+        return calculate_compact_impacts(generation, get_impact_factors(), impact_category_ids=impact_category_ids)
+
+
+def stream_impact_frames(date_start: str, date_end: str, region_code: str, engine,
+                         impact_category_ids: Optional[List[int]] = None,
+                         resolution: Optional[str] = None) -> Iterator[pd.DataFrame]:
+    """
+    Calculate impacts chunk by chunk while the generation data is read from a server-side cursor. See
+    stream_electricity_generation_frames. If impact_category_ids is None, all impact categories are calculated
+    """
+    impact_factors = get_impact_factors()
+    return stream_electricity_generation_frames(
+        date_start, region_code, engine, generation_type_id=None, date_end=date_end, resolution=resolution,
+        transform=lambda generation_df: calculate_impacts(generation_df, impact_factors, impact_category_ids))
+
+
+def calculate_impacts(generation_df: pd.DataFrame, impact_factors: ImpactFactorMatrix,
+                      impact_category_ids: Optional[List[int]] = None) -> pd.DataFrame:
+    """
+    Calculate the environmental impacts of a generation time series for several impact categories in one pass, by
+    broadcasting the generation values against the impact factor matrix.
+
+    Generation rows whose generation type has no factor for an impact category are left out for that category, as in
+    an inner join of the generation and EnvironmentalImpacts tables.
+
+    :param generation_df: Generation data with columns RegionCode, DateStamp, GenerationTypeId, AggregatedGeneration
+    :param impact_factors: ImpactFactorMatrix from the cache
+    :param impact_category_ids: Impact categories to calculate. If None, all impact categories in the matrix
+    :return: pd.DataFrame with one row per (generation row, impact category), with the columns of ImpactResultSchema
+    """
+    impacts = _broadcast_impacts(generation_df['GenerationTypeId'].to_numpy(),
+                                 generation_df['AggregatedGeneration'].to_numpy(dtype=float), impact_factors,
+                                 impact_category_ids)
+    generation_index = impacts.generation_index
+    matrix_rows, matrix_columns = impacts.matrix_rows, impacts.matrix_columns
+    return pd.DataFrame({
+        'RegionCode': generation_df['RegionCode'].to_numpy()[generation_index],
+        'DateStamp': generation_df['DateStamp'].to_numpy()[generation_index],
+        'AggregatedGeneration': impacts.aggregated_generation,
+        'GenerationUnit': impact_factors.generation_unit,
+        'ElectricityGenerationTypeId': impact_factors.generation_type_ids[matrix_rows],
+        'ImpactCategoryId': impact_factors.impact_category_ids[matrix_columns],
+        'ImpactValue': impacts.impact_value,
+        'ImpactCategoryUnit': impact_factors.impact_category_units[matrix_rows, matrix_columns],
+        'PerUnit': impact_factors.per_units[matrix_rows, matrix_columns],
+        'ConversionFactor': impacts.conversion_factor,
+        'AggregatedGenerationConverted': impacts.aggregated_generation_converted,
+        'EnvironmentalImpact': impacts.aggregated_generation_converted * impacts.impact_value,
+    })
+
+
+def calculate_compact_impacts(generation: CompactResult, impact_factors: ImpactFactorMatrix,
+                              impact_category_ids: Optional[List[int]] = None) -> CompactResult:
+    """
+    calculate_impacts on a CompactResult of generation data (see get_electricity_generation_df). The region codes keep
+    their dictionary, the generation unit and the units of the factors are dictionary-encoded and the ids are small ints
+    """
+    impacts = _broadcast_impacts(generation.columns['GenerationTypeId'], generation.columns['AggregatedGeneration'],
+                                 impact_factors, impact_category_ids)
+    generation_index = impacts.generation_index
+    matrix_rows, matrix_columns = impacts.matrix_rows, impacts.matrix_columns
+    # The unit matrices are small (generation types x impact categories), so they are encoded for each calculation
+    impact_category_unit_codes, impact_category_unit_values = dictionary_encode(
+        impact_factors.impact_category_units.ravel())
+    per_unit_codes, per_unit_values = dictionary_encode(impact_factors.per_units.ravel())
+    cells = np.ravel_multi_index((matrix_rows, matrix_columns), impact_factors.per_units.shape) \
+        if impact_factors.per_units.size else matrix_rows
+    return CompactResult(
+        {'RegionCode': generation.columns['RegionCode'][generation_index],
+         'DateStamp': generation.columns['DateStamp'][generation_index],
+         'AggregatedGeneration': impacts.aggregated_generation,
+         'GenerationUnit': np.zeros(generation_index.size, dtype=np.int8),
+         'ElectricityGenerationTypeId': small_ints(impact_factors.generation_type_ids[matrix_rows]),
+         'ImpactCategoryId': small_ints(impact_factors.impact_category_ids[matrix_columns]),
+         'ImpactValue': impacts.impact_value,
+         'ImpactCategoryUnit': impact_category_unit_codes[cells],
+         'PerUnit': per_unit_codes[cells],
+         'ConversionFactor': impacts.conversion_factor,
+         'AggregatedGenerationConverted': impacts.aggregated_generation_converted,
+         'EnvironmentalImpact': impacts.aggregated_generation_converted * impacts.impact_value},
+        dictionaries={'RegionCode': generation.dictionaries['RegionCode'],
+                      'GenerationUnit': np.array([impact_factors.generation_unit], dtype=object),
+                      'ImpactCategoryUnit': impact_category_unit_values,
+                      'PerUnit': per_unit_values},
+        timestamp_columns=generation.timestamp_columns, timezone=generation.timezone)
+
+
+@dataclass
+class _BroadcastImpacts:
+    """Rows of an impact calculation: one per (generation row, impact category) with an impact factor"""
+    generation_index: np.ndarray  # Generation row of each result row
+    matrix_rows: np.ndarray  # Row of the impact factor matrix (generation type)
+    matrix_columns: np.ndarray  # Column of the impact factor matrix (impact category)
+    aggregated_generation: np.ndarray
+    impact_value: np.ndarray
+    conversion_factor: np.ndarray
+    aggregated_generation_converted: np.ndarray
+
+
+def _broadcast_impacts(generation_type_ids: np.ndarray, aggregated_generation: np.ndarray,
+                       impact_factors: ImpactFactorMatrix,
+                       impact_category_ids: Optional[List[int]]) -> _BroadcastImpacts:
+    if impact_category_ids is None:
+        columns = np.arange(impact_factors.impact_category_ids.size)
+    else:
+        columns = impact_factors.impact_category_index(impact_category_ids)
+    rows = impact_factors.generation_type_index(generation_type_ids)
+
+    # (n generation rows x k impact categories) grids of factors. Unknown generation types and impact categories
+    # (index -1) are masked out below
+    if impact_factors.impact_values.size:
+        impact_values = impact_factors.impact_values[rows.clip(min=0)[:, None], columns.clip(min=0)[None, :]]
+    else:
+        impact_values = np.full((rows.size, columns.size), np.nan)
+    has_factor = (rows >= 0)[:, None] & (columns >= 0)[None, :] & ~np.isnan(impact_values)
+    generation_index, category_index = np.nonzero(has_factor)
+    matrix_rows = rows[generation_index]
+    matrix_columns = columns[category_index]
+
+    aggregated_generation = np.asarray(aggregated_generation, dtype=float)[generation_index]
+    conversion_factor = impact_factors.conversion_factors[matrix_rows, matrix_columns]
+    return _BroadcastImpacts(generation_index=generation_index, matrix_rows=matrix_rows, matrix_columns=matrix_columns,
+                             aggregated_generation=aggregated_generation,
+                             impact_value=impact_values[generation_index, category_index],
+                             conversion_factor=conversion_factor,
+                             aggregated_generation_converted=aggregated_generation * conversion_factor)
+
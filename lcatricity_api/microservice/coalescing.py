@@ -0,0 +1,103 @@
+"""
+Single-flight coalescing of identical concurrent requests.
+
+When a request arrives while an identical one (same ResultCacheKey: endpoint, normalized parameters and response
+format) is being computed, it waits for that computation and answers with a copy of its response instead of running
+the same queries again. This complements the result cache: it also applies to responses that are not cached (too large,
+cache disabled) and to the burst of requests that arrive before the first one has been cached.
+
+The computation runs in a task of its own, so that it completes for the waiting requests even if the client of the
+first request disconnects. Errors are raised to every waiting request. When a write of generation data is notified,
+the computations of the requests it overlaps are forgotten, so that the requests arriving after the write compute
+their response again rather than share one that may have read the rows before it.
+"""
+import asyncio
+import functools
+import logging
+import os
+import threading
+from dataclasses import dataclass, field
+from typing import Optional, Callable, Awaitable
+
+from dotenv import load_dotenv
+from fastapi import Response
+
+from lcatricity_api.data.notifications import GenerationWritten
+from lcatricity_api.microservice.metrics import COALESCED_REQUESTS
+from lcatricity_api.microservice.result_cache import ResultCacheKey
+
+load_dotenv()
+
+COALESCE_REQUESTS = os.getenv('ELEC_LCA_COALESCE_REQUESTS', 'true').lower() in ('1', 'true', 'yes')
+
+
+@dataclass
+class RequestCoalescer:
+    enabled: bool = COALESCE_REQUESTS
+    # Requests that computed their response, and requests that waited for an identical one
+    leaders: int = 0
+    followers: int = 0
+    _in_flight: dict = field(default_factory=dict)
+    # invalidate is called on the write listener thread
+    _lock: threading.Lock = field(default_factory=threading.Lock)
+
+    async def run(self, key: Optional[ResultCacheKey], compute: Callable[[], Awaitable[Response]]) -> Response:
+        """
+        The response of compute, shared with the identical requests (same key) arriving while it runs. Requests with
+        a None key are not coalesced. Must be called on the event loop
+        """
+        if key is None or not self.enabled:
+            return await compute()
+        with self._lock:
+            task = self._in_flight.get(key)
+        if task is not None:
+            self.followers += 1
+            COALESCED_REQUESTS.labels(key.path, 'follower').inc()
+            return _copy_response(await asyncio.shield(task))
+
+        self.leaders += 1
+        COALESCED_REQUESTS.labels(key.path, 'leader').inc()
+        task = asyncio.ensure_future(compute())
+        with self._lock:
+            self._in_flight[key] = task
+        task.add_done_callback(functools.partial(self._forget, key))
+        return _copy_response(await asyncio.shield(task))
+
+    def invalidate(self, written: GenerationWritten):
+        """
+        Forget the computations of the requests a write overlaps. They complete for the requests already waiting for
+        them. Registered as a write listener handler
+        """
+        with self._lock:
+            stale_keys = [key for key in self._in_flight if key.is_invalidated_by(written)]
+            for key in stale_keys:
+                del self._in_flight[key]
+        if stale_keys:
+            logging.debug(f'{len(stale_keys)} in-flight computations forgotten after {written}')
+
+    def _forget(self, key: ResultCacheKey, task: asyncio.Task):
+        with self._lock:
+            # The key may have been invalidated, and taken by a new computation since
+            if self._in_flight.get(key) is task:
+                del self._in_flight[key]
+        # Retrieve the error, in case every waiting request was cancelled
+        if not task.cancelled():
+            task.exception()
+
+    def stats(self) -> dict:
+        total = self.leaders + self.followers
+        with self._lock:
+            in_flight = len(self._in_flight)
+        return {'enabled': self.enabled, 'in_flight': in_flight, 'leaders': self.leaders,
+                'followers': self.followers, 'coalescing_ratio': self.followers / total if total else 0.0}
+
+
+def _copy_response(response: Response) -> Response:
+    """A response of its own for each request, as the middlewares may add headers to it"""
+    headers = {name: value for name, value in response.headers.items()
+               if name not in ('content-length', 'content-type')}
+    return Response(content=response.body, status_code=response.status_code, media_type=response.media_type,
+                    headers=headers)
+
+
+request_coalescer = RequestCoalescer()
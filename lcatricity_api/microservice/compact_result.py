@@ -0,0 +1,157 @@
+"""
+Compact column-oriented results of the generation and impact queries, used from the database fetch to the response
+encoding instead of DataFrames with a Python string object per string cell.
+
+Each column is a typed NumPy array:
+
+- timestamps are int32 seconds since the epoch (UTC), which covers dates up to 2038-01-19,
+- ids use the smallest integer type that holds them (int8 or int16 for generation types and impact categories),
+- repeated strings (region codes, units) are dictionary-encoded: a small integer code per row indexing the array of the
+  distinct values, -1 where the value is missing.
+
+A /calculate_all row then holds 12 bytes of timestamp, ids and codes besides its five float64 columns, where a
+DataFrame held an 8 byte datetime64, two int64 ids and a pointer to a string object per string cell. Results are
+decoded to a DataFrame only to be encoded as JSON or CSV, and are converted to Arrow (dictionary arrays, timestamp[s])
+without pandas.
+"""
+from dataclasses import dataclass, field
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from lcatricity_dataschema.base import ElectricityGeneration
+
+# Time zone of the DateStamps read from the generation tables, once decoded
+GENERATION_TIMEZONE = 'UTC' if getattr(ElectricityGeneration.__table__.c.DateStamp.type, 'timezone', False) else None
+
+
+@dataclass
+class CompactResult:
+    # Columns in output order. Dictionary-encoded columns hold the codes and timestamp columns the epoch seconds
+    columns: Dict[str, np.ndarray]
+    # Distinct values (object arrays) of each dictionary-encoded column
+    dictionaries: Dict[str, np.ndarray] = field(default_factory=dict)
+    timestamp_columns: Tuple[str, ...] = ()
+    # Time zone of the timestamp columns once decoded: 'UTC', or None for naive timestamps (in UTC)
+    timezone: Optional[str] = None
+
+    def __len__(self) -> int:
+        return next(iter(self.columns.values())).size if self.columns else 0
+
+    @property
+    def empty(self) -> bool:
+        return len(self) == 0
+
+    @property
+    def nbytes(self) -> int:
+        """Bytes held by the columns and the dictionaries (their strings included)"""
+        return (sum(column.nbytes for column in self.columns.values())
+                + sum(dictionary.nbytes + sum(len(value) for value in dictionary if isinstance(value, str))
+                      for dictionary in self.dictionaries.values()))
+
+    def take(self, indices) -> 'CompactResult':
+        """The rows at the given positions (or boolean mask), sharing the dictionaries"""
+        return CompactResult({name: column[indices] for name, column in self.columns.items()}, self.dictionaries,
+                             self.timestamp_columns, self.timezone)
+
+    def head(self, n: int) -> 'CompactResult':
+        return self.take(slice(0, n))
+
+    def values(self, name: str) -> np.ndarray:
+        """The decoded values of a column: strings of a dictionary-encoded column (None if missing), datetime64[s]"""
+        column = self.columns[name]
+        if name in self.dictionaries:
+            return np.append(self.dictionaries[name], None)[column]
+        if name in self.timestamp_columns:
+            return column.astype('datetime64[s]')
+        return column
+
+    def timestamp(self, name: str, row: int) -> pd.Timestamp:
+        """A timestamp of the result, as it is decoded in to_frame"""
+        timestamp = pd.Timestamp(int(self.columns[name][row]), unit='s')
+        return timestamp.tz_localize(self.timezone) if self.timezone else timestamp
+
+    def to_frame(self) -> pd.DataFrame:
+        """DataFrame of the result, with categorical columns for the dictionary-encoded ones"""
+        data = {}
+        for name, column in self.columns.items():
+            if name in self.dictionaries:
+                data[name] = pd.Categorical.from_codes(column, categories=pd.Index(self.dictionaries[name]))
+            elif name in self.timestamp_columns:
+                timestamps = pd.to_datetime(column.astype(np.int64), unit='s')
+                data[name] = timestamps.tz_localize(self.timezone) if self.timezone else timestamps
+            else:
+                data[name] = column
+        return pd.DataFrame(data)
+
+    def to_arrow(self):
+        """pyarrow Table of the result, with dictionary arrays and timestamp[s] columns. Needs pyarrow"""
+        import pyarrow as pa
+
+        arrays = []
+        for name, column in self.columns.items():
+            if name in self.dictionaries:
+                arrays.append(pa.DictionaryArray.from_arrays(pa.array(column, mask=column < 0),
+                                                             pa.array(self.dictionaries[name], type=pa.string())))
+            elif name in self.timestamp_columns:
+                arrays.append(pa.array(column.astype(np.int64), type=pa.timestamp('s', tz=self.timezone)))
+            else:
+                arrays.append(pa.array(column))
+        return pa.Table.from_arrays(arrays, names=list(self.columns))
+
+
+def generation_result(regions: Dict[int, str], region_ids: np.ndarray, date_stamps: np.ndarray,
+                      generation_type_ids: np.ndarray, aggregated_generation: np.ndarray) -> CompactResult:
+    """
+    Generation data with the columns RegionCode, DateStamp, GenerationTypeId and AggregatedGeneration
+
+    :param regions: Codes of the internal region ids the rows can have, which become the dictionary of RegionCode
+    :param region_ids: Internal region id of each row
+    :param date_stamps: Epoch seconds of each row
+    :param generation_type_ids: Generation type id of each row
+    :param aggregated_generation: Generation value of each row
+    """
+    known_region_ids = np.fromiter(regions, dtype=np.int64, count=len(regions))
+    order = np.argsort(known_region_ids)
+    region_codes = order[np.searchsorted(known_region_ids[order], region_ids).clip(max=max(len(regions) - 1, 0))] \
+        if region_ids.size else np.empty(0, dtype=np.int64)
+    return CompactResult({'RegionCode': region_codes.astype(smallest_int_dtype(np.array([len(regions)]))),
+                          'DateStamp': np.asarray(date_stamps).astype(np.int32),
+                          'GenerationTypeId': small_ints(generation_type_ids),
+                          'AggregatedGeneration': np.asarray(aggregated_generation, dtype=float)},
+                         dictionaries={'RegionCode': np.array(list(regions.values()), dtype=object)},
+                         timestamp_columns=('DateStamp',), timezone=GENERATION_TIMEZONE)
+
+
+def smallest_int_dtype(values: np.ndarray, signed: bool = True) -> np.dtype:
+    """Smallest integer type holding every value (and -1 if signed)"""
+    candidates = (np.int8, np.int16, np.int32, np.int64) if signed else (np.uint8, np.uint16, np.uint32, np.uint64)
+    low, high = (int(values.min()), int(values.max())) if values.size else (0, 0)
+    for dtype in candidates:
+        if np.iinfo(dtype).min <= min(low, -1 if signed else 0) and high <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    raise ValueError(f'Values between {low} and {high} do not fit in an integer type')
+
+
+def small_ints(values) -> np.ndarray:
+    """The integer values in the smallest type that holds them"""
+    values = np.asarray(values, dtype=np.int64)
+    return values.astype(smallest_int_dtype(values))
+
+
+def dictionary_encode(values) -> Tuple[np.ndarray, np.ndarray]:
+    """Codes (smallest integer type, -1 for missing values) and distinct values of an array of strings"""
+    codes, dictionary = pd.factorize(np.asarray(values, dtype=object), use_na_sentinel=True)
+    return codes.astype(smallest_int_dtype(np.array([len(dictionary)]))), np.asarray(dictionary, dtype=object)
+
+
+def epoch_seconds(values) -> np.ndarray:
+    """int32 seconds since the epoch of datetimes (naive ones are taken as UTC)"""
+    timestamps = pd.to_datetime(values)
+    if getattr(timestamps.dtype, 'tz', None) is not None:
+        timestamps = timestamps.tz_convert('UTC').tz_localize(None)
+    seconds = np.asarray(timestamps, dtype='datetime64[s]').astype(np.int64)
+    if seconds.size and (seconds.min() < np.iinfo(np.int32).min or seconds.max() > np.iinfo(np.int32).max):
+        raise ValueError('Timestamps out of the range of int32 epoch seconds')
+    return seconds.astype(np.int32)
@@ -2,7 +2,13 @@ class ServerError(Exception):
     pass
 
 
+class NotReadyError(Exception):
+    """The reference data has not been loaded from the database yet (the API is starting up)"""
+    pass
+
+
 conversion_factors = {('MJ', 'kWh'): 3.6}  # {(FromUnit,ToUnit): ConversionFactor, ...}
+GENERATION_UNIT = 'MJ'  # Unit of the AggregatedGeneration values stored in the database # TODO: Move to DB
 
 
 class NoDataAvailableError(Exception):
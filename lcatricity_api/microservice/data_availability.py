@@ -1,11 +1,17 @@
+import logging
 from datetime import datetime, timedelta
-from typing import Optional
+from typing import Optional, Iterator, List, Tuple
 
 import pandas as pd
-import sqlalchemy
-from sqlalchemy import func, desc
-from sqlalchemy.orm import sessionmaker
-
+from sqlalchemy import func, desc, select, Select, tuple_
+from sqlalchemy.exc import ProgrammingError
+
+from lcatricity_api.data.rollups import AVAILABILITY_TABLE, AVAILABILITY_ROLLUP, is_rollup_covered
+from lcatricity_api.microservice.cache_queries import get_region_id
+from lcatricity_api.microservice.db import run_in_db_executor
+from lcatricity_api.microservice.metrics import record_query
+from lcatricity_api.microservice.pagination import validate_page_size, query_fingerprint, encode_cursor, decode_cursor
+from lcatricity_api.microservice.streaming import stream_frames
 from lcatricity_dataschema.base import ElectricityGeneration, Regions
 
 
@@ -17,7 +23,7 @@ async def get_regions_with_generation_data(engine, date_start: Optional[str] = N
     I
     :param engine: SQLalchemy Engine to use
     :param date_start: Start date in the format yyyy-mm-dd. If None, then will return information on the earliest, last and count of data points for the region stored over all time in the database.
-    :param date_end:  End date of the period to search in the format yyyy-mm-dd. If None and date_start is a datestamp, then will be set to date_start+1day
+    :param date_end:  End date of the period to search in the format yyyy-mm-dd, excluded from the period. If None and date_start is a datestamp, then will be set to date_start+1day
     :param max_rows: Maximum number of rows to return. By default = 100. Maximum is 200 (which is more than the number of regions). If negative or <1 then will set to the default value of 1000
 
     :return:pd.DataFrame
@@ -48,38 +54,75 @@ async def get_regions_with_generation_data(engine, date_start: Optional[str] = N
             raise ValueError(
                 f'Could not handle start or end date in the period `{date_start}`-`{date_end}`. Check your input is in the form yyyy-mm-dd')
 
-    session_obj = sessionmaker(bind=engine)
-    with session_obj() as session:
-        if date_start is None:
-            regions_with_data_statement = session.query(
-                Regions.Code.label('RegionCode'),
-                func.min(ElectricityGeneration.DateStamp).label(
-                    'EarliestTimeStamp'),
-                func.max(ElectricityGeneration.DateStamp).label(
-                    'LatestTimeStamp'),
-                func.count(ElectricityGeneration.DateStamp).label(
-                    'CountDataPoints')
-            ).select_from(Regions).join(ElectricityGeneration, isouter=True
-                                        ).group_by(Regions.Code
-                                                   ).order_by(desc('CountDataPoints')).limit(max_rows)
-        elif isinstance(date_start, datetime):
-            regions_with_data_statement = session.query(
-                Regions.Code.label("RegionCode"),
-
-            ).select_from(Regions).join(ElectricityGeneration, isouter=True
-                                        ).add_columns(func.min(ElectricityGeneration.DateStamp).label(
-                'EarliestTimeStamp'),
-                func.max(ElectricityGeneration.DateStamp).label(
-                    'LatestTimeStamp'),
-                func.count(ElectricityGeneration.DateStamp).label(
-                    'CountDataPoints')
-            ).where((
-                            (ElectricityGeneration.DateStamp >= date_start) & (
-                            ElectricityGeneration.DateStamp <= date_end)) | (ElectricityGeneration.DateStamp == None)
-                    ).group_by(Regions.Code
-                               ).order_by(desc('CountDataPoints')).limit(max_rows)
-        region_ids_df = pd.read_sql(regions_with_data_statement.statement, session.bind)
-    return region_ids_df
+    return await run_in_db_executor(_query_regions_with_generation_data, engine, date_start=date_start,
+                                    date_end=date_end, max_rows=max_rows)
+
+
+def _query_regions_with_generation_data(engine, date_start: Optional[datetime], date_end: Optional[datetime],
+                                        max_rows: int) -> pd.DataFrame:
+    """Blocking part of get_regions_with_generation_data, run on the database thread pool"""
+    return _read_first_available(engine, _regions_with_generation_data_statements(date_start, date_end, max_rows))
+
+
+def _regions_with_generation_data_statements(date_start: Optional[datetime], date_end: Optional[datetime],
+                                             max_rows: int) -> List[Select]:
+    """
+    Statements the availability per region can be read from, in order of preference: the per-day availability rollup
+    maintained at ingest (see lcatricity_api.data.rollups), then the raw generation table if the rollup has not been
+    built over all the generation data. Both return a row per region. From the rollup, the period is the days from
+    date_start (included) to date_end (excluded)
+    """
+    availability = AVAILABILITY_TABLE
+    join_condition = Regions.Id == availability.c.RegionId
+    if date_start is not None:
+        join_condition = join_condition & (availability.c.Day >= date_start) & (availability.c.Day < date_end)
+    rollup_statement = select(
+        Regions.Code.label('RegionCode'),
+        func.min(availability.c.EarliestTimeStamp).label('EarliestTimeStamp'),
+        func.max(availability.c.LatestTimeStamp).label('LatestTimeStamp'),
+        func.coalesce(func.sum(availability.c.CountDataPoints), 0).label('CountDataPoints')
+    ).select_from(Regions).join(availability, join_condition, isouter=True
+                                ).where(is_rollup_covered(AVAILABILITY_ROLLUP)
+                                        ).group_by(Regions.Code).order_by(desc('CountDataPoints')).limit(max_rows)
+
+    raw_statement = select(
+        Regions.Code.label('RegionCode'),
+        func.min(ElectricityGeneration.DateStamp).label('EarliestTimeStamp'),
+        func.max(ElectricityGeneration.DateStamp).label('LatestTimeStamp'),
+        func.count(ElectricityGeneration.DateStamp).label('CountDataPoints')
+    ).select_from(Regions).join(ElectricityGeneration, isouter=True)
+    if date_start is not None:
+        raw_statement = raw_statement.where(
+            ((ElectricityGeneration.DateStamp >= date_start) & (ElectricityGeneration.DateStamp < date_end)) |
+            (ElectricityGeneration.DateStamp == None))
+    raw_statement = raw_statement.group_by(Regions.Code).order_by(desc('CountDataPoints')).limit(max_rows)
+    return [rollup_statement, raw_statement]
+
+
+def _read_first_available(engine, statements: List[Select]) -> pd.DataFrame:
+    """
+    Read the first statement that can be run and returns rows, e.g. a rollup table before the raw table it is computed
+    from
+    """
+    return _read_first_available_source(engine, statements)[0]
+
+
+def _read_first_available_source(engine, statements: List[Select]) -> Tuple[pd.DataFrame, Optional[int]]:
+    """Like _read_first_available, also returning the index of the statement read, None if none could be run"""
+    df = pd.DataFrame()
+    source = None
+    for index, statement in enumerate(statements):
+        try:
+            df = pd.read_sql(statement, engine)
+        except ProgrammingError as e:
+            record_query(statement, None)
+            logging.warning(f'Could not read from {statement.get_final_froms()}, trying the next source: {e}')
+            continue
+        record_query(statement, df.shape[0])
+        source = index
+        if not df.empty:
+            break
+    return df, source
 
 
 async def get_datapoints_per_day(engine, region_code: Optional[str]) -> pd.DataFrame:
@@ -90,38 +133,108 @@ async def get_datapoints_per_day(engine, region_code: Optional[str]) -> pd.DataF
     :param engine:
     :return:
     """
+    region_id = _datapoints_per_day_region_id(region_code)
+    return await run_in_db_executor(_query_datapoints_per_day, engine, region_id=region_id)
 
-    session_obj = sessionmaker(bind=engine)
-    with session_obj() as session:
-        if isinstance(region_code, str):
-            assert len(
-                region_code) < 10  # Force the region_code is less than 10 characters to minimzie risk of XSS/SQL injection
-            region_df = pd.read_sql(
-                sqlalchemy.text(f'SELECT "Id" FROM public."Regions" where "Code"=:code').bindparams(code=region_code),
-                engine)
-            if region_df.shape[0] == 0:
-                raise ValueError(f'No regions found for region code {region_code}')
-            elif region_df.shape[0] > 1:
-                raise ValueError(f'More than one region found for region code {region_code}')
-            region_id = region_df.iloc[0, 0]
-            region_id = int(region_id)
-            print('Region id is :', region_id)
-
-            data_per_day_query = session.query(
-                func.to_char(ElectricityGeneration.DateStamp, "YYYY-MM-DD").label('Datestamp'),
-                ElectricityGeneration.RegionId,
-                func.count(ElectricityGeneration.DateStamp).label('CountDataPoints')
-            ).where(ElectricityGeneration.RegionId == region_id).group_by(
-                func.to_char(ElectricityGeneration.DateStamp, "YYYY-MM-DD"), ElectricityGeneration.RegionId)
-
-        elif region_code is None:
-            data_per_day_query = session.query(
-                func.to_char(ElectricityGeneration.DateStamp, "YYYY-MM-DD").label('Datestamp'),
-                ElectricityGeneration.RegionId,
-                func.count(ElectricityGeneration.DateStamp).label('CountDataPoints')
-            ).group_by(func.to_char(ElectricityGeneration.DateStamp, "YYYY-MM-DD"), ElectricityGeneration.RegionId)
-        else:
-            print('Error, the region code is not a string or None')
-            return None
-        data_per_day_df = pd.read_sql(data_per_day_query.statement, session.bind)
-    return data_per_day_df
+
+async def get_datapoints_per_day_page(engine, region_code: Optional[str], page_size: Optional[int] = None,
+                                     cursor: Optional[str] = None) -> Tuple[pd.DataFrame, Optional[str]]:
+    """
+    Get one page of the count of generation datapoints per day per region, ordered by RegionId and day, with keyset
+    pagination (see lcatricity_api.microservice.pagination). Returns the page and the cursor of the next page, None on
+    the last page
+
+    :param page_size: Optional. Number of rows per page, up to pagination.MAX_PAGE_SIZE
+    :param cursor: Optional. Cursor returned with the previous page. None for the first page
+    """
+    region_id = _datapoints_per_day_region_id(region_code)
+    page_size = validate_page_size(page_size)
+    fingerprint = query_fingerprint('datapoints_per_day', region_id)
+    after = None
+    source = None
+    if cursor is not None:
+        key, source = decode_cursor(cursor, fingerprint)
+        try:
+            after = (int(key[0]), datetime.strptime(key[1], '%Y-%m-%d'))
+        except (IndexError, TypeError, ValueError):
+            raise ValueError('Invalid cursor. Use the cursor returned with the previous page')
+    statements = _datapoints_per_day_statements(region_id, limit=page_size + 1, after=after)
+    if source is not None:
+        if not 0 <= source < len(statements):
+            raise ValueError('Invalid cursor. Use the cursor returned with the previous page')
+        statements = [statements[source]]
+    df, statement_index = await run_in_db_executor(_read_first_available_source, engine, statements)
+    source = source if source is not None else statement_index
+
+    if df.shape[0] <= page_size:
+        return df, None
+    df = df.iloc[:page_size]
+    last_row = df.iloc[-1]
+    return df, encode_cursor([int(last_row['RegionId']), last_row['Datestamp']], source, fingerprint)
+
+
+def stream_datapoints_per_day_frames(engine, region_code: Optional[str]) -> Iterator[pd.DataFrame]:
+    """
+    Get the count of generation datapoints per day per region as DataFrame chunks read from a server-side cursor.
+    See get_datapoints_per_day
+    """
+    region_id = _datapoints_per_day_region_id(region_code)
+    return stream_frames(engine, _datapoints_per_day_statements(region_id))
+
+
+def _datapoints_per_day_region_id(region_code: Optional[str]) -> Optional[int]:
+    """Internal region id to filter on, or None for all regions"""
+    if isinstance(region_code, str):
+        region_id = get_region_id(region_code)
+        logging.debug(f'Region id is {region_id}')
+        return region_id
+    elif region_code is None:
+        return None
+    raise TypeError('Invalid region code. Region code must be a string or None')
+
+
+def _query_datapoints_per_day(engine, region_id: Optional[int]) -> pd.DataFrame:
+    """Blocking part of get_datapoints_per_day, run on the database thread pool"""
+    return _read_first_available(engine, _datapoints_per_day_statements(region_id))
+
+
+def _datapoints_per_day_statements(region_id: Optional[int], limit: Optional[int] = None,
+                                   after: Optional[Tuple[int, datetime]] = None) -> List[Select]:
+    """
+    Statements the count of datapoints per day can be read from, in order of preference: the per-day availability
+    rollup maintained at ingest, then the raw generation table if the rollup has not been built over all the
+    generation data
+
+    :param limit: Optional maximum number of rows
+    :param after: Optional (RegionId, day) of the last row of the previous page. Only the rows after it are returned
+    """
+    availability = AVAILABILITY_TABLE
+    rollup_statement = select(
+        func.to_char(availability.c.Day, "YYYY-MM-DD").label('Datestamp'),
+        availability.c.RegionId,
+        availability.c.CountDataPoints
+    ).where(is_rollup_covered(AVAILABILITY_ROLLUP)).order_by(availability.c.RegionId, availability.c.Day)
+
+    day = func.to_char(ElectricityGeneration.DateStamp, "YYYY-MM-DD")
+    raw_statement = select(
+        day.label('Datestamp'),
+        ElectricityGeneration.RegionId,
+        func.count(ElectricityGeneration.DateStamp).label('CountDataPoints')
+    ).group_by(day, ElectricityGeneration.RegionId)
+    if region_id is not None:
+        rollup_statement = rollup_statement.where(availability.c.RegionId == region_id)
+        raw_statement = raw_statement.where(ElectricityGeneration.RegionId == region_id)
+    if after is not None:
+        after_region_id, after_day = after
+        rollup_statement = rollup_statement.where(
+            tuple_(availability.c.RegionId, availability.c.Day) > tuple_(after_region_id, after_day))
+        # On DateStamp rather than on the day string, so that the index on DateStamp can be used
+        raw_statement = raw_statement.where(
+            (ElectricityGeneration.RegionId > after_region_id)
+            | ((ElectricityGeneration.RegionId == after_region_id)
+               & (ElectricityGeneration.DateStamp >= after_day + timedelta(days=1))))
+    if limit is not None:
+        raw_statement = raw_statement.order_by(ElectricityGeneration.RegionId, day)
+        rollup_statement = rollup_statement.limit(limit)
+        raw_statement = raw_statement.limit(limit)
+    return [rollup_statement, raw_statement]
@@ -0,0 +1,65 @@
+import asyncio
+import contextvars
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator
+
+from dotenv import load_dotenv
+
+from lcatricity_api.microservice.metrics import DB_POOL_WAIT
+
+load_dotenv()
+
+# Size of the SQLAlchemy connection pool. The executor below is bounded to the same capacity so that a thread never
+# sits waiting for a pooled connection while holding a worker slot.
+DB_POOL_SIZE = int(os.getenv('ELEC_LCA_DB_POOL_SIZE', '5'))
+DB_MAX_OVERFLOW = int(os.getenv('ELEC_LCA_DB_MAX_OVERFLOW', '5'))
+
+_db_executor = ThreadPoolExecutor(max_workers=DB_POOL_SIZE + DB_MAX_OVERFLOW, thread_name_prefix='lcatricity-db')
+
+
+async def run_in_db_executor(func, *args, **kwargs):
+    """
+    Run a blocking database function (sessionmaker + pd.read_sql etc.) on the bounded database thread pool, so that it
+    does not stall the event loop for other requests served by the same worker. func runs in a copy of the caller's
+    context, so that the stages it times are reported with the request (see metrics.timed_stage).
+
+    :param func: Synchronous callable to run
+    :param args: Positional arguments passed to func
+    :param kwargs: Keyword arguments passed to func
+    :return: The return value of func
+    """
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    submitted = time.perf_counter()
+
+    def _run():
+        DB_POOL_WAIT.observe(time.perf_counter() - submitted)
+        return context.run(func, *args, **kwargs)
+
+    return await loop.run_in_executor(_db_executor, _run)
+
+
+async def iterate_in_db_executor(iterator: Iterator):
+    """
+    Iterate a blocking iterator (e.g. chunks read from a server-side cursor) on the bounded database thread pool, as an
+    async generator. The iterator is closed if the consumer stops early, e.g. when a client disconnects mid-stream
+
+    :param iterator: Synchronous iterator
+    """
+    sentinel = object()
+    try:
+        while True:
+            item = await run_in_db_executor(next, iterator, sentinel)
+            if item is sentinel:
+                return
+            yield item
+    finally:
+        close = getattr(iterator, 'close', None)
+        if close is not None:
+            try:
+                close()
+            except ValueError:
+                # Still running on the thread pool (the consumer was cancelled mid-chunk). It is closed when collected
+                pass
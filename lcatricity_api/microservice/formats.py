@@ -0,0 +1,147 @@
+import gzip
+import io
+import json
+import os
+from typing import Optional, Tuple, List, Union
+
+import pandas as pd
+from fastapi import Request, Response
+
+from lcatricity_api.data.get_common_data import EncodedTable
+from lcatricity_api.microservice.compact_result import CompactResult
+from lcatricity_api.microservice.metrics import timed_stage
+
+ARROW_STREAM_MEDIA_TYPE = 'application/vnd.apache.arrow.stream'
+PARQUET_MEDIA_TYPE = 'application/parquet'
+CSV_MEDIA_TYPE = 'text/csv'
+COLUMNAR_MEDIA_TYPES = (ARROW_STREAM_MEDIA_TYPE, PARQUET_MEDIA_TYPE, CSV_MEDIA_TYPE)
+
+# Seconds clients and proxies may reuse the reference data list responses without revalidating them
+REFERENCE_DATA_MAX_AGE = int(os.getenv('ELEC_LCA_REFERENCE_DATA_MAX_AGE', '300'))
+# Responses in these formats larger than this (in bytes) are compressed if the client accepts gzip or zstd
+COMPRESSION_THRESHOLD = int(os.getenv('ELEC_LCA_COMPRESSION_THRESHOLD', '65536'))
+
+
+def negotiate_media_type(request: Request) -> Optional[str]:
+    """The columnar format asked for in the Accept header, or None for the default JSON response"""
+    accept = request.headers.get('accept', '')
+    for media_type in COLUMNAR_MEDIA_TYPES:
+        if media_type in accept:
+            return media_type
+    return None
+
+
+def encode_frame(df: Union[pd.DataFrame, CompactResult], media_type: str) -> bytes:
+    """
+    Encode a DataFrame or a CompactResult as an Arrow IPC stream, a Parquet file or CSV. Arrow and Parquet need the
+    optional pyarrow dependency, and raise an ImportError without it. A CompactResult is converted to Arrow directly,
+    with its dictionary-encoded columns as dictionary arrays
+    """
+    if media_type == CSV_MEDIA_TYPE:
+        return _as_frame(df).to_csv(index=False, date_format='%Y-%m-%dT%H:%M:%S').encode()
+    if media_type == PARQUET_MEDIA_TYPE:
+        if isinstance(df, CompactResult):
+            import pyarrow.parquet as pq
+
+            buffer = io.BytesIO()
+            pq.write_table(df.to_arrow(), buffer)
+            return buffer.getvalue()
+        buffer = io.BytesIO()
+        df.to_parquet(buffer, engine='pyarrow', index=False)
+        return buffer.getvalue()
+    if media_type == ARROW_STREAM_MEDIA_TYPE:
+        import pyarrow as pa
+
+        table = df.to_arrow() if isinstance(df, CompactResult) else pa.Table.from_pandas(df, preserve_index=False)
+        sink = pa.BufferOutputStream()
+        with pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+        return sink.getvalue().to_pybytes()
+    raise ValueError(f'Unsupported media type `{media_type}`')
+
+
+def compress_body(body: bytes, accept_encoding: str) -> Tuple[bytes, Optional[str]]:
+    """
+    Compress a response body above COMPRESSION_THRESHOLD with zstd (if the optional zstandard package is installed) or
+    gzip, depending on what the client accepts. Returns the body and the Content-Encoding to send, if any
+    """
+    if len(body) < COMPRESSION_THRESHOLD:
+        return body, None
+    if 'zstd' in accept_encoding:
+        try:
+            import zstandard
+        except ImportError:
+            pass
+        else:
+            return zstandard.ZstdCompressor().compress(body), 'zstd'
+    if 'gzip' in accept_encoding:
+        return gzip.compress(body, compresslevel=6), 'gzip'
+    return body, None
+
+
+def frame_response(df: Union[pd.DataFrame, CompactResult], request: Request,
+                   json_media_type: str = 'application/json') -> Response:
+    """
+    Build the response for a result DataFrame or CompactResult in the format asked for in the Accept header: Arrow IPC
+    stream, Parquet or CSV, or otherwise JSON records as before
+
+    :param df: Result to send
+    :param request: Incoming request, for the Accept and Accept-Encoding headers
+    :param json_media_type: Media type of the default JSON response
+    """
+    media_type = negotiate_media_type(request)
+    if media_type is None:
+        with timed_stage('encode'):
+            return Response(_as_frame(df).to_json(orient='records', date_format='iso'), media_type=json_media_type)
+    try:
+        with timed_stage('encode'):
+            body = encode_frame(df, media_type)
+    except ImportError:
+        return Response(status_code=406, content=f'{media_type} responses are not available on this server')
+    with timed_stage('compress'):
+        body, content_encoding = compress_body(body, request.headers.get('accept-encoding', ''))
+    headers = {'Vary': 'Accept, Accept-Encoding'}
+    if content_encoding is not None:
+        headers['Content-Encoding'] = content_encoding
+    return Response(body, media_type=media_type, headers=headers)
+
+
+def grouped_frame_response(df: Union[pd.DataFrame, CompactResult], request: Request, group_column: str, groups: List[str],
+                           json_media_type: str = 'application/json') -> Response:
+    """
+    Like frame_response, but the default JSON response is an object with the records of each group, e.g.
+    {"FR": [...], "NL": [...]}, with an empty list for the groups without rows. Columnar formats are returned as one
+    table, with the group column
+
+    :param df: Result to send
+    :param request: Incoming request, for the Accept and Accept-Encoding headers
+    :param group_column: Column to group the records by
+    :param groups: Values of group_column to return, in order
+    :param json_media_type: Media type of the default JSON response
+    """
+    if negotiate_media_type(request) is not None:
+        return frame_response(df, request, json_media_type=json_media_type)
+    with timed_stage('encode'):
+        records_by_group = {group: group_df.to_json(orient='records', date_format='iso')
+                            for group, group_df in _as_frame(df).groupby(group_column, sort=False, observed=True)}
+        body = ','.join(f'{json.dumps(group)}:{records_by_group.get(group, "[]")}' for group in groups)
+    return Response('{' + body + '}', media_type=json_media_type)
+
+
+def _as_frame(df: Union[pd.DataFrame, CompactResult]) -> pd.DataFrame:
+    """The DataFrame of a CompactResult, decoded only for the encoders that need one (JSON, CSV)"""
+    return df.to_frame() if isinstance(df, CompactResult) else df
+
+
+def encoded_table_response(encoded_table: EncodedTable, request: Request) -> Response:
+    """
+    Serve a reference data table encoded once per cache load, with its ETag. Answers 304 Not Modified without a body if
+    the client already has this version (If-None-Match)
+    """
+    headers = {'ETag': encoded_table.etag, 'Cache-Control': f'public, max-age={REFERENCE_DATA_MAX_AGE}'}
+    if_none_match = request.headers.get('if-none-match')
+    if if_none_match is not None:
+        client_etags = {etag.strip().removeprefix('W/') for etag in if_none_match.split(',')}
+        if encoded_table.etag in client_etags or '*' in client_etags:
+            return Response(status_code=304, headers=headers)
+    return Response(encoded_table.body, media_type='application/json', headers=headers)
@@ -1,19 +1,157 @@
 import logging
 from datetime import datetime, timedelta
-from typing import Optional
+from typing import Optional, Iterator, Callable, Tuple, List, Dict
 
+import numpy as np
 import pandas as pd
-from sqlalchemy import literal
+import sqlalchemy
+from sqlalchemy import literal, func, select, Select, case, tuple_, extract, cast, Integer
+from sqlalchemy.exc import ProgrammingError
 from sqlalchemy.orm import sessionmaker
 
+from lcatricity_api.data.rollups import ROLLUP_TABLES, is_rollup_covered
+from lcatricity_api.microservice.cache_queries import get_region_id, get_region_code, get_generation_type, \
+    get_generation_type_ids
+from lcatricity_api.microservice.compact_result import CompactResult, generation_result
 from lcatricity_api.microservice.constants import ServerError, NoDataAvailableError
-from lcatricity_dataschema.base import Regions, ElectricityGeneration
+from lcatricity_api.microservice.db import run_in_db_executor
+from lcatricity_api.microservice.metrics import timed_stage, record_query
+from lcatricity_api.microservice.pagination import validate_page_size, query_fingerprint, encode_cursor, decode_cursor
+from lcatricity_api.microservice.resolution import choose_resolution, bucket_expression, validate_resolution, \
+    bucket_start, next_bucket_start
+from lcatricity_api.microservice.streaming import stream_frames, STREAM_CHUNK_SIZE
+from lcatricity_api.microservice.tile_store import serves_period, read_generation_tiles
+from lcatricity_dataschema.base import ElectricityGeneration
+
+# Rollup table read for each downsampled resolution
+ROLLUP_LEVEL_OF_RESOLUTION = {'hour': 'hour', '4hours': 'hour', '6hours': 'hour', 'day': 'day', 'month': 'month'}
 
 
 async def get_electricity_generation_df(date_start: str, region_code: str, engine,
                                         generation_type_id: Optional[int] = None, date_end: str = None,
-                                        max_datapoints: int = 1000) -> pd.DataFrame:
-    """Get electricity generation on a given day"""
+                                        max_datapoints: int = 1000, resolution: Optional[str] = None) -> CompactResult:
+    """
+    Get electricity generation on a given day or period, with the columns RegionCode, DateStamp, GenerationTypeId and
+    AggregatedGeneration.
+
+    If resolution is None, the finest resolution expected to return at most max_datapoints rows is used. Downsampled
+    resolutions return the median of each generation type in each time bucket, read from the rollup tables (see
+    lcatricity_api.data.rollups), with DateStamp the start of the bucket.
+
+    :param resolution: Optional. One of `raw`, `hour`, `4hours`, `6hours`, `day`, `month`
+    """
+    date_start, date_end, region_id = _validate_generation_request(date_start, region_code, generation_type_id,
+                                                                   date_end)
+    n_series = 1 if generation_type_id is not None else len(get_generation_type_ids())
+    with timed_stage('resolution'):
+        resolution = choose_resolution(date_start, date_end, n_series, max_datapoints, resolution=resolution)
+
+    return await run_in_db_executor(_query_electricity_generation, date_start, _region_codes([region_id]), engine,
+                                    generation_type_id=generation_type_id, date_end=date_end,
+                                    resolution=resolution, max_datapoints=max_datapoints)
+
+
+async def get_electricity_generation_page(date_start: str, region_code: str, engine,
+                                          generation_type_id: Optional[int] = None, date_end: str = None,
+                                          resolution: Optional[str] = None, page_size: Optional[int] = None,
+                                          cursor: Optional[str] = None) -> Tuple[CompactResult, Optional[str]]:
+    """
+    Get one page of the electricity generation on a given day or period, ordered by DateStamp and GenerationTypeId,
+    with keyset pagination (see lcatricity_api.microservice.pagination). There is no max_datapoints limit and the
+    resolution defaults to `raw`. Returns the page and the cursor of the next page, None on the last page
+
+    :param page_size: Optional. Number of rows per page, up to pagination.MAX_PAGE_SIZE
+    :param cursor: Optional. Cursor returned with the previous page. None for the first page
+    """
+    date_start, date_end, region_id = _validate_generation_request(date_start, region_code, generation_type_id,
+                                                                   date_end)
+    resolution = validate_resolution(resolution) or 'raw'
+    page_size = validate_page_size(page_size)
+    fingerprint = query_fingerprint('generation', region_id, generation_type_id, date_start, date_end, resolution)
+    after = None
+    source = None
+    if cursor is not None:
+        key, source = decode_cursor(cursor, fingerprint)
+        try:
+            after = (datetime.fromisoformat(key[0]), int(key[1]))
+        except (IndexError, TypeError, ValueError):
+            raise ValueError('Invalid cursor. Use the cursor returned with the previous page')
+    regions = _region_codes([region_id])
+    statements = _generation_statements(regions, generation_type_id, date_start, date_end, resolution,
+                                        limit=page_size + 1, after=after, compact=True)
+    if source is not None:
+        if not 0 <= source < len(statements):
+            raise ValueError('Invalid cursor. Use the cursor returned with the previous page')
+        result, _ = await run_in_db_executor(_read_first_generation_source, engine, [statements[source]], regions)
+    else:
+        result, source = await run_in_db_executor(_read_first_generation_source, engine, statements, regions)
+
+    if len(result) <= page_size:
+        return result, None
+    result = result.head(page_size)
+    return result, encode_cursor([result.timestamp('DateStamp', page_size - 1).isoformat(),
+                                  int(result.columns['GenerationTypeId'][page_size - 1])], source, fingerprint)
+
+
+async def get_batch_electricity_generation_df(date_start: str, region_codes: List[str], engine, date_end: str = None,
+                                              max_datapoints_per_region: int = 1000,
+                                              resolution: Optional[str] = None) -> CompactResult:
+    """
+    Get the electricity generation of several regions on a given day or period with a single query. Returns the same
+    columns as get_electricity_generation_df, ordered by region.
+
+    The resolution is chosen as for get_electricity_generation_df, with a budget of max_datapoints_per_region rows for
+    each region
+    """
+    if not isinstance(region_codes, list) or not region_codes:
+        raise TypeError('Invalid region codes. Region codes must be a non-empty list of strings')
+    region_ids = []
+    for region_code in dict.fromkeys(region_codes):
+        date_start_datetime, date_end_datetime, region_id = _validate_generation_request(date_start, region_code, None,
+                                                                                         date_end)
+        region_ids.append(region_id)
+    regions = _region_codes(region_ids)
+    max_datapoints = max_datapoints_per_region * len(regions)
+    n_series = len(regions) * len(get_generation_type_ids())
+    with timed_stage('resolution'):
+        resolution = choose_resolution(date_start_datetime, date_end_datetime, n_series, max_datapoints,
+                                       resolution=resolution)
+
+    return await run_in_db_executor(_query_electricity_generation, date_start_datetime, regions, engine,
+                                    generation_type_id=None, date_end=date_end_datetime, resolution=resolution,
+                                    max_datapoints=max_datapoints)
+
+
+def stream_electricity_generation_frames(date_start: str, region_code: str, engine,
+                                         generation_type_id: Optional[int] = None, date_end: str = None,
+                                         resolution: Optional[str] = None,
+                                         transform: Optional[Callable[[pd.DataFrame], pd.DataFrame]] = None
+                                         ) -> Iterator[pd.DataFrame]:
+    """
+    Get electricity generation on a given day or period as DataFrame chunks read from a server-side cursor. The input
+    is validated straight away, but nothing is read from the database until the iterator is consumed.
+
+    As memory use does not depend on the size of the period, there is no max_datapoints limit and the resolution
+    defaults to `raw`.
+
+    :param transform: Optional function applied to each chunk while it is read (e.g. the impact calculation)
+    """
+    date_start, date_end, region_id = _validate_generation_request(date_start, region_code, generation_type_id,
+                                                                   date_end)
+    resolution = validate_resolution(resolution) or 'raw'
+    statements = _generation_statements(_region_codes([region_id]), generation_type_id, date_start, date_end,
+                                        resolution)
+    return stream_frames(engine, statements, transform=transform)
+
+
+def _region_codes(region_ids: List[int]) -> Dict[int, str]:
+    """The code of each internal region id, as stored in the database, to label the rows read for these regions"""
+    return {region_id: get_region_code(region_id) for region_id in region_ids}
+
+
+def _validate_generation_request(date_start: str, region_code: str, generation_type_id: Optional[int],
+                                 date_end: Optional[str]) -> Tuple[datetime, datetime, int]:
+    """Check the generation request and return the period start and end and the internal region id"""
     if not isinstance(region_code, str):
         raise TypeError('Invalid region code. Region code must be a string')
 
@@ -38,56 +176,168 @@ async def get_electricity_generation_df(date_start: str, region_code: str, engin
         raise ValueError(
             f'Could not handle start or end date in the period `{date_start}`-`{date_end}`. Check your input is in the form yyyy-mm-dd')
 
+    with timed_stage('region_lookup'):
+        region_id = get_region_id(region_code)
+    logging.debug(f'REGION IS {region_id}')
+    if generation_type_id is not None:
+        get_generation_type(generation_type_id)
+    return date_start, date_end, region_id
+
+
+def _query_electricity_generation(date_start: datetime, regions: Dict[int, str], engine,
+                                  generation_type_id: Optional[int], date_end: datetime, resolution: str,
+                                  max_datapoints: int) -> CompactResult:
+    """
+    Blocking part of get_electricity_generation_df and get_batch_electricity_generation_df, run on the database thread
+    pool. regions maps the internal ids of the regions to read to their codes. Historical periods of a single region are
+    read through the tile store if it is enabled (see tile_store)
+    """
+    region_code = ', '.join(regions.values())
+    if len(regions) == 1 and serves_period(date_end):
+        [(region_id, single_region_code)] = regions.items()
+        result = read_generation_tiles(
+            region_id, single_region_code, generation_type_id, date_start, date_end, resolution,
+            fetch_month=lambda month_start, month_end: _read_first_generation_source(
+                engine, _generation_statements(regions, None, month_start, month_end, resolution, compact=True),
+                regions)[0])
+    else:
+        result, _ = _read_first_generation_source(engine, _generation_statements(regions, generation_type_id,
+                                                                                 date_start, date_end, resolution,
+                                                                                 limit=max_datapoints + 1,
+                                                                                 compact=True), regions)
+    logging.debug(
+        f'{len(result)} rows returned from generation table for {region_code} in period {date_start}-{date_end} at resolution {resolution}')
+    if len(result) > max_datapoints:
+        raise ValueError(f'Too much data to be returned at resolution `{resolution}` for the period `{date_start}`-`{date_end}`. '
+                         f'Request a coarser resolution or a shorter period')
+    return result
+
+
+def _read_first_generation_source(engine, statements: List[Select],
+                                  regions: Dict[int, str]) -> Tuple[CompactResult, int]:
+    """
+    Read the first of the compact statements that can be run and returns rows (see _generation_statements). Returns
+    the rows and the index of the statement they were read from
+    """
+    result = None
+    source = None
     session_obj = sessionmaker(bind=engine)
-    with session_obj() as session:
-        impacts_query = session.query(Regions.Id).where(Regions.Code == region_code).limit(1)
-
-        # TODO: Consider replacing with a lookup in the common data cached in the main body
-        region_id_df = pd.read_sql(impacts_query.statement, session.bind)
-        if region_id_df is None or region_id_df.shape[0] == 0:
-            raise ValueError(f'Region Code `{region_code}` could not be found in database')
-        elif region_id_df.shape[0] > 1:
-            raise ServerError(
-                f'More than one region found for region code `{region_code}`. There is probably an error in the database')
-
-        region_id = int(region_id_df.iat[0, 0])
-        logging.debug(f'REGION IS {region_id}')
-
-        if generation_type_id:
-            query = (session.query(ElectricityGeneration)
-                     .with_entities(literal(region_code).label('RegionCode'),
-                                    ElectricityGeneration.DateStamp,
-                                    ElectricityGeneration.GenerationTypeId,
-                                    ElectricityGeneration.AggregatedGeneration)
-                     .where(ElectricityGeneration.GenerationTypeId == generation_type_id)
-                     .where(ElectricityGeneration.RegionId == region_id)
-                     .where((ElectricityGeneration.DateStamp >= date_start)
-                            & (ElectricityGeneration.DateStamp <= date_end))
-                     )
-        else:
-            query = (session.query(ElectricityGeneration)
-                     .with_entities(literal(region_code).label('RegionCode'),
-                                    ElectricityGeneration.DateStamp,
-                                    ElectricityGeneration.GenerationTypeId,
-                                    ElectricityGeneration.AggregatedGeneration)
-                     .where(ElectricityGeneration.RegionId == region_id)
-                     .where((ElectricityGeneration.DateStamp >= date_start)
-                            & (ElectricityGeneration.DateStamp <= date_end))
-                     )
-        df = pd.read_sql(query.statement, session.bind)
-        df = df.set_index('DateStamp')
-        final_df = df.copy(deep=True)
-        resample_options = ['H', '4H', '6H', 'D', 'ME']
-        resample_attempt = 0
-        logging.debug(
-            f'{final_df.shape[0]} rows returned from generation table for {region_code} in period {date_start}-{date_end}')
-        while final_df.shape[0] > max_datapoints:
-            logging.debug(f'Resample attempt {resample_attempt}')
-            if resample_attempt > len(resample_options) - 1:
-                raise Exception('Too much data to be returned')
-            final_df = final_df.resample(resample_options[resample_attempt]).median(numeric_only=True)
-            final_df['RegionCode'] = region_code # Re-introduce the region code. It's a string so it gets removed in the resampling on numeric values
-            logging.debug(f'{final_df.shape[0]} rows in generation_df after resample attempt {resample_attempt}')
-            resample_attempt += 1
-        final_df = final_df.reset_index()
-    return final_df
+    with timed_stage('generation_sql'), session_obj() as session:
+        for source, statement in enumerate(statements):
+            try:
+                with session.bind.connect() as connection:
+                    result = _fetch_generation_result(connection, statement, regions)
+            except ProgrammingError as e:
+                record_query(statement, None)
+                logging.warning(f'Could not read generation data from {statement.get_final_froms()}, trying the next source: {e}')
+                continue
+            record_query(statement, len(result))
+            if not result.empty:
+                break
+    if result is None:
+        raise ServerError('Could not read generation data from any source')
+    return result, source
+
+
+def _fetch_generation_result(connection: sqlalchemy.Connection, statement: Select,
+                             regions: Dict[int, str]) -> CompactResult:
+    """
+    Run a compact generation statement and read its rows into a CompactResult, STREAM_CHUNK_SIZE rows at a time, so that
+    only one chunk of rows is held as Python objects
+    """
+    chunks = []
+    for rows in connection.execute(statement).partitions(STREAM_CHUNK_SIZE):
+        n_rows = len(rows)
+        chunks.append((np.fromiter((row[0] for row in rows), dtype=np.int64, count=n_rows),
+                       np.fromiter((row[1] for row in rows), dtype=np.int64, count=n_rows),
+                       np.fromiter((row[2] for row in rows), dtype=np.int64, count=n_rows),
+                       # NULL generation values become NaN
+                       np.array([row[3] for row in rows], dtype=float)))
+    if not chunks:
+        chunks = [(np.empty(0, dtype=np.int64),) * 3 + (np.empty(0),)]
+    return generation_result(regions, *(np.concatenate(column) for column in zip(*chunks)))
+
+
+def _generation_statements(regions: Dict[int, str], generation_type_id: Optional[int], date_start: datetime,
+                           date_end: datetime, resolution: str, limit: Optional[int] = None,
+                           after: Optional[Tuple[datetime, int]] = None, compact: bool = False) -> List[Select]:
+    """
+    Statements the generation data can be read from, in order of preference. Downsampled resolutions are served from
+    the rollups maintained at ingest, falling back to aggregating the raw rows if the rollups have not been built for
+    this data
+
+    :param after: Optional (DateStamp, GenerationTypeId) of the last row of the previous page, for a single region.
+        Only the rows after it are returned
+    :param compact: Select RegionId and DateStamp as epoch seconds instead of the region code and the timestamp, for
+        _fetch_generation_result
+    """
+    raw = ElectricityGeneration.__table__
+    statements = []
+    if resolution != 'raw':
+        rollup_level = ROLLUP_LEVEL_OF_RESOLUTION[resolution]
+        rollup = ROLLUP_TABLES[rollup_level]
+        statements.append(_generation_statement(rollup, rollup.c.MedianGeneration, rollup_level, regions,
+                                                generation_type_id, date_start, date_end, resolution, limit, after,
+                                                compact))
+    statements.append(_generation_statement(raw, raw.c.AggregatedGeneration, 'raw', regions, generation_type_id,
+                                            date_start, date_end, resolution, limit, after, compact))
+    return statements
+
+
+def _generation_statement(source: sqlalchemy.Table, value, source_resolution: str, regions: Dict[int, str],
+                          generation_type_id: Optional[int], date_start: datetime, date_end: datetime,
+                          resolution: str, limit: Optional[int],
+                          after: Optional[Tuple[datetime, int]] = None, compact: bool = False) -> Select:
+    """
+    Query of the generation data of one or more regions (internal id: code) at the given resolution, read from the raw
+    generation table or a rollup table (source). If the source is finer than the resolution, the median of each
+    generation type in each time bucket is computed in the database. Downsampled resolutions return the buckets that
+    start between the start of the bucket of date_start and date_end, each over the whole bucket
+    """
+    if resolution == source_resolution:
+        date_stamp = source.c.DateStamp
+        aggregated_generation = value
+    else:
+        date_stamp = bucket_expression(source.c.DateStamp, resolution)
+        aggregated_generation = func.percentile_cont(0.5).within_group(value)
+
+    if len(regions) == 1:
+        [(region_id, region_code)] = regions.items()
+        region_code_column = literal(region_code)
+        region_filter = source.c.RegionId == region_id
+    else:
+        region_code_column = case(regions, value=source.c.RegionId)
+        region_filter = source.c.RegionId.in_(list(regions))
+
+    if compact:
+        region_column = source.c.RegionId
+        date_stamp_column = cast(extract('epoch', date_stamp), Integer)
+    else:
+        region_column = region_code_column.label('RegionCode')
+        date_stamp_column = date_stamp
+    query = (select(region_column,
+                    date_stamp_column.label('DateStamp'),
+                    source.c.GenerationTypeId,
+                    aggregated_generation.label('AggregatedGeneration'))
+             .where(region_filter)
+             )
+    if resolution == 'raw':
+        query = query.where((source.c.DateStamp >= date_start) & (source.c.DateStamp <= date_end))
+    else:
+        # Every bucket overlapping the period, whole, whichever source it is read from
+        query = query.where((source.c.DateStamp >= bucket_start(date_start, resolution))
+                            & (source.c.DateStamp < next_bucket_start(date_end, resolution)))
+    if source_resolution != 'raw':
+        # The rollup is read only once it has been built over all the generation data
+        query = query.where(is_rollup_covered(source_resolution))
+    if generation_type_id:
+        query = query.where(source.c.GenerationTypeId == generation_type_id)
+    if after is not None:
+        # Filtering the rows on their bucket keeps whole buckets, so it can be done before grouping
+        query = query.where(tuple_(date_stamp, source.c.GenerationTypeId) > tuple_(*after))
+    if resolution != source_resolution:
+        query = query.group_by(source.c.RegionId, date_stamp, source.c.GenerationTypeId)
+    query = query.order_by(source.c.RegionId, date_stamp, source.c.GenerationTypeId)
+    if limit is not None:
+        query = query.limit(limit)
+    return query
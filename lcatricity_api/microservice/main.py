@@ -1,26 +1,46 @@
+import asyncio
+import functools
+import hmac
 import json
 import logging
 import os
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 from datetime import datetime, timedelta
-from typing import Any, Optional, List
+from typing import Any, Optional, List, Dict, Callable, Awaitable
 
-import pandas as pd
 import sqlalchemy as sqla
 from dotenv import load_dotenv
-from fastapi import FastAPI, Response
+from fastapi import FastAPI, Response, Request, Depends, HTTPException
 from fastapi.openapi.docs import get_swagger_ui_html
-import uvicorn
 from starlette import status
-from starlette.responses import RedirectResponse
+from starlette.responses import RedirectResponse, JSONResponse
 
 from lcatricity_api.microservice.ResponseModels import GenerationResponseModel, ImpactResultSchema, \
     DataAvailabilityResponse
-from lcatricity_api.microservice.cache_queries import list_regions_in_cache, list_generation_types_in_cache, \
-    list_generation_type_mappings_in_cache, list_impact_categories_df_in_cache, init_cache
-from lcatricity_api.microservice.calculate import calculate_impact_df
-from lcatricity_api.microservice.constants import ServerError, NoDataAvailableError
-from lcatricity_api.microservice.data_availability import get_regions_with_generation_data, get_datapoints_per_day
-from lcatricity_api.microservice.generation import get_electricity_generation_df
+from lcatricity_api.microservice.cache_queries import init_cache, get_encoded_table, add_cache_refresh_handler, \
+    start_cache_refresher, refresh_cache, cache_status, request_refresh_from_writer
+from lcatricity_api.microservice.RequestModels import BatchCalculationRequest
+from lcatricity_api.microservice.coalescing import request_coalescer
+from lcatricity_api.microservice.compact_result import CompactResult
+from lcatricity_api.microservice.calculate import calculate_impact_df, calculate_all_impacts_df, stream_impact_frames, \
+    calculate_batch_impacts_df
+from lcatricity_api.microservice.constants import ServerError, NoDataAvailableError, NotReadyError
+from lcatricity_api.microservice.db import DB_POOL_SIZE, DB_MAX_OVERFLOW, run_in_db_executor
+from lcatricity_api.microservice.data_availability import get_regions_with_generation_data, get_datapoints_per_day, \
+    stream_datapoints_per_day_frames, get_datapoints_per_day_page
+from lcatricity_api.microservice.generation import get_electricity_generation_df, stream_electricity_generation_frames, \
+    get_electricity_generation_page
+from lcatricity_api.microservice.metrics import MetricsMiddleware, instrument_engine, metrics_response_body
+from lcatricity_api.microservice.pagination import add_next_page_headers
+from lcatricity_api.microservice.formats import frame_response, grouped_frame_response, encoded_table_response
+from lcatricity_api.microservice.query_profiler import SLOW_QUERY_THRESHOLD_MS, enable_query_profiling, \
+    slow_query_log
+from lcatricity_api.microservice.result_cache import result_cache, result_cache_key, ResultCacheKey
+from lcatricity_api.microservice.streaming import wants_ndjson, ndjson_response
+from lcatricity_api.microservice.tile_store import invalidate_tiles, clear_tiles, tile_store_stats
+from lcatricity_api.microservice.write_listener import add_generation_written_handler, \
+    start_generation_written_listener
 
 load_dotenv()
 HOST = os.getenv('ELEC_LCA_DB_HOST')
@@ -38,8 +58,15 @@ except Exception as e:
     raise Exception("Other issue with API_PORT in .env")
 
 API_VERSION = os.getenv('ELEC_LCA_API_VERSION')
+# Bearer token of the /admin endpoints. Empty to not serve them
+ADMIN_TOKEN = os.getenv('ELEC_LCA_ADMIN_TOKEN', '')
 
-# Connect to postgres database
+# Seconds /readyz waits for the database to answer
+READINESS_DB_TIMEOUT = 2
+# Seconds to wait before retrying to load the reference data at startup, doubled after each failure up to 1 min
+STARTUP_RETRY_DELAY = 1
+
+# Connect to postgres database. No connection is made until the first query
 engine = sqla.create_engine(sqla.engine.url.URL.create(
     drivername='postgresql',
     host=HOST,
@@ -47,12 +74,79 @@ engine = sqla.create_engine(sqla.engine.url.URL.create(
     username=USER,
     password=PASSWORD,
     port=DB_PORT
-))
-init_cache(engine)
+), pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW)
+instrument_engine(engine)
+if SLOW_QUERY_THRESHOLD_MS > 0:
+    enable_query_profiling(engine)
+# /readyz pings the database with a connection of its own, on a thread of its own, with timeouts (libpq's connect
+# timeout is at least 2 s): while the database hangs, the probes neither take the connections and threads of the API
+# queries nor pile up
+probe_engine = sqla.create_engine(engine.url, poolclass=sqla.pool.NullPool,
+                                  connect_args={'connect_timeout': max(READINESS_DB_TIMEOUT, 2),
+                                                'options': f'-c statement_timeout={READINESS_DB_TIMEOUT * 1000}'})
+_probe_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='lcatricity-probe')
+
+
+def _clear_result_cache_on_change(previous_cache, new_cache):
+    # Cached impacts were calculated with the previous impact factors
+    if previous_cache is not None and previous_cache.content_hash != new_cache.content_hash:
+        result_cache.clear()
+
+
+async def _load_reference_data():
+    """Load the cache in the background, retrying until the database is reachable, then keep it refreshed"""
+    delay = STARTUP_RETRY_DELAY
+    while True:
+        try:
+            await run_in_db_executor(init_cache, engine)
+            break
+        except Exception as e:
+            logging.error(f'Could not load the reference data, retrying in {delay} s: {e}')
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 60)
+    start_cache_refresher(engine)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Start serving straight away: the reference data is loaded in the background, and requests that need it get a 503
+    until it is loaded (see /readyz)
+    """
+    add_cache_refresh_handler(_clear_result_cache_on_change)
+    add_generation_written_handler(result_cache.invalidate)
+    add_generation_written_handler(request_coalescer.invalidate)
+    add_generation_written_handler(invalidate_tiles)
+    start_generation_written_listener(engine)
+    loader = asyncio.create_task(_load_reference_data())
+    yield
+    loader.cancel()
+    engine.dispose()
+    _probe_executor.shutdown(wait=False)
+
 
 app = FastAPI(title="LCAtricity API",
               description="Assess environmental impacts of electricity generation on multiple dimensions.",
-              version=API_VERSION)
+              version=API_VERSION,
+              lifespan=lifespan)
+app.add_middleware(MetricsMiddleware)
+
+
+@app.exception_handler(NotReadyError)
+async def not_ready_handler(request: Request, exc: NotReadyError):
+    return Response(status_code=503, content='The API is starting up, try again shortly', headers={'Retry-After': '5'})
+
+
+def require_admin_token(request: Request):
+    """Dependency of the /admin endpoints: 404 unless ELEC_LCA_ADMIN_TOKEN is set, 401 without it as bearer token"""
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=404)
+    scheme, _, token = request.headers.get('authorization', '').partition(' ')
+    if scheme.lower() != 'bearer' or not hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode()):
+        raise HTTPException(status_code=401, detail='Invalid admin token', headers={'WWW-Authenticate': 'Bearer'})
+
+
+ADMIN_DEPENDENCIES = [Depends(require_admin_token)]
 
 
 @app.get('/')
@@ -67,8 +161,50 @@ def get_docs():
     return get_swagger_ui_html(title='API documentation for LCAtricity')
 
 
+@app.get('/healthz')
+async def healthz():
+    """Liveness probe: the API process is up and serving requests"""
+    return {'status': 'ok'}
+
+
+@app.get('/readyz')
+async def readyz():
+    """
+    Readiness probe: 200 once the reference data is loaded and the database answers, otherwise 503
+
+    :return:
+    JSON
+    """
+    cache_loaded = cache_status()['loaded']
+    try:
+        await asyncio.wait_for(asyncio.get_running_loop().run_in_executor(_probe_executor, _ping_database),
+                               timeout=READINESS_DB_TIMEOUT)
+        database_reachable = True
+    except Exception as e:
+        logging.warning(f'Database not reachable: {e}')
+        database_reachable = False
+    ready = cache_loaded and database_reachable
+    return JSONResponse({'cache_loaded': cache_loaded, 'database_reachable': database_reachable},
+                        status_code=200 if ready else 503)
+
+
+def _ping_database():
+    with probe_engine.connect() as connection:
+        connection.execute(sqla.text('SELECT 1'))
+
+
+@app.get('/metrics', include_in_schema=False)
+async def metrics():
+    """
+    Prometheus metrics: latency per endpoint and per stage, rows read per query, fallbacks between the rollup and raw
+    tables, response sizes and the wait for a database connection
+    """
+    body, media_type = metrics_response_body()
+    return Response(body, media_type=media_type)
+
+
 @app.get('/list_regions')
-async def list_regions():
+async def list_regions(request: Request):
     """
     List the Electricity regions available for calculation. Note that this is a mixture of coutries and electricity regions (which may be sub-national or across multiple countries).
     Please see the ENTSO-E region documentation for notes on certain regions
@@ -76,24 +212,22 @@ async def list_regions():
     :return:
     JSON
     """
-    regions_df = await list_regions_in_cache()
-    return Response(regions_df.to_json(orient='records'), media_type="application/json")
+    return encoded_table_response(get_encoded_table('regions'), request)
 
 
 @app.get('/list_generation_types')
-async def list_generation_types():
+async def list_generation_types(request: Request):
     """
     List the types of electricity generation, including the names and codes needed for running calculation queries
 
     :return:
     JSON
     """
-    generation_types_df = await list_generation_types_in_cache()
-    return Response(generation_types_df.to_json(orient='records'), media_type="application/json")
+    return encoded_table_response(get_encoded_table('generation_types'), request)
 
 
 @app.get('/list_generation_type_mappings')
-async def list_generation_type_mappings():
+async def list_generation_type_mappings(request: Request):
     """
     Lists the original names for different electricity generation types from the different data sources. This is provided for transparency and fact-checking.
     Original data sources include ENTSO-E and the UNECE report “Life Cycle Assessment of Electricity Generation Options | UNECE.” Accessed December 5, 2023. https://unece.org/sed/documents/2021/10/reports/life-cycle-assessment-electricity-generation-options.
@@ -101,8 +235,7 @@ async def list_generation_type_mappings():
     :return:
     JSON
     """
-    generation_type_mappings_df = await list_generation_type_mappings_in_cache()
-    return Response(generation_type_mappings_df.to_json(orient='records'), media_type="application/json")
+    return encoded_table_response(get_encoded_table('generation_type_mappings'), request)
 
 
 @app.get("/available_data_region",response_model=DataAvailabilityResponse)
@@ -115,7 +248,7 @@ async def availability_regions(date_start: Optional[str] = None, date_end: Optio
         listed with null start and end datestamp, and data point count = 0
 
         :param date_start: Start date in the format yyyy-mm-dd. If None, then will return information on the earliest, last and count of data points for the region stored over all time in the database.
-        :param date_end:  End date of the period to search in the format yyyy-mm-dd. If None and date_start is a datestamp, then will be set to date_start+1day
+        :param date_end:  End date of the period to search in the format yyyy-mm-dd, excluded from the period. If None and date_start is a datestamp, then will be set to date_start+1day
         :param max_rows: Maximum number of rows to return. By default = 1000. Maximum is 100000
 
         :return:
@@ -126,64 +259,113 @@ async def availability_regions(date_start: Optional[str] = None, date_end: Optio
 
 
 @app.get("/datapoints_count_by_day")
-async def datapoints_count_by_day(region_code: Optional[str]):
+async def datapoints_count_by_day(request: Request, region_code: Optional[str] = None, page_size: Optional[int] = None,
+                                  cursor: Optional[str] = None):
     """
         Get info on the count of generation datapoints per day per region. Returns JSON with keys Datestamp (in the form YYYY-MM-DD), RegionId, CountDataPoints
 
+        Send `Accept: application/x-ndjson` to stream the result as newline-delimited JSON
+
+        Give a page_size (up to 10000 rows) to get the result page by page, ordered by RegionId and Datestamp. Each page
+        but the last has an `X-Next-Cursor` header: pass its value as cursor, with the same region_code, to get the next
+        page
+
         :param region_code: Optional[str]. A region code to filter on. If None, searches across all regions. Must be an short name in string value form, like `FR`
 
         :return:
         """
 
+    if page_size is not None or cursor is not None:
+        try:
+            datapoint_counts_df, next_cursor = await get_datapoints_per_day_page(engine, region_code=region_code,
+                                                                                 page_size=page_size, cursor=cursor)
+        except TypeError as e:
+            return Response(status_code=400, content=str(e))
+        except ValueError as e:
+            return Response(status_code=422, content=str(e))
+        return add_next_page_headers(frame_response(datapoint_counts_df, request), request, next_cursor)
+    if wants_ndjson(request):
+        return ndjson_response(stream_datapoints_per_day_frames(engine, region_code=region_code))
     datapoint_counts_df = await get_datapoints_per_day(engine, region_code=region_code)
     return Response(datapoint_counts_df.to_json(orient='records',date_format='iso'), media_type="application/json")
 
 
 @app.get('/list_impact_categories')
-async def list_impact_categories():
+async def list_impact_categories(request: Request):
     """
     List the environmental impacts that can be calculated via the API
 
-    WARNING: This operation may take some time to return
-
     :return:
     JSON
     """
-
-    impact_categories_df = await list_impact_categories_df_in_cache()
-    return Response(impact_categories_df.to_json(orient='records'), media_type="application/json")
+    return encoded_table_response(get_encoded_table('impact_categories'), request)
 
 
 @app.get('/generation', response_model=List[GenerationResponseModel])
-async def get_electricity_generation(date_start: str, region_code: str, date_end: Optional[str] = None,
-                                     generation_type_id: Optional[int] = None):
+async def get_electricity_generation(request: Request, date_start: str, region_code: str, date_end: Optional[str] = None,
+                                     generation_type_id: Optional[int] = None, resolution: Optional[str] = None,
+                                     page_size: Optional[int] = None, cursor: Optional[str] = None):
     """
     Get the electricity generation on a given time period (e.g. 2024-02-01 to 2024-02-02) for a given region (e.g. NL or FR) and optionally an
     electricity regions type (e.g. 4 for fossil gas)
 
+    Optionally a resolution (one of raw, hour, 4hours, 6hours, day, month) can be given. Otherwise long periods are
+    downsampled to the finest resolution that fits in the response, taking the median of each time bucket
+
+    Send `Accept: application/x-ndjson` to stream the result as newline-delimited JSON. Streamed responses have no size
+    limit and default to the raw resolution. Send `Accept: application/vnd.apache.arrow.stream`, `application/parquet`
+    or `text/csv` to get the result in a columnar format, compressed with gzip or zstd if accepted
+
+    Give a page_size (up to 10000 rows) to get the result page by page, without size limit and at the raw resolution
+    by default. Each page but the last has an `X-Next-Cursor` header: pass its value as cursor, with the same other
+    parameters, to get the next page (the `Link` header has the URL of the next page)
+
     :return:
     JSON
     """
+    cache_key = result_cache_key(request, region_code, date_start, date_end, generation_type_id=generation_type_id,
+                                 resolution=resolution, page_size=page_size, cursor=cursor)
     try:
-        df = await get_electricity_generation_df(date_start, region_code=region_code, engine=engine,
-                                                 generation_type_id=generation_type_id, date_end=date_end)
+        if page_size is not None or cursor is not None:
+            cached_response = result_cache.get(cache_key)
+            if cached_response is not None:
+                return cached_response
+            cache_generation = result_cache.generation(cache_key)
+            df, next_cursor = await get_electricity_generation_page(
+                date_start, region_code=region_code, engine=engine, generation_type_id=generation_type_id,
+                date_end=date_end, resolution=resolution, page_size=page_size, cursor=cursor)
+            response = add_next_page_headers(frame_response(df, request, json_media_type="application/json"), request,
+                                             next_cursor)
+            result_cache.put(cache_key, response, cache_generation)
+            return response
+        if wants_ndjson(request):
+            return ndjson_response(stream_electricity_generation_frames(
+                date_start, region_code=region_code, engine=engine, generation_type_id=generation_type_id,
+                date_end=date_end, resolution=resolution))
+        cached_response = result_cache.get(cache_key)
+        if cached_response is not None:
+            return cached_response
+        return await request_coalescer.run(cache_key, functools.partial(
+            _computed_frame_response, request, cache_key,
+            functools.partial(get_electricity_generation_df, date_start, region_code=region_code, engine=engine,
+                              generation_type_id=generation_type_id, date_end=date_end, resolution=resolution),
+            json_media_type="application/json"))
     except TypeError as e:
         return Response(status_code=400, content=str(e))
     except ValueError as e:
         return Response(status_code=422, content=str(e))
     except ServerError as e:
         return Response(status_code=500, content=str(e))
-    if not isinstance(df, pd.DataFrame):
-        return Response(status_code=500)
-    return Response(df.to_json(orient='records',date_format='iso'), media_type="application/json")
 
 
 @app.get('/calculate', response_model=List[ImpactResultSchema])
-async def calculate_impact(date_start: str, region_code: str, impact_category_id: int, date_end: str = None) -> Any:
+async def calculate_impact(request: Request, date_start: str, region_code: str, impact_category_id: int,
+                           date_end: str = None, resolution: Optional[str] = None) -> Any:
     """
     Get environmental impacts of electricity generation on given date (e.g. 2024-02-01) for a given region (e.g. NL or FR) and an electricity regions type (e.g. 4 for fossil gas)
 
-    By default date_end will be date_start + 1 day if left None
+    By default date_end will be date_start + 1 day if left None. The resolution parameter and the response formats
+    chosen with the Accept header work as for /generation
 
     :return
     ImpactResultSchema
@@ -193,9 +375,112 @@ async def calculate_impact(date_start: str, region_code: str, impact_category_id
         start_datetime = datetime.strptime(date_start, '%Y-%m-%d')
         end_datetime = start_datetime + timedelta(days=1)
         date_end = end_datetime.strftime('%Y-%m-%d')
+    cache_key = result_cache_key(request, region_code, date_start, date_end, impact_category_id=impact_category_id,
+                                 resolution=resolution)
+    try:
+        if wants_ndjson(request):
+            return ndjson_response(stream_impact_frames(date_start, date_end, region_code, engine=engine,
+                                                        impact_category_ids=[impact_category_id],
+                                                        resolution=resolution))
+        cached_response = result_cache.get(cache_key)
+        if cached_response is not None:
+            return cached_response
+        return await request_coalescer.run(cache_key, functools.partial(
+            _computed_frame_response, request, cache_key,
+            functools.partial(calculate_impact_df, date_start, date_end, region_code,
+                              impact_category_id=impact_category_id, engine=engine, resolution=resolution),
+            json_media_type='text/json'))
+    except NoDataAvailableError as exc:
+        return Response(status_code=400, content=json.dumps({'response': 400, 'error_info': exc.message}), media_type='text/json')
+    except TypeError as e:
+        return Response(status_code=400, content=str(e))
+    except ValueError as e:
+        return Response(status_code=422, content=str(e))
+    except ServerError as e:
+        return Response(status_code=500, content=str(e))
+
+
+@app.get('/calculate_all', response_model=List[ImpactResultSchema])
+async def calculate_all_impacts(request: Request, date_start: str, region_code: str, date_end: str = None,
+                                resolution: Optional[str] = None) -> Any:
+    """
+    Get the environmental impacts of electricity generation on given date (e.g. 2024-02-01) for a given region (e.g. NL or FR) for every impact category at once.
+    Equivalent to calling /calculate once per impact category, with one row per generation data point and impact category
+
+    By default date_end will be date_start + 1 day if left None. The resolution parameter and the response formats
+    chosen with the Accept header work as for /generation
+
+    :return
+    ImpactResultSchema
+    """
+    assert isinstance(date_start, str)
+    if date_end is None:
+        start_datetime = datetime.strptime(date_start, '%Y-%m-%d')
+        end_datetime = start_datetime + timedelta(days=1)
+        date_end = end_datetime.strftime('%Y-%m-%d')
+    cache_key = result_cache_key(request, region_code, date_start, date_end, resolution=resolution)
+    try:
+        if wants_ndjson(request):
+            return ndjson_response(stream_impact_frames(date_start, date_end, region_code, engine=engine,
+                                                        resolution=resolution))
+        cached_response = result_cache.get(cache_key)
+        if cached_response is not None:
+            return cached_response
+        return await request_coalescer.run(cache_key, functools.partial(
+            _computed_frame_response, request, cache_key,
+            functools.partial(calculate_all_impacts_df, date_start, date_end, region_code, engine=engine,
+                              resolution=resolution),
+            json_media_type='text/json'))
+    except NoDataAvailableError as exc:
+        return Response(status_code=400, content=json.dumps({'response': 400, 'error_info': exc.message}), media_type='text/json')
+    except TypeError as e:
+        return Response(status_code=400, content=str(e))
+    except ValueError as e:
+        return Response(status_code=422, content=str(e))
+    except ServerError as e:
+        return Response(status_code=500, content=str(e))
+
+
+async def _computed_frame_response(request: Request, cache_key: Optional[ResultCacheKey],
+                                  compute_df: Callable[[], Awaitable[CompactResult]],
+                                  json_media_type: str) -> Response:
+    """
+    Compute the result of a /generation or /calculate request, encode it in the format asked for and cache the
+    response. Identical requests arriving meanwhile share this response (see coalescing)
+    """
+    # Read before computing, so that the response is not cached if the rows it was computed from were rewritten since
+    cache_generation = result_cache.generation(cache_key)
+    result = await compute_df()
+    if not isinstance(result, CompactResult):
+        return Response(status_code=500)
+    response = frame_response(result, request, json_media_type=json_media_type)
+    result_cache.put(cache_key, response, cache_generation)
+    return response
+
+
+@app.post('/calculate_batch', response_model=Dict[str, List[ImpactResultSchema]])
+async def calculate_batch_impacts(request: Request, batch: BatchCalculationRequest) -> Any:
+    """
+    Get the environmental impacts of electricity generation of several regions (e.g. FR, NL, DE_LU) for several impact
+    categories on the same period, in one call. Returns a JSON object with the results of each region, in the format of
+    /calculate. If impact_category_ids is left None, every impact category is calculated
+
+    By default date_end will be date_start + 1 day if left None. The resolution parameter and the response formats
+    chosen with the Accept header work as for /generation, except NDJSON. Columnar formats return one table with the
+    RegionCode column
+
+    :return
+    Dict[str, List[ImpactResultSchema]]
+    """
     try:
-        impact_df = await calculate_impact_df(date_start, date_end, region_code, impact_category_id=impact_category_id,
-                                              engine=engine)
+        date_end = batch.date_end
+        if date_end is None:
+            start_datetime = datetime.strptime(batch.date_start, '%Y-%m-%d')
+            end_datetime = start_datetime + timedelta(days=1)
+            date_end = end_datetime.strftime('%Y-%m-%d')
+        impact_df = await calculate_batch_impacts_df(batch.date_start, date_end, batch.region_codes, engine=engine,
+                                                     impact_category_ids=batch.impact_category_ids,
+                                                     resolution=batch.resolution)
     except NoDataAvailableError as exc:
         return Response(status_code=400, content=json.dumps({'response': 400, 'error_info': exc.message}), media_type='text/json')
     except TypeError as e:
@@ -204,11 +489,111 @@ async def calculate_impact(date_start: str, region_code: str, impact_category_id
         return Response(status_code=422, content=str(e))
     except ServerError as e:
         return Response(status_code=500, content=str(e))
-    if not isinstance(impact_df, pd.DataFrame):
+    if not isinstance(impact_df, CompactResult):
         return Response(status_code=500)
-    return Response(impact_df.to_json(orient='records', date_format='iso'), media_type='text/json')
+    return grouped_frame_response(impact_df, request, 'RegionCode', list(dict.fromkeys(batch.region_codes)),
+                                  json_media_type='text/json')
+
+
+@app.get('/admin/result_cache', dependencies=ADMIN_DEPENDENCIES)
+async def result_cache_stats():
+    """
+    Get the size and the hit, miss, eviction, expiration and invalidation counters of the cache of /generation and
+    /calculate responses
+
+    :return:
+    JSON
+    """
+    return result_cache.stats()
+
+
+@app.delete('/admin/result_cache', dependencies=ADMIN_DEPENDENCIES)
+async def clear_result_cache():
+    """Empty the cache of /generation and /calculate responses"""
+    result_cache.clear()
+    return result_cache.stats()
+
+
+@app.get('/admin/coalescing', dependencies=ADMIN_DEPENDENCIES)
+async def coalescing_stats():
+    """
+    Get the number of /generation and /calculate requests that computed their response and of identical requests that
+    shared it while it was computed, and the share of the latter (coalescing ratio)
+
+    :return:
+    JSON
+    """
+    return request_coalescer.stats()
+
+
+@app.get('/admin/slow_queries', dependencies=ADMIN_DEPENDENCIES)
+async def slow_queries():
+    """
+    Get the SQL statements slower than ELEC_LCA_SLOW_QUERY_MS, most recent first, with their normalized SQL, the types
+    of their parameters and the EXPLAIN (ANALYZE, BUFFERS) plan of the SELECT statements. Empty unless enabled
+
+    :return:
+    JSON
+    """
+    return {**slow_query_log.stats(), 'queries': slow_query_log.entries()}
+
+
+@app.delete('/admin/slow_queries', dependencies=ADMIN_DEPENDENCIES)
+async def clear_slow_queries():
+    """Empty the log of slow SQL statements"""
+    slow_query_log.clear()
+    return slow_query_log.stats()
+
+
+@app.get('/admin/tile_store', dependencies=ADMIN_DEPENDENCIES)
+async def tile_store_status():
+    """
+    Get the number and total size of the tiles of historical generation data stored on the local disk
+
+    :return:
+    JSON
+    """
+    return await run_in_db_executor(tile_store_stats)
+
+
+@app.delete('/admin/tile_store', dependencies=ADMIN_DEPENDENCIES)
+async def clear_tile_store():
+    """Delete the tiles of historical generation data. They are read from the database again when next requested"""
+    await run_in_db_executor(clear_tiles)
+    return await run_in_db_executor(tile_store_stats)
+
+
+@app.get('/admin/reference_data', dependencies=ADMIN_DEPENDENCIES)
+async def reference_data_status():
+    """
+    Get when the cached reference data (regions, generation types, impact categories and factors) was loaded from the
+    database, how long the load took, and the error of the last reload if it failed
+
+    :return:
+    JSON
+    """
+    return cache_status()
+
+
+@app.post('/admin/reference_data/refresh', dependencies=ADMIN_DEPENDENCIES)
+async def refresh_reference_data():
+    """
+    Reload the cached reference data from the database now. The previous data is served until the reload is done. With
+    ELEC_LCA_SHARED_CACHE_DIR set, only the writer worker reads the database: on another worker, the writer is asked to
+    reload it and this returns straight away with `refresh_requested_from_writer` true. Every worker then reads the
+    snapshot the writer publishes within ELEC_LCA_SHARED_CACHE_POLL_INTERVAL seconds
+    """
+    if request_refresh_from_writer():
+        return {**cache_status(), 'refresh_requested_from_writer': True}
+    try:
+        await run_in_db_executor(refresh_cache, engine)
+    except Exception as e:
+        return Response(status_code=500, content=f'Could not reload the reference data: {e}')
+    return {**cache_status(), 'refresh_requested_from_writer': False}
 
 
 if __name__ == '__main__':
+    import uvicorn
+
     logging.basicConfig(level=logging.DEBUG, filename='api.log')
     uvicorn.run(app, port=API_PORT)
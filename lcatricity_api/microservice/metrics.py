@@ -0,0 +1,140 @@
+"""
+Prometheus metrics of the API, served on /metrics, and per-request stage timings.
+
+The hot path records its stages (region lookup, choice of the resolution, generation SQL, impact calculation, response
+encoding) with timed_stage. MetricsMiddleware collects the stages of each request: they are observed in the per
+endpoint stage histogram and sent back in the Server-Timing response header, e.g.
+`Server-Timing: region_lookup;dur=0.1, generation_sql;dur=35.2, encode;dur=4.0, total;dur=41.0` (milliseconds).
+Streamed responses send their headers before the data is read, so their Server-Timing only has the stages done by then.
+
+Metrics are kept per process: with several uvicorn workers, each worker is scraped separately.
+"""
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional, List, Tuple
+
+import sqlalchemy
+from prometheus_client import Histogram, Counter, Gauge, generate_latest, CONTENT_TYPE_LATEST
+from sqlalchemy import Select
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+REQUEST_LATENCY = Histogram('lcatricity_request_duration_seconds', 'Time to send the response headers, per endpoint',
+                            ['endpoint', 'method', 'status'], buckets=LATENCY_BUCKETS)
+STAGE_LATENCY = Histogram('lcatricity_stage_duration_seconds', 'Time spent in each stage of a request, per endpoint',
+                          ['endpoint', 'stage'], buckets=LATENCY_BUCKETS)
+RESPONSE_BYTES = Histogram('lcatricity_response_bytes', 'Size of the response bodies sent, per endpoint', ['endpoint'],
+                           buckets=(256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216))
+ROWS_FETCHED = Histogram('lcatricity_query_rows', 'Rows returned by the database per query, per source table',
+                         ['source'], buckets=(0, 1, 10, 100, 1000, 10000, 100000, 1000000))
+QUERY_ATTEMPTS = Counter('lcatricity_query_attempts_total',
+                         'Reads of a source table, with outcome rows, empty (falling back to the next source) or error',
+                         ['source', 'outcome'])
+TILE_REQUESTS = Counter('lcatricity_tile_requests_total',
+                        'Months of generation data read from the tile store (hit) or from the database into it (miss)',
+                        ['outcome'])
+COALESCED_REQUESTS = Counter('lcatricity_coalesced_requests_total',
+                             'Requests that computed their response (leader) or shared the response of an identical '
+                             'request in flight (follower)', ['endpoint', 'role'])
+DB_POOL_WAIT = Histogram('lcatricity_db_pool_wait_seconds',
+                         'Time blocking database calls wait for a worker of the database thread pool. The pool is '
+                         'sized to the connection pool, so this is the wait for a pooled connection',
+                         buckets=LATENCY_BUCKETS)
+DB_POOL_CHECKED_OUT = Gauge('lcatricity_db_pool_checked_out', 'Connections of the pool currently in use')
+
+_stage_timings: ContextVar[Optional[List[Tuple[str, float]]]] = ContextVar('lcatricity_stage_timings', default=None)
+
+
+@contextmanager
+def timed_stage(name: str):
+    """Record the time spent in the with block as a stage of the current request. Does nothing outside a request"""
+    s = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings = _stage_timings.get()
+        if timings is not None:
+            timings.append((name, time.perf_counter() - s))
+
+
+def statement_source(statement: Select) -> str:
+    """Name of the table a statement reads from, for the metric labels. For a join, the table joined last"""
+    source = statement.get_final_froms()[0]
+    source = getattr(source, 'right', source)
+    return getattr(source, 'name', 'unknown')
+
+
+def record_query(statement: Select, n_rows: Optional[int]):
+    """Count a read of a source table and its number of rows. n_rows is None if the read failed"""
+    source = statement_source(statement)
+    if n_rows is None:
+        QUERY_ATTEMPTS.labels(source, 'error').inc()
+        return
+    QUERY_ATTEMPTS.labels(source, 'rows' if n_rows else 'empty').inc()
+    ROWS_FETCHED.labels(source).observe(n_rows)
+
+
+def instrument_engine(engine: sqlalchemy.Engine):
+    """Report the connections in use of the engine's pool"""
+    DB_POOL_CHECKED_OUT.set_function(lambda: engine.pool.checkedout())
+
+
+def metrics_response_body() -> Tuple[bytes, str]:
+    """The metrics in the Prometheus text format, and its media type"""
+    return generate_latest(), CONTENT_TYPE_LATEST
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware timing every HTTP request, counting the response bytes and adding the Server-Timing header.
+    Requests are labelled with the path of the route that served them (e.g. /generation), or `unmatched`
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        timings = []
+        token = _stage_timings.set(timings)
+        s = time.perf_counter()
+        response_bytes = 0
+
+        async def send_with_metrics(message):
+            nonlocal response_bytes
+            if message['type'] == 'http.response.start':
+                elapsed = time.perf_counter() - s
+                endpoint = _endpoint(scope)
+                stages = _sum_stages(timings)
+                for stage, seconds in stages.items():
+                    STAGE_LATENCY.labels(endpoint, stage).observe(seconds)
+                REQUEST_LATENCY.labels(endpoint, scope['method'], str(message['status'])).observe(elapsed)
+                server_timing = ', '.join([f'{stage};dur={seconds * 1000:.1f}' for stage, seconds in stages.items()]
+                                          + [f'total;dur={elapsed * 1000:.1f}'])
+                message['headers'] = list(message.get('headers', [])) + [(b'server-timing', server_timing.encode())]
+            elif message['type'] == 'http.response.body':
+                response_bytes += len(message.get('body', b''))
+                if not message.get('more_body', False):
+                    RESPONSE_BYTES.labels(_endpoint(scope)).observe(response_bytes)
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_metrics)
+        finally:
+            _stage_timings.reset(token)
+
+
+def _endpoint(scope) -> str:
+    route = scope.get('route')
+    return getattr(route, 'path', 'unmatched')
+
+
+def _sum_stages(timings: List[Tuple[str, float]]) -> dict:
+    """Total time of each stage, in the order they first ran. A stage can run more than once, e.g. per region"""
+    stages = {}
+    for stage, seconds in timings:
+        stages[stage] = stages.get(stage, 0.0) + seconds
+    return stages
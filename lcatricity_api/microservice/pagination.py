@@ -0,0 +1,68 @@
+"""
+Keyset pagination: a page is read with `WHERE (sort key) > (last key of the previous page) ORDER BY sort key LIMIT n`,
+so each page costs the same whatever its position, unlike OFFSET which scans every row before the page.
+
+The continuation token given to the client is opaque: base64url JSON with the last key, the index of the source table
+the first page was read from (so every page comes from the same source), and a fingerprint of the query parameters,
+so a token cannot be replayed with other parameters.
+"""
+import base64
+import binascii
+import hashlib
+import json
+from typing import Optional, Tuple, List
+
+from fastapi import Request, Response
+
+DEFAULT_PAGE_SIZE = 1000
+MAX_PAGE_SIZE = 10000
+NEXT_CURSOR_HEADER = 'X-Next-Cursor'
+
+
+def validate_page_size(page_size: Optional[int]) -> int:
+    """The page size to use, DEFAULT_PAGE_SIZE if None. Raises a ValueError if not between 1 and MAX_PAGE_SIZE"""
+    if page_size is None:
+        return DEFAULT_PAGE_SIZE
+    if not 1 <= page_size <= MAX_PAGE_SIZE:
+        raise ValueError(f'Invalid page size `{page_size}`. Page size must be between 1 and {MAX_PAGE_SIZE}')
+    return page_size
+
+
+def query_fingerprint(*params) -> str:
+    """Fingerprint of the parameters of a paginated query, stored in its continuation tokens"""
+    return hashlib.sha256(json.dumps(params, default=str).encode()).hexdigest()[:16]
+
+
+def encode_cursor(key: List, source: int, fingerprint: str) -> str:
+    """
+    Continuation token of the page after the row with the given sort key
+
+    :param key: Sort key of the last row of the page, as JSON serializable values
+    :param source: Index of the statement the page was read from
+    :param fingerprint: query_fingerprint of the query
+    """
+    payload = json.dumps({'k': key, 's': source, 'q': fingerprint}, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(payload).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str, fingerprint: str) -> Tuple[List, int]:
+    """
+    The sort key and the source index of a continuation token. Raises a ValueError if the token is invalid or was
+    issued for a query with other parameters
+    """
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        key, source, cursor_fingerprint = payload['k'], int(payload['s']), payload['q']
+    except (binascii.Error, UnicodeDecodeError, json.JSONDecodeError, KeyError, TypeError, ValueError):
+        raise ValueError('Invalid cursor. Use the cursor returned with the previous page')
+    if cursor_fingerprint != fingerprint:
+        raise ValueError('The cursor was returned for other query parameters. Repeat the parameters of the first page')
+    return key, source
+
+
+def add_next_page_headers(response: Response, request: Request, next_cursor: Optional[str]) -> Response:
+    """Add the continuation token and the URL of the next page (Link header) to a page, unless it is the last one"""
+    if next_cursor is not None:
+        response.headers[NEXT_CURSOR_HEADER] = next_cursor
+        response.headers['Link'] = f'<{request.url.include_query_params(cursor=next_cursor)}>; rel="next"'
+    return response
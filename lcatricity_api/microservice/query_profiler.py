@@ -0,0 +1,176 @@
+"""
+Opt-in capture of slow SQL statements, enabled by setting ELEC_LCA_SLOW_QUERY_MS.
+
+Every statement run by the engine is timed with the before/after_cursor_execute events. Statements slower than the
+threshold are recorded in a bounded ring buffer (the oldest are dropped first) with their normalized SQL, the types of
+their bound parameters and, for SELECT statements, an `EXPLAIN (ANALYZE, BUFFERS)` plan. As EXPLAIN ANALYZE runs the
+statement again, plans are collected on a background thread with a connection of its own, one at a time, and not twice
+for the same normalized SQL while one is pending. Statements that write are never explained.
+"""
+import logging
+import os
+import re
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field, asdict
+from datetime import datetime, timezone
+from typing import Optional, Dict, Union, List
+
+import sqlalchemy
+from dotenv import load_dotenv
+from sqlalchemy import event
+
+load_dotenv()
+
+# Statements taking longer than this (in milliseconds) are recorded. 0 disables the profiling
+SLOW_QUERY_THRESHOLD_MS = float(os.getenv('ELEC_LCA_SLOW_QUERY_MS', '0'))
+# Number of slow statements kept
+SLOW_QUERY_BUFFER_SIZE = int(os.getenv('ELEC_LCA_SLOW_QUERY_BUFFER_SIZE', '100'))
+# Whether to collect the EXPLAIN (ANALYZE, BUFFERS) plan of the slow SELECT statements
+SLOW_QUERY_EXPLAIN = os.getenv('ELEC_LCA_SLOW_QUERY_EXPLAIN', 'true').lower() in ('1', 'true', 'yes')
+
+_START_TIMES_KEY = 'lcatricity_query_start_times'
+_IN_LIST = re.compile(r'%\((\w+?)_\d+\)s(?:, %\(\w+?_\d+\)s)+')
+_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_LITERAL = re.compile(r'(?<![\w"%.])\d+(?:\.\d+)?\b')
+_WHITESPACE = re.compile(r'\s+')
+
+
+@dataclass
+class SlowQuery:
+    sql: str
+    parameter_types: Union[Dict[str, str], List[str]]
+    duration_ms: float
+    recorded_at: datetime
+    plan: Optional[str] = None
+    # Why there is no plan: `pending`, `disabled`, `not a SELECT`, `executemany`, `already pending` or the EXPLAIN error
+    plan_status: str = 'pending'
+
+
+@dataclass
+class SlowQueryLog:
+    threshold_ms: float = SLOW_QUERY_THRESHOLD_MS
+    explain: bool = SLOW_QUERY_EXPLAIN
+    recorded: int = 0
+    _entries: deque = field(default_factory=lambda: deque(maxlen=SLOW_QUERY_BUFFER_SIZE))
+    _pending_explains: set = field(default_factory=set)
+    _lock: threading.Lock = field(default_factory=threading.Lock)
+
+    def add(self, entry: SlowQuery):
+        with self._lock:
+            self._entries.append(entry)
+            self.recorded += 1
+
+    def entries(self) -> List[dict]:
+        """The slow statements kept, most recent first"""
+        with self._lock:
+            return [asdict(entry) for entry in reversed(self._entries)]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'enabled': _profiled_engine is not None, 'threshold_ms': self.threshold_ms,
+                    'explain': self.explain, 'recorded': self.recorded, 'kept': len(self._entries),
+                    'max_kept': self._entries.maxlen}
+
+
+slow_query_log = SlowQueryLog()
+_explain_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='lcatricity-explain')
+_profiled_engine = None
+
+
+def enable_query_profiling(engine: sqlalchemy.Engine, threshold_ms: float = SLOW_QUERY_THRESHOLD_MS):
+    """
+    Time every statement run by the engine and record those slower than threshold_ms in slow_query_log. Can only be
+    enabled for one engine per process
+    """
+    global _profiled_engine
+    if _profiled_engine is not None:
+        return
+    _profiled_engine = engine
+    slow_query_log.threshold_ms = threshold_ms
+    event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+    logging.info(f'Recording the SQL statements slower than {threshold_ms} ms')
+
+
+def normalize_sql(statement: str) -> str:
+    """SQL with the literals replaced by ?, expanded IN lists collapsed to one parameter and whitespace collapsed"""
+    statement = _STRING_LITERAL.sub('?', statement)
+    statement = _NUMBER_LITERAL.sub('?', statement)
+    statement = _IN_LIST.sub(r'%(\1_n)s', statement)
+    return _WHITESPACE.sub(' ', statement).strip()
+
+
+def parameter_types(parameters) -> Union[Dict[str, str], List[str]]:
+    """The type names of the bound parameters, e.g. {'RegionId_1': 'int', 'DateStamp_1': 'datetime'}"""
+    if isinstance(parameters, dict):
+        return {name: type(value).__name__ for name, value in parameters.items()}
+    if isinstance(parameters, (list, tuple)):
+        return [type(value).__name__ for value in parameters]
+    return []
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault(_START_TIMES_KEY, []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    start_times = conn.info.get(_START_TIMES_KEY)
+    if not start_times:
+        return
+    duration_ms = (time.perf_counter() - start_times.pop()) * 1000
+    if duration_ms < slow_query_log.threshold_ms:
+        return
+    sql = normalize_sql(statement)
+    entry = SlowQuery(sql=sql,
+                      parameter_types=parameter_types(parameters[0] if executemany and parameters else parameters),
+                      duration_ms=duration_ms, recorded_at=datetime.now(timezone.utc).replace(tzinfo=None))
+    entry.plan_status = _submit_explain(entry, statement, parameters, executemany)
+    slow_query_log.add(entry)
+
+
+def _submit_explain(entry: SlowQuery, statement: str, parameters, executemany: bool) -> str:
+    if not slow_query_log.explain:
+        return 'disabled'
+    if executemany:
+        return 'executemany'
+    if not statement.lstrip().upper().startswith(('SELECT', 'WITH')) or _writes(statement):
+        return 'not a SELECT'
+    with slow_query_log._lock:
+        if entry.sql in slow_query_log._pending_explains:
+            return 'already pending'
+        slow_query_log._pending_explains.add(entry.sql)
+    _explain_executor.submit(_explain, entry, statement, parameters)
+    return 'pending'
+
+
+def _writes(statement: str) -> bool:
+    """Whether a WITH statement contains a data-modifying clause"""
+    return re.search(r'\b(INSERT|UPDATE|DELETE|MERGE)\b', statement, re.IGNORECASE) is not None
+
+
+def _explain(entry: SlowQuery, statement: str, parameters):
+    """Run on the explain thread. Uses a raw DBAPI connection, so the EXPLAIN is not itself profiled"""
+    try:
+        connection = _profiled_engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            cursor.execute(f'EXPLAIN (ANALYZE, BUFFERS) {statement}', parameters)
+            entry.plan = '\n'.join(row[0] for row in cursor.fetchall())
+            cursor.close()
+            entry.plan_status = 'done'
+        finally:
+            connection.rollback()
+            connection.close()
+    except Exception as e:
+        logging.warning(f'Could not EXPLAIN the slow statement `{entry.sql}`: {e}')
+        entry.plan_status = f'error: {e}'
+    finally:
+        with slow_query_log._lock:
+            slow_query_log._pending_explains.discard(entry.sql)
@@ -0,0 +1,93 @@
+import math
+from datetime import datetime, timedelta
+from typing import Optional
+
+from sqlalchemy import func, literal_column, cast, Integer
+
+# Time bucket of each resolution, from the finest to the coarsest. `raw` returns the data points as stored
+RESOLUTIONS = {
+    'raw': None,
+    'hour': timedelta(hours=1),
+    '4hours': timedelta(hours=4),
+    '6hours': timedelta(hours=6),
+    'day': timedelta(days=1),
+    'month': timedelta(days=31),
+}
+# Finest interval at which generation data is reported (ENTSO-E reports some regions every 15 minutes). Used as an
+# upper bound of the number of raw data points in a period
+NATIVE_INTERVAL = timedelta(minutes=15)
+
+
+def validate_resolution(resolution: Optional[str]) -> Optional[str]:
+    """Check the resolution is None or one of RESOLUTIONS, raising a ValueError otherwise"""
+    if resolution is not None and resolution not in RESOLUTIONS:
+        raise ValueError(f'Invalid resolution `{resolution}`. Resolution must be one of {list(RESOLUTIONS)}')
+    return resolution
+
+
+def estimate_row_count(date_start: datetime, date_end: datetime, resolution: str, n_series: int) -> int:
+    """
+    Cheap upper bound of the number of rows returned for a period, without querying the database
+
+    :param date_start: Start of the period
+    :param date_end: End of the period (inclusive)
+    :param resolution: One of RESOLUTIONS
+    :param n_series: Number of generation time series (e.g. generation types) returned
+    :return: int
+    """
+    interval = RESOLUTIONS[resolution] or NATIVE_INTERVAL
+    return (math.ceil((date_end - date_start) / interval) + 1) * n_series
+
+
+def choose_resolution(date_start: datetime, date_end: datetime, n_series: int, max_datapoints: int,
+                      resolution: Optional[str] = None) -> str:
+    """
+    Choose the resolution to return a period at: the resolution requested, or else the finest resolution whose row
+    count estimate fits in max_datapoints
+
+    :return: One of RESOLUTIONS
+    """
+    if validate_resolution(resolution) is not None:
+        return resolution
+    for candidate in RESOLUTIONS:
+        if estimate_row_count(date_start, date_end, candidate, n_series) <= max_datapoints:
+            return candidate
+    raise ValueError(f'Too much data to be returned for the period `{date_start}`-`{date_end}`, even at monthly '
+                     f'resolution. Request a shorter period')
+
+
+def bucket_expression(column, resolution: str):
+    """
+    SQL expression truncating a timestamp column to the start of its time bucket at the given resolution
+
+    :param column: Timestamp column, e.g. ElectricityGeneration.DateStamp
+    :param resolution: One of RESOLUTIONS other than `raw`
+    """
+    if resolution in ('hour', 'day', 'month'):
+        return func.date_trunc(literal_column(f"'{resolution}'"), column)
+    if resolution in ('4hours', '6hours'):
+        hours = int(RESOLUTIONS[resolution] / timedelta(hours=1))
+        hour_of_day = cast(func.extract(literal_column("'hour'"), column), Integer)
+        return (func.date_trunc(literal_column("'hour'"), column)
+                - func.make_interval(0, 0, 0, 0, hour_of_day % literal_column(str(hours))))
+    raise ValueError(f'No time bucket for resolution `{resolution}`')
+
+
+def bucket_start(timestamp: datetime, resolution: str) -> datetime:
+    """Start of the time bucket of a timestamp at the given resolution, as computed in SQL by bucket_expression"""
+    if resolution == 'raw':
+        return timestamp
+    if resolution == 'month':
+        return timestamp.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    if resolution == 'day':
+        return timestamp.replace(hour=0, minute=0, second=0, microsecond=0)
+    hours = int(RESOLUTIONS[resolution] / timedelta(hours=1))
+    return timestamp.replace(hour=timestamp.hour - timestamp.hour % hours, minute=0, second=0, microsecond=0)
+
+
+def next_bucket_start(timestamp: datetime, resolution: str) -> datetime:
+    """Start of the time bucket following the bucket of a timestamp at the given resolution, other than `raw`"""
+    start = bucket_start(timestamp, resolution)
+    if resolution == 'month':
+        return start.replace(year=start.year + start.month // 12, month=start.month % 12 + 1)
+    return start + RESOLUTIONS[resolution]
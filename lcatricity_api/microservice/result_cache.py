@@ -0,0 +1,203 @@
+"""
+In-memory cache of serialized /generation and /calculate responses.
+
+Entries are keyed on the normalized query parameters and the negotiated response format, evicted least recently used
+first when the cache is over its byte budget, and expire after a TTL (longer for periods that ended long ago, which
+are rarely rewritten). When generation data is rewritten (see lcatricity_api.data.notifications), the entries of the
+same region whose period and generation type overlap the write are invalidated. A response computed while a write of
+its region was notified is not cached, as it may have been computed from the rows before the write.
+"""
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+from typing import Optional, Tuple
+
+from dotenv import load_dotenv
+from fastapi import Request, Response
+
+from lcatricity_api.data.notifications import GenerationWritten
+from lcatricity_api.microservice.cache_queries import get_region_id
+from lcatricity_api.microservice.formats import negotiate_media_type
+
+load_dotenv()
+
+# Memory budget of the cached response bodies. 0 disables the cache
+RESULT_CACHE_MAX_BYTES = int(os.getenv('ELEC_LCA_RESULT_CACHE_MAX_BYTES', str(256 * 1024 * 1024)))
+# Seconds a response is cached for, unless its period ended more than RESULT_CACHE_HISTORICAL_AFTER_DAYS days ago
+RESULT_CACHE_TTL = int(os.getenv('ELEC_LCA_RESULT_CACHE_TTL', '300'))
+RESULT_CACHE_HISTORICAL_TTL = int(os.getenv('ELEC_LCA_RESULT_CACHE_HISTORICAL_TTL', '86400'))
+RESULT_CACHE_HISTORICAL_AFTER_DAYS = int(os.getenv('ELEC_LCA_RESULT_CACHE_HISTORICAL_AFTER_DAYS', '7'))
+# Bodies larger than this fraction of the budget are not cached, so one response cannot flush the whole cache
+_MAX_ENTRY_FRACTION = 4
+
+
+@dataclass(frozen=True)
+class ResultCacheKey:
+    path: str
+    region_id: int
+    generation_type_id: Optional[int]
+    start: datetime
+    end: datetime
+    params: Tuple
+    media_type: Optional[str]
+    encodings: Tuple[str, ...]
+
+    def is_invalidated_by(self, written: GenerationWritten) -> bool:
+        """Whether a write of generation data overlaps the region, period and generation type of the key"""
+        return (self.region_id == written.region_id
+                and self.start <= written.end and written.start <= self.end
+                and (written.generation_type_id is None or self.generation_type_id is None
+                     or self.generation_type_id == written.generation_type_id))
+
+
+@dataclass
+class _CachedResponse:
+    body: bytes
+    media_type: Optional[str]
+    headers: dict
+    expires_at: float
+
+
+@dataclass
+class ResultCache:
+    max_bytes: int = RESULT_CACHE_MAX_BYTES
+    size_bytes: int = 0
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    expirations: int = 0
+    invalidations: int = 0
+    # Responses not cached because a write of their region was notified while they were computed
+    stale_puts: int = 0
+    _entries: OrderedDict = field(default_factory=OrderedDict)
+    # Number of clears, and of writes notified per region, to tell whether a response computed meanwhile is stale
+    _clears: int = 0
+    _region_writes: dict = field(default_factory=dict)
+    _lock: threading.Lock = field(default_factory=threading.Lock)
+
+    def get(self, key: Optional[ResultCacheKey]) -> Optional[Response]:
+        """The cached response for the key, or None"""
+        if key is None or self.max_bytes <= 0:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.expires_at <= time.monotonic():
+                self._remove(key)
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        return Response(content=entry.body, media_type=entry.media_type, headers=entry.headers)
+
+    def generation(self, key: Optional[ResultCacheKey]) -> Optional[Tuple[int, int]]:
+        """
+        The invalidation generation of the region of the key, to read before computing a response and pass to put.
+        It changes whenever a write of the region is notified or the cache is cleared
+        """
+        if key is None:
+            return None
+        with self._lock:
+            return self._clears, self._region_writes.get(key.region_id, 0)
+
+    def put(self, key: Optional[ResultCacheKey], response: Response, generation: Optional[Tuple[int, int]] = None):
+        """
+        Cache a successful response under the key, evicting the least recently used entries if over budget
+
+        :param generation: Optional result of generation(key) read before the response was computed. The response is
+            not cached if the region was written to (or the cache cleared) since
+        """
+        if key is None or self.max_bytes <= 0 or response.status_code != 200:
+            return
+        body = bytes(response.body)
+        if len(body) > self.max_bytes // _MAX_ENTRY_FRACTION:
+            return
+        headers = {name: value for name, value in response.headers.items()
+                   if name not in ('content-length', 'content-type')}
+        entry = _CachedResponse(body=body, media_type=response.media_type, headers=headers,
+                                expires_at=time.monotonic() + _ttl(key.end))
+        with self._lock:
+            if generation is not None and generation != (self._clears, self._region_writes.get(key.region_id, 0)):
+                self.stale_puts += 1
+                return
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = entry
+            self.size_bytes += len(body)
+            while self.size_bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self, written: GenerationWritten):
+        """Remove the entries of the region written to whose period and generation type overlap the write"""
+        with self._lock:
+            self._region_writes[written.region_id] = self._region_writes.get(written.region_id, 0) + 1
+            stale_keys = [key for key in self._entries if key.is_invalidated_by(written)]
+            for key in stale_keys:
+                self._remove(key)
+            self.invalidations += len(stale_keys)
+        if stale_keys:
+            logging.debug(f'{len(stale_keys)} cached results invalidated by {written}')
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size_bytes = 0
+            self._clears += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'entries': len(self._entries), 'size_bytes': self.size_bytes, 'max_bytes': self.max_bytes,
+                    'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'expirations': self.expirations, 'invalidations': self.invalidations,
+                    'stale_puts': self.stale_puts}
+
+    def _remove(self, key: ResultCacheKey):
+        entry = self._entries.pop(key)
+        self.size_bytes -= len(entry.body)
+
+
+def _ttl(end: datetime) -> int:
+    if end < datetime.now(timezone.utc).replace(tzinfo=None) - timedelta(days=RESULT_CACHE_HISTORICAL_AFTER_DAYS):
+        return RESULT_CACHE_HISTORICAL_TTL
+    return RESULT_CACHE_TTL
+
+
+def result_cache_key(request: Request, region_code: str, date_start: str, date_end: Optional[str],
+                     generation_type_id: Optional[int] = None, **params) -> Optional[ResultCacheKey]:
+    """
+    Key of a /generation or /calculate request. Returns None if the parameters are invalid, in which case the request
+    is not cached and fails as usual
+
+    :param request: Incoming request, for the path and the Accept and Accept-Encoding headers
+    :param region_code: Region code, e.g. `FR`
+    :param date_start: Start date in the form yyyy-mm-dd
+    :param date_end: End date in the form yyyy-mm-dd, or None for date_start + 1 day
+    :param generation_type_id: Optional generation type the request is restricted to
+    :param params: Other query parameters that change the response, e.g. the impact category and the resolution
+    """
+    try:
+        start = datetime.strptime(date_start, '%Y-%m-%d')
+        end = datetime.strptime(date_end, '%Y-%m-%d') if date_end is not None else start + timedelta(days=1)
+        region_id = get_region_id(region_code)
+    except (ValueError, TypeError):
+        return None
+    accept_encoding = request.headers.get('accept-encoding', '')
+    return ResultCacheKey(path=request.url.path,
+                          region_id=region_id,
+                          generation_type_id=generation_type_id,
+                          start=start,
+                          end=end,
+                          params=tuple(sorted((name, str(value)) for name, value in params.items()
+                                              if value is not None)),
+                          media_type=negotiate_media_type(request),
+                          encodings=tuple(encoding for encoding in ('gzip', 'zstd') if encoding in accept_encoding))
+
+
+result_cache = ResultCache()
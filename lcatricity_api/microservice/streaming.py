@@ -0,0 +1,64 @@
+import logging
+from typing import Iterator, Iterable, Optional, Callable
+
+import pandas as pd
+from fastapi import Request
+from sqlalchemy import Select
+from sqlalchemy.exc import ProgrammingError
+from starlette.responses import StreamingResponse
+
+from lcatricity_api.microservice.db import iterate_in_db_executor
+
+NDJSON_MEDIA_TYPE = 'application/x-ndjson'
+# Number of rows fetched from the server-side cursor and written to the response at a time
+STREAM_CHUNK_SIZE = 10000
+
+
+def wants_ndjson(request: Request) -> bool:
+    """True if the client asked for a streamed newline-delimited JSON response via the Accept header"""
+    return NDJSON_MEDIA_TYPE in request.headers.get('accept', '')
+
+
+def stream_frames(engine, statements: Iterable[Select], chunk_size: int = STREAM_CHUNK_SIZE,
+                  transform: Optional[Callable[[pd.DataFrame], pd.DataFrame]] = None) -> Iterator[pd.DataFrame]:
+    """
+    Read the results of a query in DataFrame chunks through a server-side cursor, so that memory use does not grow with
+    the size of the result.
+
+    Several statements can be given, in order of preference: the first one that returns rows is streamed (e.g. a
+    rollup table, then the raw table if the rollups have not been built)
+
+    :param engine: SQLAlchemy Engine to use
+    :param statements: Statements to try in order
+    :param chunk_size: Number of rows per chunk
+    :param transform: Optional function applied to each chunk
+    :return: Iterator of DataFrames
+    """
+    for statement in statements:
+        rows_read = 0
+        try:
+            with engine.connect().execution_options(stream_results=True, yield_per=chunk_size) as connection:
+                for chunk_df in pd.read_sql(statement, connection, chunksize=chunk_size):
+                    rows_read += chunk_df.shape[0]
+                    yield transform(chunk_df) if transform is not None else chunk_df
+        except ProgrammingError as e:
+            if rows_read:
+                raise
+            logging.warning(f'Could not stream from {statement.get_final_froms()}, trying the next source: {e}')
+            continue
+        if rows_read:
+            return
+
+
+def _ndjson_lines(frames: Iterator[pd.DataFrame]) -> Iterator[bytes]:
+    for frame in frames:
+        if not frame.empty:
+            yield frame.to_json(orient='records', lines=True, date_format='iso').rstrip('\n').encode() + b'\n'
+
+
+def ndjson_response(frames: Iterator[pd.DataFrame]) -> StreamingResponse:
+    """
+    Stream DataFrame chunks as newline-delimited JSON, one record per line. Reading and encoding the chunks runs on the
+    database thread pool. If there is no data, the response body is empty
+    """
+    return StreamingResponse(iterate_in_db_executor(_ndjson_lines(frames)), media_type=NDJSON_MEDIA_TYPE)
@@ -0,0 +1,187 @@
+"""
+Read-through store of historical generation data on local disk, enabled by setting ELEC_LCA_TILE_STORE_DIR.
+
+Generation data of months that ended more than ELEC_LCA_TILE_STORE_MIN_AGE_DAYS days ago rarely changes. The rows of
+such a month are kept as one Arrow IPC file (a tile) per (region, resolution, month), with every generation type, in the
+column types of CompactResult (int32 epoch seconds, small int generation type ids, float64 values), and
+requests whose whole period is in such months are answered from the tiles instead of the database. Each request reads
+the columns of its tiles into its own arrays, which are concatenated and filtered to the period anyway, so nothing is
+kept mapped between requests: the saving is the database query, and the page cache keeps the recent tiles in memory.
+A missing tile is read from the database (the same statements as without the store, over the whole month) and written
+when it is first needed.
+
+Tiles of the months a write to the generation data overlaps are deleted when its notification is received (see
+lcatricity_api.data.notifications and write_listener), on every worker. As a notification can be missed while no
+worker is listening, tiles are also refetched after ELEC_LCA_TILE_STORE_TTL seconds.
+
+A bucket is returned if it starts between the start of the bucket of date_start and date_end, and holds the statistic
+of the whole bucket, as from the rollup tables. Needs the pyarrow dependency.
+"""
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Optional, Callable, List, Dict
+
+import numpy as np
+from dotenv import load_dotenv
+
+from lcatricity_api.data.notifications import GenerationWritten
+from lcatricity_api.microservice.compact_result import CompactResult, generation_result, epoch_seconds
+from lcatricity_api.microservice.metrics import TILE_REQUESTS, timed_stage
+from lcatricity_api.microservice.resolution import bucket_start
+
+load_dotenv()
+
+# Directory of the tiles. Empty to disable the tile store
+TILE_STORE_DIR = os.getenv('ELEC_LCA_TILE_STORE_DIR', '')
+# Months that ended more than this number of days ago are served from tiles
+TILE_STORE_MIN_AGE_DAYS = int(os.getenv('ELEC_LCA_TILE_STORE_MIN_AGE_DAYS', '30'))
+# Seconds after which a tile is read from the database again
+TILE_STORE_TTL = int(os.getenv('ELEC_LCA_TILE_STORE_TTL', str(7 * 86400)))
+
+TILE_COLUMNS = ('DateStamp', 'GenerationTypeId', 'AggregatedGeneration')
+
+# Invalidations seen per region, so that a tile read from the database before a write is not stored after it
+_invalidations = {}
+_invalidations_lock = threading.Lock()
+
+
+def months_of_period(date_start: datetime, date_end: datetime) -> List[datetime]:
+    """Start of each month overlapping the period [date_start, date_end]"""
+    month = date_start.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    months = []
+    while month <= date_end:
+        months.append(month)
+        month = _next_month(month)
+    return months
+
+
+def serves_period(date_end: datetime) -> bool:
+    """Whether a period ending at date_end can be served from tiles"""
+    if not TILE_STORE_DIR:
+        return False
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    return _next_month(date_end.replace(day=1, hour=0, minute=0, second=0, microsecond=0)) \
+        <= now - timedelta(days=TILE_STORE_MIN_AGE_DAYS)
+
+
+def read_generation_tiles(region_id: int, region_code: str, generation_type_id: Optional[int], date_start: datetime,
+                          date_end: datetime, resolution: str,
+                          fetch_month: Callable[[datetime, datetime], CompactResult]) -> CompactResult:
+    """
+    The generation data of a region in a period whose months can be served from tiles (see serves_period), as returned
+    by get_electricity_generation_df. Blocking, run on the database thread pool
+
+    :param fetch_month: Function reading the rows of every generation type of the region at this resolution between
+        a month start and the month end (inclusive) from the database
+    """
+    tiles = []
+    for month in months_of_period(date_start, date_end):
+        path = _tile_path(region_id, resolution, month)
+        with timed_stage('tile_read'):
+            tile = _read_tile(path)
+        if tile is not None:
+            TILE_REQUESTS.labels('hit').inc()
+        else:
+            TILE_REQUESTS.labels('miss').inc()
+            invalidations = _invalidations.get(region_id, 0)
+            fetched = fetch_month(month, _next_month(month) - timedelta(microseconds=1))
+            tile = {name: fetched.columns[name] for name in TILE_COLUMNS}
+            # Under the lock, so that an invalidation either comes first and the tile is not written, or deletes it
+            with _invalidations_lock:
+                if _invalidations.get(region_id, 0) == invalidations:
+                    _write_tile(path, tile)
+        tiles.append(tile)
+    date_stamps, generation_type_ids, aggregated_generation = (np.concatenate([tile[name] for tile in tiles])
+                                                               for name in TILE_COLUMNS)
+
+    first_bucket, last_bucket = epoch_seconds([bucket_start(date_start, resolution), date_end])
+    keep = (date_stamps >= first_bucket) & (date_stamps <= last_bucket)
+    if generation_type_id:
+        keep &= generation_type_ids == generation_type_id
+    return generation_result({region_id: region_code}, np.full(int(keep.sum()), region_id), date_stamps[keep],
+                             generation_type_ids[keep], aggregated_generation[keep])
+
+
+def invalidate_tiles(written: GenerationWritten):
+    """Delete the tiles of the months a write overlaps, at every resolution. Registered as a write listener handler"""
+    if not TILE_STORE_DIR:
+        return
+    with _invalidations_lock:
+        _invalidations[written.region_id] = _invalidations.get(written.region_id, 0) + 1
+    region_path = os.path.join(TILE_STORE_DIR, str(written.region_id))
+    if not os.path.isdir(region_path):
+        return
+    for resolution in os.listdir(region_path):
+        for month in months_of_period(written.start, written.end):
+            try:
+                os.remove(_tile_path(written.region_id, resolution, month))
+            except FileNotFoundError:
+                pass
+
+
+def clear_tiles():
+    """Delete every tile"""
+    if TILE_STORE_DIR and os.path.isdir(TILE_STORE_DIR):
+        for name in os.listdir(TILE_STORE_DIR):
+            shutil.rmtree(os.path.join(TILE_STORE_DIR, name), ignore_errors=True)
+
+
+def tile_store_stats() -> dict:
+    n_tiles = 0
+    size_bytes = 0
+    if TILE_STORE_DIR and os.path.isdir(TILE_STORE_DIR):
+        for directory, _, files in os.walk(TILE_STORE_DIR):
+            for file_name in files:
+                n_tiles += 1
+                size_bytes += os.path.getsize(os.path.join(directory, file_name))
+    return {'enabled': bool(TILE_STORE_DIR), 'tiles': n_tiles, 'size_bytes': size_bytes,
+            'min_age_days': TILE_STORE_MIN_AGE_DAYS, 'ttl_s': TILE_STORE_TTL}
+
+
+def _next_month(month: datetime) -> datetime:
+    return month.replace(year=month.year + month.month // 12, month=month.month % 12 + 1)
+
+
+def _tile_path(region_id: int, resolution: str, month: datetime) -> str:
+    return os.path.join(TILE_STORE_DIR, str(region_id), resolution, f'{month:%Y-%m}.arrow')
+
+
+def _read_tile(path: str) -> Optional[Dict[str, np.ndarray]]:
+    """The columns of a tile, or None if it does not exist, has expired or was written in a previous format"""
+    import pyarrow as pa
+
+    try:
+        if time.time() - os.path.getmtime(path) > TILE_STORE_TTL:
+            return None
+        with pa.memory_map(path) as source:
+            table = pa.ipc.open_file(source).read_all()
+            if tuple(table.schema.names) != TILE_COLUMNS or table.schema.field('DateStamp').type != pa.int32():
+                return None
+            # Copied once out of the memory map, which is closed when the with block ends
+            return {name: np.array(table.column(name)) for name in TILE_COLUMNS}
+    except FileNotFoundError:
+        return None
+    except (OSError, pa.ArrowInvalid) as e:
+        logging.warning(f'Could not read the generation tile {path}, reading the database instead: {e}')
+        return None
+
+
+def _write_tile(path: str, tile: Dict[str, np.ndarray]):
+    """Write a tile to a temporary file renamed into place, so readers never see a partly written tile"""
+    import pyarrow as pa
+
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{uuid.uuid4().hex[:8]}.tmp'
+        table = pa.Table.from_arrays([pa.array(tile[name]) for name in TILE_COLUMNS], names=list(TILE_COLUMNS))
+        with pa.OSFile(tmp_path, 'wb') as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logging.warning(f'Could not write the generation tile {path}: {e}')
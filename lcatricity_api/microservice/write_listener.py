@@ -0,0 +1,75 @@
+import logging
+import select
+import threading
+import time
+from typing import Callable, List
+
+import sqlalchemy
+
+from lcatricity_api.data.notifications import GENERATION_WRITTEN_CHANNEL, GenerationWritten, parse_generation_written
+
+# Seconds to wait before reconnecting after the listening connection is lost
+RECONNECT_DELAY = 5
+
+_handlers: List[Callable[[GenerationWritten], None]] = []
+_listener_thread = None
+
+
+def add_generation_written_handler(handler: Callable[[GenerationWritten], None]):
+    """Register a function called (on the listener thread) for each generation data write committed to the database"""
+    _handlers.append(handler)
+
+
+def start_generation_written_listener(engine: sqlalchemy.Engine):
+    """
+    Start a daemon thread that LISTENs to the GENERATION_WRITTEN_CHANNEL notifications sent by
+    store_generation_data_to_db and passes them to the registered handlers. Only one listener is started per process
+    """
+    global _listener_thread
+    if _listener_thread is not None:
+        return
+    _listener_thread = threading.Thread(target=_listen, args=(engine,), name='lcatricity-write-listener', daemon=True)
+    _listener_thread.start()
+
+
+def dispatch_generation_written(written: GenerationWritten):
+    for handler in _handlers:
+        try:
+            handler(written)
+        except Exception as e:
+            logging.error(f'Handler {handler} failed for {written}: {e}')
+
+
+def _listen(engine: sqlalchemy.Engine):
+    while True:
+        connection = None
+        try:
+            # Detached from the pool: the connection is held for the lifetime of the process
+            pool_connection = engine.raw_connection()
+            pool_connection.detach()
+            connection = pool_connection.driver_connection
+            connection.autocommit = True
+            with connection.cursor() as cursor:
+                cursor.execute(f'LISTEN {GENERATION_WRITTEN_CHANNEL}')
+            logging.info(f'Listening to `{GENERATION_WRITTEN_CHANNEL}` notifications')
+            while True:
+                if select.select([connection], [], [], 60) == ([], [], []):
+                    continue
+                connection.poll()
+                while connection.notifies:
+                    notification = connection.notifies.pop(0)
+                    try:
+                        written = parse_generation_written(notification.payload)
+                    except (ValueError, KeyError) as e:
+                        logging.error(f'Invalid `{GENERATION_WRITTEN_CHANNEL}` payload {notification.payload}: {e}')
+                        continue
+                    dispatch_generation_written(written)
+        except Exception as e:
+            # Writes made while disconnected are missed, so cached results rely on their TTL until then
+            logging.error(f'Lost the `{GENERATION_WRITTEN_CHANNEL}` listener connection, reconnecting: {e}')
+            if connection is not None:
+                try:
+                    connection.close()
+                except Exception:
+                    pass
+            time.sleep(RECONNECT_DELAY)
@@ -0,0 +1,120 @@
+# Per-request peak memory and time of a /calculate_all result, from the rows fetched from the database to the encoded
+# response body: DataFrames (as pd.read_sql returns them, with the region code and a datetime per row) against the
+# CompactResult arrays of lcatricity_api.microservice.compact_result. The database cursor is simulated by a generator
+# of row tuples, so no database is needed.
+#   python -m tests.benchmarks.bench_compact_results --rows 1000 10000 100000
+import argparse
+import json
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+from lcatricity_api.data.get_common_data import build_impact_factor_matrix
+from lcatricity_api.microservice.calculate import calculate_impacts, calculate_compact_impacts
+from lcatricity_api.microservice.formats import encode_frame, ARROW_STREAM_MEDIA_TYPE
+from lcatricity_api.microservice.generation import _fetch_generation_result
+from tests.benchmarks.bench_impact_engine import synthetic_environmental_impacts, N_GENERATION_TYPES
+
+REGION_ID = 1
+REGION_CODE = 'FR'
+START = datetime(2023, 1, 1)
+ENCODERS = {
+    'json': lambda result: (result.to_frame() if hasattr(result, 'to_frame') else result).to_json(
+        orient='records', date_format='iso').encode(),
+    'arrow': lambda result: encode_frame(result, ARROW_STREAM_MEDIA_TYPE),
+}
+
+
+class _SimulatedResult:
+    """Rows of a query, created while they are fetched like the tuples of a database driver"""
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    def partitions(self, size: int):
+        chunk = []
+        for row in self.rows:
+            chunk.append(row)
+            if len(chunk) == size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+
+class _SimulatedConnection:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def execute(self, statement):
+        return _SimulatedResult(self.rows)
+
+
+def _generation_rows(n_rows: int, compact: bool):
+    """Rows of the generation statement: (region code, DateStamp, ...) or, compact, (region id, epoch seconds, ...)"""
+    rng = np.random.default_rng(1)
+    values = rng.uniform(0, 5000, n_rows)
+    start_epoch = int((START - datetime(1970, 1, 1)).total_seconds())
+    for i in range(n_rows):
+        step = i // N_GENERATION_TYPES * 900
+        if compact:
+            yield REGION_ID, start_epoch + step, i % N_GENERATION_TYPES + 1, float(values[i])
+        else:
+            # The code is a new string object per row, as decoded by the driver
+            yield ''.join(REGION_CODE), START + timedelta(seconds=step), i % N_GENERATION_TYPES + 1, float(values[i])
+
+
+def _dataframe_request(n_rows: int, impact_factors, encoder) -> tuple:
+    # pd.read_sql fetches every row, then builds the DataFrame
+    rows = list(_generation_rows(n_rows, compact=False))
+    generation_df = pd.DataFrame.from_records(
+        rows, columns=['RegionCode', 'DateStamp', 'GenerationTypeId', 'AggregatedGeneration'])
+    del rows
+    result = calculate_impacts(generation_df, impact_factors)
+    return result, int(result.memory_usage(deep=True).sum()), encoder(result)
+
+
+def _compact_request(n_rows: int, impact_factors, encoder) -> tuple:
+    generation = _fetch_generation_result(_SimulatedConnection(_generation_rows(n_rows, compact=True)), None,
+                                          {REGION_ID: REGION_CODE})
+    result = calculate_compact_impacts(generation, impact_factors)
+    return result, result.nbytes, encoder(result)
+
+
+def _measure(request, n_rows: int, impact_factors, encoder) -> dict:
+    tracemalloc.start()
+    s = time.perf_counter()
+    result, result_bytes, body = request(n_rows, impact_factors, encoder)
+    elapsed = time.perf_counter() - s
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {'result_rows': len(result), 'result_mb': result_bytes / 2 ** 20, 'body_mb': len(body) / 2 ** 20,
+            'peak_python_memory_mb': peak / 2 ** 20, 'seconds': elapsed}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the memory of DataFrame and compact results per request')
+    parser.add_argument('--rows', type=int, nargs='+', default=[1_000, 10_000, 100_000],
+                        help='Number of generation rows (every impact category is calculated for each)')
+    parser.add_argument('--output', default=None, help='Optional path of a JSON file to write the results to')
+    args = parser.parse_args()
+
+    impact_factors = build_impact_factor_matrix(synthetic_environmental_impacts())
+    results = []
+    for n_rows in args.rows:
+        for encoding, encoder in ENCODERS.items():
+            for representation, request in (('dataframe', _dataframe_request), ('compact', _compact_request)):
+                result = {'generation_rows': n_rows, 'encoding': encoding, 'representation': representation,
+                          **_measure(request, n_rows, impact_factors, encoder)}
+                results.append(result)
+                print(json.dumps(result))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
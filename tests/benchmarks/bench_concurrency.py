@@ -0,0 +1,75 @@
+# Concurrency benchmark: p50/p95/p99 latency of cheap and expensive endpoints under mixed load.
+# Run it against a deployment before and after a change, e.g.
+#   python -m tests.benchmarks.bench_concurrency --label before --output before.json
+import argparse
+import asyncio
+import json
+import os
+import time
+
+import httpx
+import numpy as np
+from dotenv import load_dotenv
+
+# (path, params) of the requests making up the mixed load. The /calculate call covers several weeks, so it keeps the
+# database busy while the cheap /list_regions calls measure how much the slow requests stall the worker.
+SLOW_REQUEST = ('/calculate', {'date_start': '2024-01-01', 'date_end': '2024-02-15', 'region_code': 'FR',
+                               'impact_category_id': 1})
+FAST_REQUEST = ('/list_regions', {})
+
+
+async def _timed_get(client: httpx.AsyncClient, path: str, params: dict, latencies: dict):
+    s = time.perf_counter()
+    response = await client.get(path, params=params)
+    latencies.setdefault(path, []).append(time.perf_counter() - s)
+    latencies.setdefault(f'{path} status', []).append(response.status_code)
+
+
+async def _run_load(base_url: str, n_slow: int, n_fast: int, concurrency: int) -> dict:
+    latencies = {}
+    requests = [SLOW_REQUEST] * n_slow + [FAST_REQUEST] * n_fast
+    np.random.default_rng(0).shuffle(requests)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def _worker(path, params):
+        async with semaphore:
+            await _timed_get(client, path, params, latencies)
+
+    async with httpx.AsyncClient(base_url=base_url, timeout=300) as client:
+        s = time.perf_counter()
+        await asyncio.gather(*[_worker(path, params) for path, params in requests])
+        wall_time = time.perf_counter() - s
+
+    summary = {'wall_time_s': wall_time, 'requests': len(requests), 'throughput_rps': len(requests) / wall_time}
+    for path in (SLOW_REQUEST[0], FAST_REQUEST[0]):
+        values = np.array(latencies.get(path, [np.nan])) * 1000
+        statuses = latencies.get(f'{path} status', [])
+        summary[path] = {'count': len(statuses),
+                         'errors': sum(1 for code in statuses if code >= 400),
+                         'p50_ms': float(np.percentile(values, 50)),
+                         'p95_ms': float(np.percentile(values, 95)),
+                         'p99_ms': float(np.percentile(values, 99))}
+    return summary
+
+
+def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser(description='Mixed-load latency benchmark for the LCAtricity API')
+    parser.add_argument('--base-url', default=f"{os.getenv('ELEC_LCA_API_URL')}:{os.getenv('ELEC_LCA_API_PORT')}")
+    parser.add_argument('--slow', type=int, default=20, help='Number of slow /calculate requests')
+    parser.add_argument('--fast', type=int, default=200, help='Number of fast /list_regions requests')
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--label', default='run', help='Label stored with the results, e.g. before/after')
+    parser.add_argument('--output', default=None, help='Optional path of a JSON file to write the results to')
+    args = parser.parse_args()
+
+    summary = asyncio.run(_run_load(args.base_url, args.slow, args.fast, args.concurrency))
+    summary['label'] = args.label
+    print(json.dumps(summary, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(summary, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+# Benchmark of the response formats: encode time and payload size of JSON, NDJSON, Arrow IPC, Parquet and CSV, raw and
+# compressed, for /calculate results of increasing size. No database is needed.
+#   python -m tests.benchmarks.bench_export_formats --rows 1000 100000 1000000
+import argparse
+import gzip
+import json
+import time
+
+from lcatricity_api.data.get_common_data import build_impact_factor_matrix
+from lcatricity_api.microservice.calculate import calculate_impacts
+from lcatricity_api.microservice.formats import encode_frame, ARROW_STREAM_MEDIA_TYPE, PARQUET_MEDIA_TYPE, \
+    CSV_MEDIA_TYPE
+from tests.benchmarks.bench_impact_engine import synthetic_environmental_impacts, synthetic_generation
+
+ENCODERS = {
+    'json': lambda df: df.to_json(orient='records', date_format='iso').encode(),
+    'ndjson': lambda df: df.to_json(orient='records', lines=True, date_format='iso').encode(),
+    'arrow': lambda df: encode_frame(df, ARROW_STREAM_MEDIA_TYPE),
+    'parquet': lambda df: encode_frame(df, PARQUET_MEDIA_TYPE),
+    'csv': lambda df: encode_frame(df, CSV_MEDIA_TYPE),
+}
+
+
+def _compressors() -> dict:
+    compressors = {'none': lambda body: body, 'gzip': lambda body: gzip.compress(body, compresslevel=6)}
+    try:
+        import zstandard
+        compressors['zstd'] = zstandard.ZstdCompressor().compress
+    except ImportError:
+        pass
+    return compressors
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark encode time and payload size of the response formats')
+    parser.add_argument('--rows', type=int, nargs='+', default=[1_000, 100_000, 1_000_000],
+                        help='Number of generation rows (one impact category is calculated for each)')
+    parser.add_argument('--output', default=None, help='Optional path of a JSON file to write the results to')
+    args = parser.parse_args()
+
+    impact_factors = build_impact_factor_matrix(synthetic_environmental_impacts())
+    compressors = _compressors()
+    results = []
+    for n_rows in args.rows:
+        impact_df = calculate_impacts(synthetic_generation(n_rows), impact_factors, [1])
+        for format_name, encode in ENCODERS.items():
+            s = time.perf_counter()
+            body = encode(impact_df)
+            encode_time = time.perf_counter() - s
+            for compression_name, compress in compressors.items():
+                s = time.perf_counter()
+                compressed = compress(body)
+                result = {'rows': impact_df.shape[0], 'format': format_name, 'compression': compression_name,
+                          'encode_s': encode_time, 'compress_s': time.perf_counter() - s,
+                          'bytes': len(compressed)}
+                results.append(result)
+                print(json.dumps(result))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+# Micro-benchmark of the impact calculation: the original merge + row-wise apply (one impact category per call)
+# against the vectorized calculate_impacts engine, on synthetic generation data. No database is needed.
+#   python -m tests.benchmarks.bench_impact_engine --rows 1000 100000 1000000
+import argparse
+import json
+import time
+
+import numpy as np
+import pandas as pd
+
+from lcatricity_api.data.get_common_data import build_impact_factor_matrix
+from lcatricity_api.microservice.calculate import calculate_impacts
+from lcatricity_api.microservice.constants import conversion_factors
+
+N_GENERATION_TYPES = 20
+N_IMPACT_CATEGORIES = 8
+
+
+def synthetic_environmental_impacts() -> pd.DataFrame:
+    rng = np.random.default_rng(0)
+    generation_type_ids, impact_category_ids = np.meshgrid(np.arange(1, N_GENERATION_TYPES + 1),
+                                                           np.arange(1, N_IMPACT_CATEGORIES + 1))
+    n = generation_type_ids.size
+    return pd.DataFrame({'Id': np.arange(n),
+                         'ElectricityGenerationTypeId': generation_type_ids.ravel(),
+                         'ImpactCategoryId': impact_category_ids.ravel(),
+                         'ImpactValue': rng.uniform(0, 1000, n),
+                         'ImpactCategoryUnit': 'g CO2 eq.',
+                         'PerUnit': 'kWh',
+                         'ReferenceYear': 2021})
+
+
+def synthetic_generation(n_rows: int) -> pd.DataFrame:
+    rng = np.random.default_rng(1)
+    return pd.DataFrame({'RegionCode': 'FR',
+                         'DateStamp': pd.Timestamp('2023-01-01') + pd.to_timedelta(
+                             np.arange(n_rows) // N_GENERATION_TYPES * 15, unit='min'),
+                         'GenerationTypeId': np.arange(n_rows) % N_GENERATION_TYPES + 1,
+                         'AggregatedGeneration': rng.uniform(0, 5000, n_rows)})
+
+
+def legacy_calculate_impact(generation_df: pd.DataFrame, environmental_impacts_df: pd.DataFrame,
+                            impact_category_id: int) -> pd.DataFrame:
+    """The calculation as done by calculate_impact_df before the vectorized engine"""
+    environmental_impacts_df = environmental_impacts_df[
+        environmental_impacts_df['ImpactCategoryId'] == impact_category_id].drop(['ReferenceYear', 'Id'], axis=1)
+    generation_df = generation_df.copy()
+    generation_df['GenerationUnit'] = 'MJ'
+    calculation_df = generation_df.merge(environmental_impacts_df, left_on='GenerationTypeId',
+                                         right_on='ElectricityGenerationTypeId')
+    calculation_df.drop(["GenerationTypeId"], axis=1, inplace=True)
+    calculation_df['ConversionFactor'] = calculation_df[['GenerationUnit', 'PerUnit']].apply(
+        lambda x: conversion_factors[(x['GenerationUnit'], x['PerUnit'])], axis=1)
+    calculation_df['AggregatedGenerationConverted'] = calculation_df['AggregatedGeneration'] * calculation_df[
+        'ConversionFactor']
+    calculation_df['EnvironmentalImpact'] = calculation_df['AggregatedGenerationConverted'] * calculation_df[
+        'ImpactValue']
+    return calculation_df
+
+
+def _best_of(func, repeat: int) -> float:
+    timings = []
+    for _ in range(repeat):
+        s = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - s)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the impact calculation engine')
+    parser.add_argument('--rows', type=int, nargs='+', default=[1_000, 100_000, 1_000_000])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', default=None, help='Optional path of a JSON file to write the results to')
+    args = parser.parse_args()
+
+    environmental_impacts = synthetic_environmental_impacts()
+    impact_factors = build_impact_factor_matrix(environmental_impacts)
+    results = []
+    for n_rows in args.rows:
+        generation_df = synthetic_generation(n_rows)
+        # The legacy path is too slow to repeat at the largest sizes
+        repeat = args.repeat if n_rows <= 100_000 else 1
+        legacy_one = _best_of(lambda: legacy_calculate_impact(generation_df, environmental_impacts, 1), repeat)
+        vectorized_one = _best_of(lambda: calculate_impacts(generation_df, impact_factors, [1]), args.repeat)
+        vectorized_all = _best_of(lambda: calculate_impacts(generation_df, impact_factors), args.repeat)
+        result = {'rows': n_rows,
+                  'legacy_one_category_s': legacy_one,
+                  'legacy_all_categories_s (estimated, N sequential calls)': legacy_one * N_IMPACT_CATEGORIES,
+                  'vectorized_one_category_s': vectorized_one,
+                  'vectorized_all_categories_s': vectorized_all,
+                  'speedup_one_category': legacy_one / vectorized_one,
+                  'speedup_all_categories': legacy_one * N_IMPACT_CATEGORIES / vectorized_all}
+        results.append(result)
+        print(json.dumps(result))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+# Ingest throughput benchmark (rows per second): the COPY-based store_generation_frame_to_db and the parallel ingestion
+# pipeline against the previous DELETE + DataFrame.to_sql path (without its one second sleep). Needs the database from
+# `.env`.
+# The rows are written to existing regions and generation types on dates in 1990, and deleted afterwards.
+#   python -m tests.benchmarks.bench_ingest --region-ids 1 2 --generation-type-ids 1 2 3 4 --rows 10000 100000
+# With several --region-ids, the pipeline spreads the regions over --workers workers.
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+import pandas as pd
+import sqlalchemy
+from dotenv import load_dotenv
+
+from lcatricity_api.data.ingestion_pipeline import ingest_generation_series
+from lcatricity_api.data.rollups import create_rollup_tables, refresh_generation_rollups
+from lcatricity_api.data.store_generation_data import store_generation_frame_to_db
+
+BENCHMARK_START = pd.Timestamp('1990-01-01')
+
+
+def synthetic_generation_rows(n_rows: int, region_id: int, generation_type_ids: list) -> pd.DataFrame:
+    """n_rows data points at 15 min intervals, split over the generation types given"""
+    rng = np.random.default_rng(0)
+    n_types = len(generation_type_ids)
+    return pd.DataFrame({'RegionId': region_id,
+                         'DateStamp': BENCHMARK_START + pd.to_timedelta(np.arange(n_rows) // n_types * 15, unit='min'),
+                         'GenerationTypeId': np.array(generation_type_ids)[np.arange(n_rows) % n_types],
+                         'AggregatedGeneration': rng.uniform(0, 5000, n_rows)})
+
+
+def legacy_store(values_to_insert: pd.DataFrame, sql_engine: sqlalchemy.Engine):
+    """The previous store_generation_data_to_db, once per (region, generation type) series"""
+    elec_gen_table = sqlalchemy.Table('ElectricityGeneration', sqlalchemy.MetaData(), autoload_with=sql_engine)
+    for (region_id, generation_type_id), series_df in values_to_insert.groupby(['RegionId', 'GenerationTypeId']):
+        start, end = series_df['DateStamp'].min(), series_df['DateStamp'].max()
+        with sql_engine.begin() as connection:
+            connection.execute(elec_gen_table.delete().where(
+                (elec_gen_table.c.DateStamp >= start) & (elec_gen_table.c.DateStamp <= end) &
+                (elec_gen_table.c.RegionId == int(region_id)) &
+                (elec_gen_table.c.GenerationTypeId == int(generation_type_id))))
+        series_df.to_sql('ElectricityGeneration', sql_engine, if_exists='append', index=False)
+        with sql_engine.begin() as connection:
+            refresh_generation_rollups(connection, start, end, region_id=int(region_id),
+                                       generation_type_id=int(generation_type_id))
+
+
+def pipeline_store(values_to_insert: pd.DataFrame, sql_engine: sqlalchemy.Engine, n_workers: int):
+    """ingest_generation_series, one item per (region, generation type) series"""
+    items = ((region_id, generation_type_id,
+              series_df.set_index('DateStamp')[['AggregatedGeneration']].rename(
+                  columns={'AggregatedGeneration': 'Actual Aggregated'}))
+             for (region_id, generation_type_id), series_df in values_to_insert.groupby(['RegionId',
+                                                                                          'GenerationTypeId']))
+    report = ingest_generation_series(items, sql_engine, n_workers=n_workers)
+    if report.items_failed:
+        raise RuntimeError(f'{len(report.items_failed)} series failed: {report.items_failed[0]}')
+
+
+def delete_benchmark_rows(sql_engine: sqlalchemy.Engine, region_ids: list, end: pd.Timestamp):
+    with sql_engine.begin() as connection:
+        for region_id in region_ids:
+            connection.execute(sqlalchemy.text(
+                'DELETE FROM "ElectricityGeneration" WHERE "RegionId" = :region_id AND "DateStamp" >= :start '
+                'AND "DateStamp" <= :end'), {'region_id': region_id, 'start': BENCHMARK_START, 'end': end})
+            refresh_generation_rollups(connection, BENCHMARK_START, end, region_id=region_id)
+
+
+def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser(description='Benchmark the ingest throughput of generation data')
+    parser.add_argument('--region-ids', type=int, nargs='+', required=True,
+                        help='Existing internal region ids to write to')
+    parser.add_argument('--generation-type-ids', type=int, nargs='+', required=True,
+                        help='Existing internal generation type ids to write to, one series each')
+    parser.add_argument('--rows', type=int, nargs='+', default=[10_000, 100_000], help='Number of rows per region')
+    parser.add_argument('--workers', type=int, default=4, help='Number of workers of the ingestion pipeline')
+    parser.add_argument('--output', default=None, help='Optional path of a JSON file to write the results to')
+    args = parser.parse_args()
+
+    sql_engine = sqlalchemy.create_engine(sqlalchemy.engine.url.URL.create(
+        drivername='postgresql',
+        host=os.getenv('ELEC_LCA_DB_HOST'),
+        database=os.getenv('ELEC_LCA_DB_NAME'),
+        username=os.getenv('ELEC_LCA_DB_LOGIN'),
+        password=os.getenv('ELEC_LCA_DB_PWD'),
+        port=os.getenv('ELEC_LCA_DB_PORT')
+    ), pool_size=args.workers)
+    create_rollup_tables(sql_engine)
+
+    results = []
+    for n_rows in args.rows:
+        values_to_insert = pd.concat([synthetic_generation_rows(n_rows, region_id, args.generation_type_ids)
+                                      for region_id in args.region_ids], ignore_index=True)
+        end = values_to_insert['DateStamp'].max()
+        methods = (('legacy', legacy_store),
+                   ('copy', store_generation_frame_to_db),
+                   ('pipeline', lambda df, engine: pipeline_store(df, engine, args.workers)))
+        for method, store in methods:
+            try:
+                s = time.perf_counter()
+                store(values_to_insert, sql_engine)
+                elapsed = time.perf_counter() - s
+            finally:
+                delete_benchmark_rows(sql_engine, args.region_ids, end)
+            result = {'rows': values_to_insert.shape[0],
+                      'series': len(args.region_ids) * len(args.generation_type_ids),
+                      'method': method, 'workers': args.workers if method == 'pipeline' else 1,
+                      'time_s': elapsed, 'rows_per_s': values_to_insert.shape[0] / elapsed}
+            results.append(result)
+            print(json.dumps(result))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
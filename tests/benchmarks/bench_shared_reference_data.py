@@ -0,0 +1,95 @@
+# Shared reference data benchmark (no database needed): time for the writer to publish a snapshot of synthetic
+# reference data, and for N worker processes to build their cache from it, with the memory each worker adds (RSS after
+# loading minus RSS before). Each worker holds its own copy of the DataFrames and lookups, so the added memory does not
+# go down with more workers: what the snapshot saves is the database load of every worker. Compare the load time with
+# last_refresh_duration_s of /admin/reference_data on the database.
+#   python -m tests.benchmarks.bench_shared_reference_data --workers 1 2 4 8 --regions 200 --output shared.json
+import argparse
+import datetime
+import json
+import multiprocessing
+import os
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from lcatricity_api.data.get_common_data import BasicDataCache
+from lcatricity_api.data.shared_reference_data import publish_snapshot, read_snapshot, acquire_writer_lock
+
+
+def synthetic_reference_data(regions: int, generation_types: int, impact_categories: int) -> BasicDataCache:
+    rng = np.random.default_rng(0)
+    factor_generation_types, factor_impact_categories = np.meshgrid(np.arange(1, generation_types + 1),
+                                                                    np.arange(1, impact_categories + 1))
+    return BasicDataCache(
+        generation_types=pd.DataFrame({'Id': np.arange(1, generation_types + 1),
+                                       'Name': [f'Generation type {i}' for i in range(generation_types)]}),
+        generation_type_mappings=pd.DataFrame({'Id': np.arange(1, generation_types + 1),
+                                               'OriginalName': [f'Original {i}' for i in range(generation_types)],
+                                               'GenerationTypeId': np.arange(1, generation_types + 1)}),
+        regions=pd.DataFrame({'Id': np.arange(1, regions + 1), 'Code': [f'R{i:03d}' for i in range(regions)],
+                              'Name': [f'Region {i}' for i in range(regions)]}),
+        impact_categories=pd.DataFrame({'Id': np.arange(1, impact_categories + 1),
+                                        'Name': [f'Impact category {i}' for i in range(impact_categories)]}),
+        environmental_impacts=pd.DataFrame({'Id': np.arange(1, factor_generation_types.size + 1),
+                                            'ElectricityGenerationTypeId': factor_generation_types.ravel(),
+                                            'ImpactCategoryId': factor_impact_categories.ravel(),
+                                            'ImpactValue': rng.uniform(0, 1000, factor_generation_types.size),
+                                            'ImpactCategoryUnit': 'g CO2 eq.', 'PerUnit': 'kWh',
+                                            'ReferenceYear': 2021}),
+        retrieved_timestamp=datetime.datetime.now(datetime.timezone.utc))
+
+
+def _rss_bytes() -> int:
+    # Current resident set size (Linux)
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def _attach(directory: str, results):
+    rss_before = _rss_bytes()
+    s = time.perf_counter()
+    cache = read_snapshot(directory)
+    results.put({'load_s': time.perf_counter() - s, 'added_rss_mb': (_rss_bytes() - rss_before) / 2 ** 20})
+    del cache
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the reference data shared between workers')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--regions', type=int, default=200)
+    parser.add_argument('--generation-types', type=int, default=50)
+    parser.add_argument('--impact-categories', type=int, default=20)
+    parser.add_argument('--output', default=None, help='Optional path of a JSON file to write the results to')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='lcatricity-shared-', dir='/dev/shm')
+    cache = synthetic_reference_data(args.regions, args.generation_types, args.impact_categories)
+    acquire_writer_lock(directory)
+    s = time.perf_counter()
+    publish_snapshot(cache, directory)
+    summary = {'publish_s': time.perf_counter() - s, 'runs': []}
+    context = multiprocessing.get_context('spawn')
+    for n_workers in args.workers:
+        results = context.Queue()
+        processes = [context.Process(target=_attach, args=(directory, results)) for _ in range(n_workers)]
+        for process in processes:
+            process.start()
+        attached = [results.get() for _ in processes]
+        for process in processes:
+            process.join()
+        run = {'workers': n_workers,
+               'median_load_s': float(np.median([result['load_s'] for result in attached])),
+               'median_added_rss_mb': float(np.median([result['added_rss_mb'] for result in attached]))}
+        summary['runs'].append(run)
+        print(json.dumps(run))
+    print(json.dumps(summary, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(summary, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
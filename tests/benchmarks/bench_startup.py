@@ -0,0 +1,66 @@
+# Startup benchmark: time to import the app, time from launching uvicorn to the first request served (/healthz), and to
+# ready (/readyz, reference data loaded and database reachable). Uses the database settings from `.env`.
+#   python -m tests.benchmarks.bench_startup --runs 5 --output startup.json
+import argparse
+import json
+import subprocess
+import sys
+import time
+
+import httpx
+import numpy as np
+
+IMPORT_SCRIPT = ('import time; s = time.perf_counter(); import lcatricity_api.microservice.main; '
+                 'print(time.perf_counter() - s)')
+
+
+def _wait_for(url: str, process: subprocess.Popen, start: float, timeout: float):
+    """Seconds from start until url answers 200, or None if the process exits or the timeout is reached"""
+    while time.perf_counter() - start < timeout:
+        if process.poll() is not None:
+            return None
+        try:
+            if httpx.get(url, timeout=1).status_code == 200:
+                return time.perf_counter() - start
+        except httpx.TransportError:
+            pass
+        time.sleep(0.01)
+    return None
+
+
+def measure_startup(port: int, timeout: float) -> dict:
+    import_time = float(subprocess.run([sys.executable, '-c', IMPORT_SCRIPT], capture_output=True, text=True,
+                                       check=True).stdout.strip().splitlines()[-1])
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, '-m', 'uvicorn', 'lcatricity_api.microservice.main:app',
+                                '--port', str(port), '--log-level', 'warning'])
+    try:
+        first_request = _wait_for(f'http://127.0.0.1:{port}/healthz', process, start, timeout)
+        ready = _wait_for(f'http://127.0.0.1:{port}/readyz', process, start, timeout)
+    finally:
+        process.terminate()
+        process.wait()
+    return {'import_s': import_time, 'first_request_s': first_request, 'ready_s': ready}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the startup time of the LCAtricity API')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--timeout', type=float, default=120, help='Seconds to wait for each probe')
+    parser.add_argument('--output', default=None, help='Optional path of a JSON file to write the results to')
+    args = parser.parse_args()
+
+    runs = [measure_startup(args.port, args.timeout) for _ in range(args.runs)]
+    summary = {'runs': runs}
+    for metric in ('import_s', 'first_request_s', 'ready_s'):
+        values = [run[metric] for run in runs if run[metric] is not None]
+        summary[f'median_{metric}'] = float(np.median(values)) if values else None
+    print(json.dumps(summary, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(summary, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
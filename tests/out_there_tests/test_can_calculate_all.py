@@ -0,0 +1,25 @@
+# Test that /calculate_all returns the same impacts as /calculate, for every impact category at once
+import os
+
+import httpx
+from dotenv import load_dotenv
+
+
+def test_calculate_all_matches_calculate():
+    load_dotenv()
+    API_BASE_URL = os.getenv('ELEC_LCA_API_URL')
+    ELEC_LCA_API_PORT = os.getenv('ELEC_LCA_API_PORT')
+    params = {'date_start': '2024-02-01', 'region_code': 'FR'}
+
+    response = httpx.get(url=f'{API_BASE_URL}:{ELEC_LCA_API_PORT}/calculate_all', params=params, timeout=60)
+    assert 200 <= response.status_code < 300
+    all_impacts = response.json()
+    assert len(all_impacts)
+
+    impact_category_id = all_impacts[0]['ImpactCategoryId']
+    response = httpx.get(url=f'{API_BASE_URL}:{ELEC_LCA_API_PORT}/calculate',
+                         params=params | {'impact_category_id': impact_category_id}, timeout=60)
+    assert 200 <= response.status_code < 300
+    single_impact = response.json()
+
+    assert len(single_impact) == len([row for row in all_impacts if row['ImpactCategoryId'] == impact_category_id])
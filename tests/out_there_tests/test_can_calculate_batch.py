@@ -0,0 +1,24 @@
+# Test that /calculate_batch returns the same impacts per region as /calculate
+import os
+
+import httpx
+from dotenv import load_dotenv
+
+
+def test_calculate_batch_matches_calculate():
+    load_dotenv()
+    API_BASE_URL = os.getenv('ELEC_LCA_API_URL')
+    ELEC_LCA_API_PORT = os.getenv('ELEC_LCA_API_PORT')
+    batch = {'region_codes': ['FR', 'NL'], 'impact_category_ids': [1], 'date_start': '2024-02-01'}
+
+    response = httpx.post(url=f'{API_BASE_URL}:{ELEC_LCA_API_PORT}/calculate_batch', json=batch, timeout=60)
+    assert 200 <= response.status_code < 300
+    impacts_by_region = response.json()
+    assert list(impacts_by_region) == ['FR', 'NL']
+
+    for region_code, region_impacts in impacts_by_region.items():
+        response = httpx.get(url=f'{API_BASE_URL}:{ELEC_LCA_API_PORT}/calculate',
+                             params={'date_start': '2024-02-01', 'region_code': region_code, 'impact_category_id': 1},
+                             timeout=60)
+        assert 200 <= response.status_code < 300
+        assert len(response.json()) == len(region_impacts)
@@ -0,0 +1,49 @@
+# Test that paging through /generation returns every raw data point once, in order
+import os
+
+import httpx
+from dotenv import load_dotenv
+
+
+def test_generation_pages_cover_the_period():
+    load_dotenv()
+    API_BASE_URL = os.getenv('ELEC_LCA_API_URL')
+    ELEC_LCA_API_PORT = os.getenv('ELEC_LCA_API_PORT')
+    params = {'date_start': '2024-02-01', 'date_end': '2024-02-03', 'region_code': 'FR', 'resolution': 'raw'}
+
+    response = httpx.get(url=f'{API_BASE_URL}:{ELEC_LCA_API_PORT}/generation', params=params, timeout=60)
+    if response.status_code == 422:
+        # Too many rows for an unpaginated response: compare the pages with each other only
+        unpaginated = None
+    else:
+        assert response.status_code == 200
+        unpaginated = response.json()
+
+    rows = []
+    cursor = None
+    while True:
+        page_params = params | {'page_size': 500} | ({'cursor': cursor} if cursor is not None else {})
+        response = httpx.get(url=f'{API_BASE_URL}:{ELEC_LCA_API_PORT}/generation', params=page_params, timeout=60)
+        assert response.status_code == 200
+        page = response.json()
+        assert len(page) <= 500
+        rows.extend(page)
+        cursor = response.headers.get('x-next-cursor')
+        if cursor is None:
+            break
+
+    keys = [(row['DateStamp'], row['GenerationTypeId']) for row in rows]
+    assert keys == sorted(keys)
+    assert len(set(keys)) == len(keys)
+    if unpaginated is not None:
+        assert len(rows) == len(unpaginated)
+
+
+def test_invalid_cursor_is_rejected():
+    load_dotenv()
+    API_BASE_URL = os.getenv('ELEC_LCA_API_URL')
+    ELEC_LCA_API_PORT = os.getenv('ELEC_LCA_API_PORT')
+
+    response = httpx.get(url=f'{API_BASE_URL}:{ELEC_LCA_API_PORT}/datapoints_count_by_day',
+                         params={'page_size': 10, 'cursor': 'not-a-cursor'})
+    assert response.status_code == 422
@@ -21,3 +21,17 @@ def test_get_regions():
         raise e
 
     assert len(response_json) == EXPECTED_NUMBER_REGIONS
+
+
+def test_get_regions_not_modified():
+    load_dotenv()
+    API_BASE_URL = os.getenv('ELEC_LCA_API_URL')
+    ELEC_LCA_API_PORT = os.getenv('ELEC_LCA_API_PORT')
+
+    response = httpx.get(url=f'{API_BASE_URL}:{ELEC_LCA_API_PORT}/list_regions')
+    assert 200 <= response.status_code < 300
+    etag = response.headers['ETag']
+
+    response = httpx.get(url=f'{API_BASE_URL}:{ELEC_LCA_API_PORT}/list_regions', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.headers['ETag'] == etag
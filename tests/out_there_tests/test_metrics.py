@@ -0,0 +1,57 @@
+# Test that the stage timings are sent with the responses and the Prometheus metrics are exposed
+import asyncio
+import os
+
+import httpx
+from dotenv import load_dotenv
+
+
+def test_server_timing_and_metrics():
+    load_dotenv()
+    API_BASE_URL = os.getenv('ELEC_LCA_API_URL')
+    ELEC_LCA_API_PORT = os.getenv('ELEC_LCA_API_PORT')
+
+    response = httpx.get(url=f'{API_BASE_URL}:{ELEC_LCA_API_PORT}/calculate',
+                         params={'date_start': '2024-02-01', 'region_code': 'FR', 'impact_category_id': 1})
+    assert response.status_code == 200
+    assert 'total;dur=' in response.headers['server-timing']
+
+    response = httpx.get(url=f'{API_BASE_URL}:{ELEC_LCA_API_PORT}/metrics')
+    assert response.status_code == 200
+    assert 'lcatricity_request_duration_seconds_count{endpoint="/calculate"' in response.text
+    assert 'lcatricity_stage_duration_seconds' in response.text
+
+
+def test_slow_query_log():
+    load_dotenv()
+    API_BASE_URL = os.getenv('ELEC_LCA_API_URL')
+    ELEC_LCA_API_PORT = os.getenv('ELEC_LCA_API_PORT')
+
+    admin_headers = {'Authorization': f'Bearer {os.getenv("ELEC_LCA_ADMIN_TOKEN")}'}
+
+    response = httpx.get(url=f'{API_BASE_URL}:{ELEC_LCA_API_PORT}/admin/slow_queries')
+    assert response.status_code in (401, 404)
+
+    response = httpx.get(url=f'{API_BASE_URL}:{ELEC_LCA_API_PORT}/admin/slow_queries', headers=admin_headers)
+    assert response.status_code == 200
+    assert isinstance(response.json()['queries'], list)
+
+
+def test_coalesces_identical_requests():
+    load_dotenv()
+    API_BASE_URL = os.getenv('ELEC_LCA_API_URL')
+    ELEC_LCA_API_PORT = os.getenv('ELEC_LCA_API_PORT')
+    params = {'date_start': '2024-02-01', 'region_code': 'FR', 'impact_category_id': 1}
+
+    async def get_concurrently():
+        async with httpx.AsyncClient(base_url=f'{API_BASE_URL}:{ELEC_LCA_API_PORT}', timeout=60) as client:
+            return await asyncio.gather(*[client.get('/calculate', params=params) for _ in range(10)])
+
+    responses = asyncio.run(get_concurrently())
+    assert all(response.status_code == 200 for response in responses)
+    assert len({response.content for response in responses}) == 1
+
+    response = httpx.get(url=f'{API_BASE_URL}:{ELEC_LCA_API_PORT}/admin/coalescing',
+                         headers={'Authorization': f'Bearer {os.getenv("ELEC_LCA_ADMIN_TOKEN")}'})
+    assert response.status_code == 200
+    assert response.json()['leaders'] >= 1
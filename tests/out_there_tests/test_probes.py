@@ -0,0 +1,18 @@
+# Test that the liveness and readiness probes answer
+import os
+
+import httpx
+from dotenv import load_dotenv
+
+
+def test_healthz_and_readyz():
+    load_dotenv()
+    API_BASE_URL = os.getenv('ELEC_LCA_API_URL')
+    ELEC_LCA_API_PORT = os.getenv('ELEC_LCA_API_PORT')
+
+    response = httpx.get(url=f'{API_BASE_URL}:{ELEC_LCA_API_PORT}/healthz')
+    assert response.status_code == 200
+
+    response = httpx.get(url=f'{API_BASE_URL}:{ELEC_LCA_API_PORT}/readyz')
+    assert response.status_code == 200
+    assert response.json() == {'cache_loaded': True, 'database_reachable': True}